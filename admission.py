@@ -0,0 +1,234 @@
+import os
+import math
+import time
+import asyncio
+import threading
+from functools import wraps
+from collections import OrderedDict
+from flask import g, request
+
+from dbpool import DB_POOL_SIZE, DB_MAX_OVERFLOW
+from metrics import registry
+
+'''
+Admission control settings, read from the environment
+Every limit is per worker. By default reads and writes together never
+hold more requests than the worker's connection pool can serve, so an
+admitted request does not wait for a connection.
+'''
+
+ADMISSION_ENABLED = os.environ.get(
+    'ADMISSION_ENABLED', 'true').lower() == 'true'
+ADMISSION_MAX_WRITES = int(os.environ.get(
+    'ADMISSION_MAX_WRITES', max(1, (DB_POOL_SIZE + DB_MAX_OVERFLOW) // 3)))
+ADMISSION_MAX_READS = int(os.environ.get(
+    'ADMISSION_MAX_READS',
+    max(1, DB_POOL_SIZE + DB_MAX_OVERFLOW - ADMISSION_MAX_WRITES)))
+# requests waiting for a slot of each budget, the next ones are shed
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 16))
+# seconds a queued request waits for a slot before it is shed
+ADMISSION_QUEUE_TIMEOUT = float(
+    os.environ.get('ADMISSION_QUEUE_TIMEOUT', 2.0))
+# Retry-After (seconds) of the shed requests
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+# requests per second allowed to each JWT subject, 0 disables the limit
+RATE_LIMIT = float(os.environ.get('RATE_LIMIT', 0))
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 20))
+# subjects whose bucket is kept, the least recently seen are dropped
+RATE_LIMIT_SUBJECTS = int(os.environ.get('RATE_LIMIT_SUBJECTS', 10000))
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# never shed, so the overload stays observable
+EXEMPT_PATHS = ('/metrics',)
+
+'''
+Overloaded Exception
+raised when a request is shed (503) or rate limited (429), the response
+tells the client when to retry
+'''
+
+
+class Overloaded(Exception):
+    def __init__(self, status_code, message, retry_after):
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+
+class Bulkhead:
+    """Caps the requests in flight and the requests queued behind them.
+
+    acquire() admits a request right away while there is a free slot,
+    queues it while the queue has room and fails once it is full or when
+    the slot is not freed within the timeout.
+    """
+
+    def __init__(self, name, limit, queue_size=ADMISSION_QUEUE_SIZE,
+                 timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._condition = threading.Condition()
+
+    def try_acquire(self):
+        '''takes a free slot without waiting, returns whether it did'''
+        with self._condition:
+            if self.in_flight < self.limit and self.queued == 0:
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        '''returns None when admitted, else the reason of the refusal'''
+        with self._condition:
+            if self.try_acquire():
+                return None
+            if self.queued >= self.queue_size:
+                return 'queue_full'
+            registry.inc('requests_queued_total', kind=self.name)
+            self.queued += 1
+            deadline = time.monotonic() + self.timeout
+            try:
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return 'timeout'
+                    self._condition.wait(remaining)
+                self.in_flight += 1
+                return None
+            finally:
+                self.queued -= 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'queue_size': self.queue_size
+        }
+
+
+class RateLimiter:
+    """Token bucket rate limit per JWT subject.
+
+    Each subject gets burst tokens, refilled at rate tokens per second,
+    and every request takes one. Buckets are kept in a bounded LRU.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_LIMIT_BURST,
+                 max_subjects=RATE_LIMIT_SUBJECTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_subjects = max_subjects
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, subject):
+        '''returns 0 when the request is allowed, else the seconds to wait
+        for the next token'''
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(subject, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[subject] = (tokens, now)
+            self._buckets.move_to_end(subject)
+            while len(self._buckets) > self.max_subjects:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+bulkheads = {
+    'read': Bulkhead('read', ADMISSION_MAX_READS),
+    'write': Bulkhead('write', ADMISSION_MAX_WRITES)
+}
+rate_limiter = RateLimiter()
+
+'''
+check_rate_limit(payload)
+    takes a token from the bucket of the payload's subject, raises
+    Overloaded (429) when it is empty; called by requires_auth once the
+    token is verified so a forged sub cannot drain someone else's bucket
+'''
+
+
+def check_rate_limit(payload):
+    subject = payload.get('sub')
+    if subject is None:
+        return
+    wait = rate_limiter.consume(subject)
+    if wait:
+        registry.inc('requests_rate_limited_total')
+        raise Overloaded(429, 'too many requests', math.ceil(wait))
+
+
+'''
+init_admission(app)
+    admits every request of the app into the read or write budget before
+    it runs, and sheds it with 503 when the budget and its queue are full
+'''
+
+
+def init_admission(app):
+    @app.before_request
+    def admit():
+        if not ADMISSION_ENABLED or request.path in EXEMPT_PATHS:
+            return
+        name = 'read' if request.method in READ_METHODS else 'write'
+        reason = bulkheads[name].acquire()
+        if reason is not None:
+            registry.inc('requests_shed_total', kind=name, reason=reason)
+            raise Overloaded(
+                503, 'service unavailable', ADMISSION_RETRY_AFTER)
+        g.admission_budget = name
+
+    @app.teardown_request
+    def release(exception=None):
+        name = g.pop('admission_budget', None)
+        if name is not None:
+            bulkheads[name].release()
+
+
+'''
+admitted_async(f)
+    admits an async handler of asgi.py into the budgets of init_admission,
+    which the requests handed over to the Flask app go through instead
+    a free slot is taken on the event loop, waiting in the queue for one
+    happens in a worker thread so the loop keeps serving
+'''
+
+
+def admitted_async(f):
+    @wraps(f)
+    async def wrapper(request, *args, **kwargs):
+        if not ADMISSION_ENABLED:
+            return await f(request, *args, **kwargs)
+        name = 'read' if request.method in READ_METHODS else 'write'
+        bulkhead = bulkheads[name]
+        if not bulkhead.try_acquire():
+            reason = await asyncio.get_running_loop().run_in_executor(
+                None, bulkhead.acquire)
+            if reason is not None:
+                registry.inc('requests_shed_total', kind=name, reason=reason)
+                raise Overloaded(
+                    503, 'service unavailable', ADMISSION_RETRY_AFTER)
+        try:
+            return await f(request, *args, **kwargs)
+        finally:
+            bulkhead.release()
+
+    return wrapper
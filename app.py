@@ -3,42 +3,77 @@ from flask import (
     Flask,
     request,
     abort,
-    jsonify
+    Response
 )
-from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy.orm import selectinload
 
 from models import (
+    db,
     setup_db,
     Movie,
     Actor,
+    movie_actors,
+    bulk_insert,
+    update_rows,
+    delete_rows,
+    update_row,
+    delete_row,
+    bump_version,
     db_drop_and_create_all
 )
 from auth import AuthError, requires_auth
-
-from flask_migrate import Migrate
+from pagination import (
+    get_page_args,
+    get_fields,
+    paginate,
+    select_fields,
+    row_to_dict
+)
+from filtering import get_filters, get_sort
+from includes import get_include
+from streaming import stream_collection
+from export import export_collection
+from changes import get_changes_args, get_changes
+from search import get_search_args, search
+from stats import get_stats
+from bulk import (
+    read_bulk_rows,
+    validate_rows,
+    read_batch_criteria,
+    read_values
+)
+from conditional import collection_etag, not_modified
+from serialization import jsonify
+from dbpool import get_pool_status
+from metrics import init_metrics, registry, render_prometheus, timed
+from admission import init_admission, bulkheads, Overloaded
+from replicas import init_replicas, replica_set
 
 
 def create_app(test_config=None):
 
     # create and configure the app
     app = Flask(__name__)
+    # compact responses, jsonify still indents them in debug mode
+    app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
     CORS(app)
+    init_metrics(app)
+    init_admission(app)
+    init_replicas(app)
 
+    # binds the single SQLAlchemy instance, no connection is opened here
     setup_db(app)
     # To create a new database on app refresh uncomment the below line.
     # db_drop_and_create_all()
 
-    db = SQLAlchemy(app)
-    migrate = Migrate(app, db)
-
     # CORS Headers
     @app.after_request
     def after_request(response):
         response.headers.add(
             'Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
         response.headers.add(
-            'Access-Control-Allow-Methods', 'GET,PATCH,POST,DELETE')
+            'Access-Control-Allow-Methods', 'GET,PUT,PATCH,POST,DELETE')
         return response
 
     @app.route('/', methods=['GET'])
@@ -53,22 +88,50 @@ def create_app(test_config=None):
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
     def get_movies(payload):
+        fields = get_fields(request.args, Movie)
+        filters = get_filters(request.args, Movie)
+        sort = get_sort(request.args, Movie)
+        include = get_include(request.args, Movie)
+        stream = request.args.get('stream') == 'true'
+        if stream and include:
+            abort(400)
+        if not stream:
+            limit, after = get_page_args(request.args, Movie, sort)
+
+        # answer 304 before touching the rows when nothing has changed
+        # (the included relationships are named after their collections)
+        etag = collection_etag('movies', *include)
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        # stream the whole collection instead of a single page
+        if stream:
+            response = stream_collection(
+                'movies', Movie, fields, filters=filters, sort=sort)
+            response.set_etag(etag)
+            return response
+
         try:
-            # fetch all movies in the db
-            movie_list = Movie.query.all()
-            # convert fetched movie list to data representation
-            movies = [movie.format() for movie in movie_list]
+            # fetch one page of the requested movie columns in the db
+            movies, next_cursor = paginate(
+                Movie, fields, limit, after, filters, sort, include)
 
-            if len(movies) == 0:
+            # only the first page is expected to be non empty
+            if len(movies) == 0 and after is None:
                 print("movie list is empty")
                 abort(404)
 
-            return jsonify(
-                    {
-                        "success": True,
-                        "movies": movies
-                    }
-            )
+            with timed('serialize'):
+                response = jsonify(
+                        {
+                            "success": True,
+                            "movies": movies,
+                            "next": next_cursor
+                        }
+                )
+            response.set_etag(etag)
+            return response
         except Exception as e:
             if '404' in str(e):
                 abort(404)
@@ -78,28 +141,192 @@ def create_app(test_config=None):
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
     def get_actors(payload):
+        fields = get_fields(request.args, Actor)
+        filters = get_filters(request.args, Actor)
+        sort = get_sort(request.args, Actor)
+        include = get_include(request.args, Actor)
+        stream = request.args.get('stream') == 'true'
+        if stream and include:
+            abort(400)
+        if not stream:
+            limit, after = get_page_args(request.args, Actor, sort)
+
+        # answer 304 before touching the rows when nothing has changed
+        # (the included relationships are named after their collections)
+        etag = collection_etag('actors', *include)
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        # stream the whole collection instead of a single page
+        if stream:
+            response = stream_collection(
+                'actors', Actor, fields, filters=filters, sort=sort)
+            response.set_etag(etag)
+            return response
+
         try:
-            # fetch all actors in the db
-            actor_list = Actor.query.all()
-            # convert fetched actors list to data representation
-            actors = [actor.format() for actor in actor_list]
+            # fetch one page of the requested actor columns in the db
+            actors, next_cursor = paginate(
+                Actor, fields, limit, after, filters, sort, include)
 
-            if len(actors) == 0:
+            # only the first page is expected to be non empty
+            if len(actors) == 0 and after is None:
                 print("actors list is empty")
                 abort(404)
 
-            return jsonify(
-                    {
-                        "success": True,
-                        "actors": actors
-                    }
-            )
+            with timed('serialize'):
+                response = jsonify(
+                        {
+                            "success": True,
+                            "actors": actors,
+                            "next": next_cursor
+                        }
+                )
+            response.set_etag(etag)
+            return response
         except Exception as e:
             if '404' in str(e):
                 abort(404)
             else:
                 print(e)
 
+    '''
+    get_one(name, model, id)
+        answers a single row with the relationships requested with
+        ?include= embedded, loaded with one selectin query each
+    '''
+    def get_one(name, model, id):
+        include = get_include(request.args, model)
+        instance = db.session.get(model, id, options=[
+            selectinload(getattr(model, relationship))
+            for relationship in include])
+        if instance is None:
+            abort(404)
+
+        item = instance.format()
+        for relationship in include:
+            item[relationship] = [
+                related.format()
+                for related in getattr(instance, relationship)]
+        return jsonify(
+            {
+                "success": True,
+                name: [item]
+            }
+        )
+
+    @app.route("/movies/<int:id>", methods=["GET"])
+    @requires_auth('get:movies')
+    # This method is used to fetch a movie, ?include=actors adds its cast
+    def get_movie(payload, id):
+        return get_one('movie', Movie, id)
+
+    @app.route("/actors/<int:id>", methods=["GET"])
+    @requires_auth('get:actors')
+    # This method is used to fetch an actor, ?include=movies adds its movies
+    def get_actor(payload, id):
+        return get_one('actor', Actor, id)
+
+    '''
+    search_collection(name, model)
+        answers a ranked, paginated full text search of the collection
+        backed by its text index, 404 when nothing matches
+    '''
+    def search_collection(name, model):
+        fields = get_fields(request.args, model)
+        q, limit, after = get_search_args(request.args)
+        try:
+            items, next_cursor = search(model, fields, q, limit, after)
+
+            # only the first page is expected to be non empty
+            if len(items) == 0 and after is None:
+                abort(404)
+
+            with timed('serialize'):
+                return jsonify(
+                        {
+                            "success": True,
+                            name: items,
+                            "next": next_cursor
+                        }
+                )
+        except Exception as e:
+            if '404' in str(e):
+                abort(404)
+            else:
+                print(e)
+                abort(500)
+
+    @app.route('/movies/search', methods=['GET'])
+    @requires_auth('get:movies')
+    # This method is used to search movies by name and genre
+    def search_movies(payload):
+        return search_collection('movies', Movie)
+
+    @app.route('/actors/search', methods=['GET'])
+    @requires_auth('get:actors')
+    # This method is used to search actors by name
+    def search_actors(payload):
+        return search_collection('actors', Actor)
+
+    '''
+    export(name, model)
+        streams the whole collection as CSV or NDJSON for bulk exports
+    '''
+    def export(name, model):
+        accept_gzip = request.accept_encodings['gzip'] > 0
+        return export_collection(name, model, request.args, accept_gzip)
+
+    @app.route('/movies/export', methods=['GET'])
+    @requires_auth('export:movies')
+    # This method is used to export every movie as CSV or NDJSON
+    def export_movies(payload):
+        return export('movies', Movie)
+
+    @app.route('/actors/export', methods=['GET'])
+    @requires_auth('export:actors')
+    # This method is used to export every actor as CSV or NDJSON
+    def export_actors(payload):
+        return export('actors', Actor)
+
+    '''
+    changes(name, model)
+        answers the rows of the collection changed and the ids deleted
+        since the ?since= token, oldest first, with the token to send
+        next time; "more" tells the client to call again right away
+    '''
+    def changes(name, model):
+        since, limit, fields = get_changes_args(request.args, model)
+        try:
+            items, deleted, token, more = get_changes(
+                model, fields, limit, since)
+        except Exception as e:
+            print(e)
+            abort(500)
+        with timed('serialize'):
+            return jsonify(
+                    {
+                        "success": True,
+                        name: items,
+                        "deleted": deleted,
+                        "since": token,
+                        "more": more
+                    }
+            )
+
+    @app.route('/movies/changes', methods=['GET'])
+    @requires_auth('get:movies')
+    # This method is used to sync the movies changed since the last sync
+    def movie_changes(payload):
+        return changes('movies', Movie)
+
+    @app.route('/actors/changes', methods=['GET'])
+    @requires_auth('get:actors')
+    # This method is used to sync the actors changed since the last sync
+    def actor_changes(payload):
+        return changes('actors', Actor)
+
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
     # This method is used to post a movie to the system
@@ -154,6 +381,52 @@ def create_app(test_config=None):
         except Exception as e:
             print(e)
 
+    '''
+    create_in_bulk(model)
+        validates every row of the request body and inserts the valid ones
+        in one transaction. Unless ?partial=true is given, a single invalid
+        row rejects the whole request with 422 and the per row errors.
+    '''
+    def create_in_bulk(model):
+        rows = read_bulk_rows(request)
+        valid, errors = validate_rows(model, rows)
+        partial = request.args.get('partial') == 'true'
+
+        if errors and not partial:
+            return jsonify({
+                "success": False,
+                "error": 422,
+                "message": "unprocessable",
+                "errors": errors
+            }), 422
+
+        ids = []
+        if valid:
+            try:
+                ids = bulk_insert(model, [values for index, values in valid])
+            except Exception as e:
+                print(e)
+                abort(500)
+        return jsonify(
+            {
+                "success": True,
+                "ids": ids,
+                "errors": errors
+            }
+        )
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    # This method is used to post many movies in a single transaction
+    def post_movies_bulk(payload):
+        return create_in_bulk(Movie)
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    # This method is used to post many actors in a single transaction
+    def post_actors_bulk(payload):
+        return create_in_bulk(Actor)
+
     @app.route("/movies/<int:id>", methods=["PATCH"])
     @requires_auth('patch:movies')
     # This method is used to update an existing movie
@@ -161,22 +434,22 @@ def create_app(test_config=None):
         body = request.get_json()
         if body is None:
             abort(400)
+        values = read_values(body, Movie)
         try:
-            # fetch the corresponding row from the db according to the given id
-            movie = Movie.query.filter(Movie.id == id).one_or_none()
-            if movie is None:
+            # a single UPDATE ... WHERE id = :id returning the movie,
+            # instead of loading the row before changing it
+            if values:
+                rows = update_row(Movie, id, values, Movie.FIELDS)
+            else:
+                rows = db.session.execute(select_fields(
+                    Movie, Movie.FIELDS).where(Movie.id == id)).all()
+            if not rows:
                 abort(404)
 
-            if "name" in body:
-                movie.name = body.get("name")
-            if "genre" in body:
-                movie.genre = body.get("genre")
-
-            movie.update()
             return jsonify(
                 {
                     "success": True,
-                    "movie": [movie.format()]
+                    "movie": [row_to_dict(Movie.FIELDS, rows[0])]
                 }
             )
         except Exception as e:
@@ -190,14 +463,13 @@ def create_app(test_config=None):
     # def delete_movie(payload, id):
     def delete_movie(payload, id):
         try:
-            movie = Movie.query.filter(Movie.id == id).one_or_none()
-            if movie is None:
+            # a single DELETE ... WHERE id = :id
+            if not delete_row(Movie, id):
                 abort(404)
-            movie.delete()
             return jsonify(
                 {
                     "success": True,
-                    "deleted": movie.id
+                    "deleted": id
                 }
             )
         except Exception as e:
@@ -206,6 +478,152 @@ def create_app(test_config=None):
             else:
                 print(e)
 
+    '''
+    update_in_batch(model) / delete_in_batch(model)
+        update or delete every row matching the ids and / or the filter
+        of the request body with a single set based statement, in one
+        transaction, and answer the ids of the affected rows
+    '''
+    def update_in_batch(model):
+        body = request.get_json(silent=True)
+        criteria = read_batch_criteria(body, model)
+        values = read_values(body.get('values'), model)
+        if not values:
+            abort(400)
+        try:
+            ids = [row.id for row in update_rows(model, criteria, values)]
+        except Exception as e:
+            print(e)
+            abort(500)
+        return jsonify(
+            {
+                "success": True,
+                "updated": ids
+            }
+        )
+
+    def delete_in_batch(model):
+        criteria = read_batch_criteria(request.get_json(silent=True), model)
+        try:
+            ids = delete_rows(model, criteria)
+        except Exception as e:
+            print(e)
+            abort(500)
+        return jsonify(
+            {
+                "success": True,
+                "deleted": ids
+            }
+        )
+
+    @app.route('/movies', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    # This method is used to update many movies at once
+    def update_movies(payload):
+        return update_in_batch(Movie)
+
+    @app.route('/movies', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    # This method is used to delete many movies at once
+    def delete_movies(payload):
+        return delete_in_batch(Movie)
+
+    @app.route('/actors', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    # This method is used to update many actors at once
+    def update_actors(payload):
+        return update_in_batch(Actor)
+
+    @app.route('/actors', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    # This method is used to delete many actors at once
+    def delete_actors(payload):
+        return delete_in_batch(Actor)
+
+    '''
+    cast(movie_id, actor_id, casted)
+        adds (or removes) an actor to the cast of a movie, 404 when either
+        does not exist; both collections change since either can embed
+        the other
+    '''
+    def cast(movie_id, actor_id, casted):
+        if db.session.get(Movie, movie_id) is None or \
+                db.session.get(Actor, actor_id) is None:
+            abort(404)
+        try:
+            key = (movie_actors.c.movie_id == movie_id) & \
+                (movie_actors.c.actor_id == actor_id)
+            exists = db.session.execute(
+                movie_actors.select().where(key)).first() is not None
+            if casted and not exists:
+                db.session.execute(movie_actors.insert().values(
+                    movie_id=movie_id, actor_id=actor_id))
+            elif not casted and exists:
+                db.session.execute(movie_actors.delete().where(key))
+            else:
+                return jsonify({"success": True})
+            bump_version(Movie.__tablename__)
+            bump_version(Actor.__tablename__)
+            db.session.commit()
+            return jsonify({"success": True})
+        except Exception as e:
+            db.session.rollback()
+            print(e)
+            abort(500)
+
+    @app.route("/movies/<int:id>/actors/<int:actor_id>", methods=["PUT"])
+    @requires_auth('patch:movies')
+    # This method is used to cast an actor in a movie
+    def add_to_cast(payload, id, actor_id):
+        return cast(id, actor_id, True)
+
+    @app.route("/movies/<int:id>/actors/<int:actor_id>", methods=["DELETE"])
+    @requires_auth('patch:movies')
+    # This method is used to remove an actor from the cast of a movie
+    def remove_from_cast(payload, id, actor_id):
+        return cast(id, actor_id, False)
+
+    @app.route('/stats', methods=['GET'])
+    @requires_auth('get:stats')
+    # This method reports the catalog statistics kept by the database
+    def stats(payload):
+        etag = collection_etag('movies', 'actors')
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        response = jsonify(
+            {
+                "success": True,
+                "stats": get_stats()
+            }
+        )
+        response.set_etag(etag)
+        return response
+
+    @app.route('/internal/pool', methods=['GET'])
+    @requires_auth('get:internal')
+    # This method reports the connection pool state of this worker
+    def pool_status(payload):
+        return jsonify(
+            {
+                "success": True,
+                "pool": get_pool_status(db.engine),
+                "admission": {
+                    name: bulkhead.stats()
+                    for name, bulkhead in bulkheads.items()
+                },
+                "replicas": replica_set.status()
+            }
+        )
+
+    @app.route('/metrics', methods=['GET'])
+    # Prometheus scrape endpoint, aggregated over every worker
+    def metrics():
+        return Response(
+            render_prometheus(registry.collect()),
+            mimetype='text/plain; version=0.0.4')
+
     # Error Handling
     '''
     Example error handling for unprocessable entity
@@ -275,6 +693,17 @@ def create_app(test_config=None):
             "message": error.error['description']
         }), error.status_code
 
+    @app.errorhandler(Overloaded)
+    def overloaded(error):
+        response = jsonify({
+            "success": False,
+            "error": error.status_code,
+            "message": error.message
+        })
+        response.status_code = error.status_code
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
     return app
 
 
@@ -0,0 +1,425 @@
+"""ASGI entry point serving the movie and actor routes asynchronously.
+
+    uvicorn asgi:app
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+GET/POST /movies, GET/POST /actors and PATCH/DELETE /movies/<id> run as
+async handlers on an asyncio SQLAlchemy engine, so a worker keeps serving
+other requests while one waits on the database or on the JWKS. Every other
+route, and list requests using query parameters the async handlers do not
+know, are handed over to the Flask app so the API stays the same; they
+are handed over before authenticating, the Flask app verifies the token,
+charges the rate limit and admits the request itself. The async handlers
+go through the same read and write budgets and are reported in /metrics.
+"""
+import json
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import (
+    JSONResponse as StarletteJSONResponse,
+    Response,
+    StreamingResponse
+)
+from starlette.routing import Mount, Route
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from werkzeug.exceptions import HTTPException, BadRequest, abort
+from werkzeug.http import parse_etags, quote_etag
+
+from app import app as flask_app
+from auth import AuthError, requires_auth_async
+from admission import Overloaded, admitted_async
+from metrics import observed_async
+from replicas import start_primary_window
+from models import (
+    database_path,
+    Movie,
+    Actor,
+    CollectionVersion,
+    movie_actors
+)
+from dbpool import async_engine_options
+from pagination import (
+    get_page_args,
+    get_fields,
+    page_statement,
+    build_page,
+    list_statement
+)
+from filtering import get_filters, get_sort
+from streaming import STREAM_BATCH_SIZE
+from bulk import read_values
+from serialization import dumps, row_serializer
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite'
+}
+# query parameters understood by the async list handlers
+LIST_PARAMS = {'limit', 'after', 'fields', 'stream', 'sort'}
+
+ERROR_MESSAGES = {
+    400: 'bad request',
+    401: 'unauthorized',
+    403: 'forbidden',
+    404: 'resource not found',
+    405: 'method not allowed',
+    422: 'unprocessable',
+    500: 'internal server error'
+}
+
+
+'''
+async_database_url(path)
+    switches the database URL to the asyncio driver of its dialect
+'''
+
+
+def async_database_url(path):
+    scheme, rest = path.split('://', 1)
+    return '%s://%s' % (ASYNC_DRIVERS.get(scheme, scheme), rest)
+
+
+engine = create_async_engine(
+    async_database_url(database_path), **async_engine_options(database_path))
+Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+wsgi_app = WSGIMiddleware(flask_app)
+
+
+class JSONResponse(StarletteJSONResponse):
+    # the responses are encoded like the Flask app's (serialization.dumps)
+    def render(self, content):
+        return dumps(content)
+
+
+'''
+get_version(session, name) / bump_version(session, name)
+    the async counterparts of models.get_version and models.bump_version
+'''
+
+
+async def get_version(session, name):
+    table = CollectionVersion.__table__
+    result = await session.execute(
+        table.select().with_only_columns(table.c.version)
+        .where(table.c.name == name))
+    return result.scalar() or 0
+
+
+async def bump_version(session, name):
+    table = CollectionVersion.__table__
+    result = await session.execute(
+        table.update()
+        .where(table.c.name == name)
+        .values(version=table.c.version + 1))
+    if result.rowcount == 0:
+        await session.execute(table.insert().values(name=name, version=1))
+
+
+'''
+written(content)
+    the JSON response of a successful write, which starts the client's
+    primary window like the writes of the Flask app (the reads handed
+    over to it may go to a replica)
+'''
+
+
+def written(content):
+    response = JSONResponse(content)
+    start_primary_window(response)
+    return response
+
+
+'''
+get_json(request)
+    returns the decoded JSON body like Flask's request.get_json(): None
+    when the body is not JSON, 400 when it cannot be decoded
+'''
+
+
+async def get_json(request):
+    if request.headers.get('content-type', '').split(';')[0] != \
+            'application/json':
+        return None
+    try:
+        return json.loads(await request.body())
+    except ValueError:
+        raise BadRequest()
+
+
+'''
+handed_over(request, model)
+    whether a list request uses query parameters the async handlers do not
+    know, and is served by the Flask app instead
+
+list_collection(request, name, model)
+    the async GET /movies and GET /actors: keyset pages, sparse fieldsets,
+    filters and sorts, streaming and conditional GET, as served by the
+    Flask app
+'''
+
+
+def handed_over(request, model):
+    return bool(set(request.query_params) - LIST_PARAMS - set(model.FILTERS))
+
+
+async def list_collection(request, name, model):
+    args = request.query_params
+    fields = get_fields(args, model)
+    filters = get_filters(args, model)
+    sort = get_sort(args, model)
+    stream = args.get('stream') == 'true'
+    if not stream:
+        limit, after = get_page_args(args, model, sort)
+
+    session = Session()
+    try:
+        etag = '%s-%d' % (name, await get_version(session, name))
+        headers = {'ETag': quote_etag(etag)}
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and parse_etags(if_none_match).contains(etag):
+            return Response(status_code=304, headers=headers)
+
+        if stream:
+            response = await stream_collection(
+                session, name, model, fields, filters, sort)
+            # the streaming response closes the session when it is done
+            session = None
+            response.headers.update(headers)
+            return response
+
+        result = await session.execute(page_statement(
+            model, fields, limit, after, filters, sort, engine.dialect))
+        items, next_cursor = build_page(fields, result.all(), limit, sort)
+    finally:
+        if session is not None:
+            await session.close()
+
+    # only the first page is expected to be non empty
+    if len(items) == 0 and after is None:
+        abort(404)
+    return JSONResponse(
+        {
+            "success": True,
+            name: items,
+            "next": next_cursor
+        },
+        headers=headers)
+
+
+async def stream_collection(session, name, model, fields, filters, sort):
+    statement = list_statement(model, fields, filters, sort)
+    result = await session.stream(
+        statement.execution_options(stream_results=True))
+    batches = result.partitions(STREAM_BATCH_SIZE)
+    # peek at the first batch so an empty collection still answers 404
+    try:
+        first = await batches.__anext__()
+    except StopAsyncIteration:
+        first = None
+    if not first:
+        await session.close()
+        abort(404)
+
+    serialize = row_serializer(tuple(fields))
+
+    async def generate():
+        try:
+            yield b'{"success":true,"%s":[' % name.encode()
+            yield b','.join(dumps(serialize(row)) for row in first)
+            async for batch in batches:
+                yield b',' + b','.join(dumps(serialize(row)) for row in batch)
+            yield b']}'
+        finally:
+            await session.close()
+
+    return StreamingResponse(generate(), media_type='application/json')
+
+
+@observed_async('/movies')
+async def get_movies(request):
+    if handed_over(request, Movie):
+        return wsgi_app
+    return await list_movies(request)
+
+
+@admitted_async
+@requires_auth_async('get:movies')
+async def list_movies(payload, request):
+    return await list_collection(request, 'movies', Movie)
+
+
+@observed_async('/actors')
+async def get_actors(request):
+    if handed_over(request, Actor):
+        return wsgi_app
+    return await list_actors(request)
+
+
+@admitted_async
+@requires_auth_async('get:actors')
+async def list_actors(payload, request):
+    return await list_collection(request, 'actors', Actor)
+
+
+@observed_async('/movies')
+@admitted_async
+@requires_auth_async('post:movies')
+async def post_movies(payload, request):
+    body = await get_json(request)
+    if not isinstance(body, dict):
+        abort(400)
+    if body.get("name") is None:
+        abort(422)
+
+    movie = Movie(name=body.get("name"), genre=body.get("genre"))
+    async with Session() as session:
+        session.add(movie)
+        await bump_version(session, Movie.__tablename__)
+        await session.commit()
+    return written({"success": True, "movie": [movie.format()]})
+
+
+@observed_async('/actors')
+@admitted_async
+@requires_auth_async('post:actors')
+async def post_actors(payload, request):
+    body = await get_json(request)
+    if not isinstance(body, dict):
+        abort(400)
+    if body.get("name") is None:
+        abort(422)
+
+    age = body.get("age")
+    # asyncpg does not cast strings like psycopg2 does
+    if isinstance(age, str):
+        try:
+            age = int(age)
+        except ValueError:
+            abort(422)
+
+    actor = Actor(
+        name=body.get("name"),
+        experience_level=body.get("experience_level"),
+        gender=body.get("gender"),
+        age=age)
+    async with Session() as session:
+        session.add(actor)
+        await bump_version(session, Actor.__tablename__)
+        await session.commit()
+    return written({"success": True, "actor": [actor.format()]})
+
+
+@observed_async('/movies/<int:id>')
+@admitted_async
+@requires_auth_async('patch:movies')
+async def update_movie(payload, request):
+    body = await get_json(request)
+    if body is None:
+        abort(400)
+    values = read_values(body, Movie)
+
+    table = Movie.__table__
+    key = table.c.id == request.path_params['id']
+    columns = [table.c[field] for field in Movie.FIELDS]
+    async with Session() as session:
+        # a single UPDATE ... WHERE id = :id returning the movie
+        if values and engine.dialect.full_returning:
+            result = await session.execute(
+                table.update().where(key).values(**values)
+                .returning(*columns))
+        else:
+            if values:
+                await session.execute(
+                    table.update().where(key).values(**values))
+            result = await session.execute(select(*columns).where(key))
+        row = result.first()
+        if row is None:
+            abort(404)
+        if values:
+            await bump_version(session, Movie.__tablename__)
+            await session.commit()
+    return written(
+        {"success": True, "movie": [row_serializer(Movie.FIELDS)(row)]})
+
+
+@observed_async('/movies/<int:id>')
+@admitted_async
+@requires_auth_async('delete:movies')
+async def delete_movie(payload, request):
+    id = request.path_params['id']
+    table = Movie.__table__
+    async with Session() as session:
+        # a single DELETE ... WHERE id = :id, the cast goes first
+        cast = await session.execute(
+            movie_actors.delete().where(movie_actors.c.movie_id == id))
+        result = await session.execute(table.delete().where(table.c.id == id))
+        if result.rowcount == 0:
+            abort(404)
+        if cast.rowcount:
+            # the actors embedding this movie change too
+            await bump_version(session, Actor.__tablename__)
+        await bump_version(session, Movie.__tablename__)
+        await session.commit()
+    return written({"success": True, "deleted": id})
+
+
+async def http_error(request, error):
+    status = error.code if error.code in ERROR_MESSAGES else 500
+    return JSONResponse({
+        "success": False,
+        "error": status,
+        "message": ERROR_MESSAGES[status]
+    }, status_code=status)
+
+
+async def auth_error(request, error):
+    return JSONResponse({
+        "success": False,
+        "error": error.status_code,
+        "message": error.error['description']
+    }, status_code=error.status_code)
+
+
+async def overloaded(request, error):
+    return JSONResponse({
+        "success": False,
+        "error": error.status_code,
+        "message": error.message
+    }, status_code=error.status_code,
+        headers={'Retry-After': str(error.retry_after)})
+
+
+async def shutdown():
+    await engine.dispose()
+
+
+app = Starlette(
+    routes=[
+        Route('/movies', get_movies, methods=['GET']),
+        Route('/movies', post_movies, methods=['POST']),
+        Route('/actors', get_actors, methods=['GET']),
+        Route('/actors', post_actors, methods=['POST']),
+        Route('/movies/{id:int}', update_movie, methods=['PATCH']),
+        Route('/movies/{id:int}', delete_movie, methods=['DELETE']),
+        # everything else is served by the Flask app
+        Mount('/', app=wsgi_app)
+    ],
+    middleware=[
+        # the CORS headers the Flask app sends
+        Middleware(
+            CORSMiddleware,
+            allow_origins=['*'],
+            allow_headers=['Content-Type', 'Authorization', 'true'],
+            allow_methods=['GET', 'PUT', 'PATCH', 'POST', 'DELETE'])
+    ],
+    exception_handlers={
+        HTTPException: http_error,
+        AuthError: auth_error,
+        Overloaded: overloaded
+    },
+    on_shutdown=[shutdown])
@@ -1,14 +1,51 @@
 import os
+import re
 import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
+from jose import jwt, jwk
+from jose.utils import base64url_decode
 from urllib.request import urlopen
 
+from metrics import timed, registry
+from admission import check_rate_limit
+
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = os.environ.get('ALGORITHMS')
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
 
+# seconds to keep the JWKS when Auth0 does not send a Cache-Control max-age
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 600))
+# minimum seconds between two refetches triggered by an unknown kid
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+# optional local JWKS file used instead of Auth0 (offline testing)
+JWKS_FILE = os.environ.get('JWKS_FILE')
+# maximum number of verified tokens kept by requires_auth
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_ENABLED = os.environ.get(
+    'TOKEN_CACHE_ENABLED', 'true').lower() == 'true'
+
+
+'''
+parse_algorithms(value)
+    the list of the algorithm names of the ALGORITHMS setting, written
+    as RS256, RS256,RS384 or ['RS256'] (setup.sh); the header of a token
+    must name one of them exactly
+'''
+
+
+def parse_algorithms(value):
+    return re.findall(r'\w+', value or '')
+
+
+ALGORITHMS = parse_algorithms(ALGORITHMS)
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -22,13 +59,219 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS Key Store
+'''
+JWKS fetchers
+    a fetcher is a callable returning (jwks, max_age) where jwks is the
+    decoded JWK Set and max_age the number of seconds it may be cached
+    (None to fall back to JWKS_TTL)
+'''
+
+_MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+
+def url_jwks_fetcher(url=None, timeout=5):
+    def fetch():
+        jwks_url = url or f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+        response = urlopen(jwks_url, timeout=timeout)
+        jwks = json.loads(response.read())
+        cache_control = response.headers.get('Cache-Control') or ''
+        if 'no-store' in cache_control or 'no-cache' in cache_control:
+            return jwks, 0
+        max_age = _MAX_AGE_RE.search(cache_control)
+        return jwks, int(max_age.group(1)) if max_age else None
+
+    return fetch
+
+
+def file_jwks_fetcher(path):
+    def fetch():
+        with open(path) as jwks_file:
+            return json.load(jwks_file), None
+
+    return fetch
+
+
+class JWKSStore:
+    """Process-wide cache of the parsed JWKS signing keys, indexed by kid.
+
+    Keys are served until their TTL expires; after that the stale keys keep
+    being served while a background thread refetches the set. An unknown
+    kid triggers an immediate refetch, at most once every
+    min_refresh_interval seconds.
+    """
+
+    def __init__(self, fetcher, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.keys = {}
+        self.expires_at = 0
+        self.last_fetch = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get_key(self, kid):
+        if not self.keys:
+            self.refresh()
+        elif time.monotonic() >= self.expires_at and self._may_refetch():
+            self._refresh_in_background()
+
+        key = self.keys.get(kid)
+        if key is None and self._may_refetch():
+            self.refresh()
+            key = self.keys.get(kid)
+        return key
+
+    def refresh(self):
+        with self._lock:
+            self.last_fetch = time.monotonic()
+            try:
+                jwks, max_age = self.fetcher()
+            except Exception:
+                registry.inc('jwks_refresh_failures_total')
+                if not self.keys:
+                    raise AuthError({
+                        'code': 'jwks_unavailable',
+                        'description': 'Unable to fetch signing keys.'
+                    }, 503)
+                return
+
+            keys = {}
+            for key in jwks.get('keys', []):
+                if key.get('kty') != 'RSA' or 'kid' not in key:
+                    continue
+                keys[key['kid']] = jwk.construct(key, key.get('alg', 'RS256'))
+            self.keys = keys
+            ttl = self.ttl if max_age is None else max_age
+            self.expires_at = self.last_fetch + ttl
+
+    def clear(self):
+        with self._lock:
+            self.keys = {}
+            self.expires_at = 0
+            self.last_fetch = None
+
+    def _may_refetch(self):
+        return (self.last_fetch is None or
+                time.monotonic() - self.last_fetch >=
+                self.min_refresh_interval)
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except AuthError:
+                pass
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+jwks_store = JWKSStore(
+    file_jwks_fetcher(JWKS_FILE) if JWKS_FILE else url_jwks_fetcher())
+
+
+# Verified Token Cache
+
+
+class TokenCache:
+    """Bounded LRU cache of verified JWT payloads.
+
+    Entries are keyed by the SHA-256 of the raw token so bearer tokens are
+    never kept in memory, and each entry expires at the token's exp claim.
+    Hits, misses and evictions are also counted in GET /metrics.
+    """
+
+    def __init__(self, max_size=TOKEN_CACHE_SIZE,
+                 enabled=TOKEN_CACHE_ENABLED):
+        self.max_size = max_size
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        if not self.enabled:
+            return None
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                registry.inc('token_cache_misses_total')
+                return None
+            expires_at, payload = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                registry.inc('token_cache_misses_total')
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            registry.inc('token_cache_hits_total')
+            return payload
+
+    def set(self, token, payload):
+        if not self.enabled or self.max_size <= 0:
+            return
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (expires_at, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+                registry.inc('token_cache_evictions_total')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+token_cache = TokenCache()
+
+
 # Auth Header
 
 
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
     """
-    auth = request.headers.get('Authorization', None)
+    return get_token_from_header(request.headers.get('Authorization', None))
+
+
+def get_token_from_header(auth):
+    """Obtains the Access Token from an Authorization Header value
+    """
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -73,33 +316,31 @@ def check_permissions(permissions, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:
         try:
+            if unverified_header.get('alg') not in ALGORITHMS:
+                raise jwt.JWTError('The specified alg value is not allowed')
+            # verify the signature with the cached key object so the JWK
+            # is not parsed again, then let jose validate the claims
+            signing_input, signature = token.encode('utf-8').rsplit(b'.', 1)
+            if not rsa_key.verify(signing_input, base64url_decode(signature)):
+                raise jwt.JWTError('Signature verification failed.')
+
             payload = jwt.decode(
                 token,
-                rsa_key,
+                None,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer='https://' + AUTH0_DOMAIN + '/',
+                options={'verify_signature': False}
             )
 
             return payload
@@ -130,10 +371,45 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            with timed('auth'):
+                token = get_token_auth_header()
+                payload = token_cache.get(token)
+            if payload is None:
+                with timed('jwt'):
+                    payload = verify_decode_jwt(token)
+                token_cache.set(token, payload)
             check_permissions(permission, payload)
+            check_rate_limit(payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
+
+
+'''
+requires_auth_async(permission)
+    the requires_auth decorator for the async (ASGI) handlers, which
+    receive the request as their first argument
+    verification happens in a worker thread so a JWKS fetch never blocks
+    the event loop
+'''
+
+
+def requires_auth_async(permission=''):
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(request, *args, **kwargs):
+            token = get_token_from_header(
+                request.headers.get('Authorization', None))
+            payload = token_cache.get(token)
+            if payload is None:
+                loop = asyncio.get_running_loop()
+                payload = await loop.run_in_executor(
+                    None, verify_decode_jwt, token)
+                token_cache.set(token, payload)
+            check_permissions(permission, payload)
+            check_rate_limit(payload)
+            return await f(payload, request, *args, **kwargs)
+
+        return wrapper
+    return requires_auth_decorator
@@ -0,0 +1,208 @@
+"""Load test every API route against a generated catalog.
+
+Runs create_app() in process against SQLite (default) or a local Postgres,
+authenticating with a locally generated RSA key served through JWKS_FILE.
+Each route is driven at a fixed concurrency and the throughput, p50/p99
+latency and peak RSS are saved as JSON.
+
+    python -m benchmarks.api --sizes 1000,100000 --output bench.json
+    python -m benchmarks.api --baseline bench.json --tolerance 0.2
+
+With --baseline the run exits with status 1 when an endpoint regressed.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+
+from benchmarks.common import (
+    setup_environment,
+    seed_catalog,
+    run_load,
+    find_regressions
+)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--database', help='database URL (default: a temporary SQLite file)')
+    parser.add_argument(
+        '--sizes', default='1000',
+        help='comma separated catalog sizes, e.g. 1000,100000,1000000')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests sent to each endpoint')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--stream-requests', type=int, default=5,
+                        help='requests sent to the streaming endpoints')
+    parser.add_argument('--output', help='file the JSON results are saved to')
+    parser.add_argument('--baseline', help='previous results to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed regression as a fraction (0.2 = 20%%)')
+    return parser.parse_args(argv)
+
+
+'''
+build_scenarios(client, headers, rows)
+    returns (name, requests, send) tuples covering every route
+'''
+
+
+def build_scenarios(client, headers, rows, args):
+    from changes import DELETED, encode_token
+
+    # a client that synced a moment ago, before the write scenarios
+    up_to_date = encode_token((datetime.utcnow(), DELETED, 0))
+
+    def get(url):
+        return lambda i: client.get(url, headers=headers).status_code
+
+    def post(url, body):
+        return lambda i: client.post(
+            url, json=body, headers=headers).status_code
+
+    def first_half(i):
+        # the ids the delete scenarios do not reach
+        return i % max(1, rows // 2) + 1
+
+    def get_movie(i):
+        return client.get(
+            '/movies/%d?include=actors' % first_half(i),
+            headers=headers).status_code
+
+    def get_actor(i):
+        return client.get(
+            '/actors/%d' % first_half(i), headers=headers).status_code
+
+    def cast(method):
+        def send(i):
+            return client.open(
+                '/movies/%d/actors/%d' % (first_half(i), first_half(i)),
+                method=method, headers=headers).status_code
+        return send
+
+    def patch_movie(i):
+        return client.patch(
+            '/movies/%d' % (i % rows + 1), json={'genre': 'drama'},
+            headers=headers).status_code
+
+    def delete_movie(i):
+        # delete from the end of the catalog so other scenarios keep rows
+        return client.delete(
+            '/movies/%d' % (rows - i), headers=headers).status_code
+
+    def patch_movies(i):
+        ids = [first_half(i + step) for step in range(10)]
+        return client.patch(
+            '/movies', json={'ids': ids, 'values': {'genre': 'drama'}},
+            headers=headers).status_code
+
+    def delete_actors(i):
+        return client.delete(
+            '/actors', json={'ids': [rows - i]}, headers=headers).status_code
+
+    bulk = [{'name': 'bulk movie %d' % i, 'genre': 'comedy'}
+            for i in range(100)]
+    bulk_actors = [{'name': 'bulk actor %d' % i, 'age': 30}
+                   for i in range(100)]
+    return [
+        ('GET /', args.requests, get('/')),
+        ('GET /movies', args.requests, get('/movies')),
+        ('GET /movies?fields=id,name', args.requests,
+         get('/movies?fields=id,name')),
+        ('GET /movies?stream=true', args.stream_requests,
+         get('/movies?stream=true')),
+        ('GET /actors', args.requests, get('/actors')),
+        ('GET /actors?stream=true', args.stream_requests,
+         get('/actors?stream=true')),
+        ('GET /movies/<id>?include=actors', args.requests, get_movie),
+        ('GET /actors/<id>', args.requests, get_actor),
+        ('GET /movies/export?format=ndjson', args.stream_requests,
+         get('/movies/export?format=ndjson')),
+        ('GET /actors/export?format=csv', args.stream_requests,
+         get('/actors/export?format=csv')),
+        ('GET /movies/changes', args.requests, get('/movies/changes')),
+        ('GET /movies/changes?since=<now>', args.requests,
+         get('/movies/changes?since=' + up_to_date)),
+        ('GET /actors/changes?since=<now>', args.requests,
+         get('/actors/changes?since=' + up_to_date)),
+        ('GET /movies/search', args.requests, get('/movies/search?q=movie')),
+        ('GET /actors/search', args.requests, get('/actors/search?q=actor')),
+        ('POST /movies', args.requests,
+         post('/movies', {'name': 'bench movie', 'genre': 'comedy'})),
+        ('POST /actors', args.requests,
+         post('/actors', {'name': 'bench actor', 'age': 30})),
+        ('POST /movies/bulk', max(1, args.requests // 10),
+         post('/movies/bulk', bulk)),
+        ('POST /actors/bulk', max(1, args.requests // 10),
+         post('/actors/bulk', bulk_actors)),
+        ('PATCH /movies/<id>', args.requests, patch_movie),
+        ('PUT /movies/<id>/actors/<id>', args.requests, cast('PUT')),
+        ('DELETE /movies/<id>/actors/<id>', args.requests, cast('DELETE')),
+        ('DELETE /movies/<id>', min(args.requests, rows), delete_movie),
+        ('PATCH /movies', args.requests, patch_movies),
+        ('DELETE /actors', min(args.requests, rows), delete_actors),
+        ('GET /stats', args.requests, get('/stats')),
+        ('GET /internal/pool', args.requests, get('/internal/pool')),
+        ('GET /metrics', args.requests, get('/metrics'))
+    ]
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='cinema-bench-')
+    database = args.database or 'sqlite:///%s' % os.path.join(
+        workdir, 'bench.db')
+    sign_token = setup_environment(database, workdir)
+
+    # the application reads its configuration at import time
+    from app import create_app
+
+    app = create_app()
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + sign_token()}
+
+    results = {
+        'meta': {
+            'database': database.split(':')[0],
+            'concurrency': args.concurrency,
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'results': {}
+    }
+    for rows in [int(size) for size in args.sizes.split(',')]:
+        with app.app_context():
+            seed_catalog(rows)
+        endpoints = results['results'][str(rows)] = {}
+        for name, requests, send in build_scenarios(
+                client, headers, rows, args):
+            endpoints[name] = stats = run_load(
+                send, requests, args.concurrency)
+            print('%8d rows  %-32s %8.1f req/s  p50 %7.2f ms  '
+                  'p99 %7.2f ms  rss %6.1f MB  errors %d' % (
+                      rows, name, stats['throughput'], stats['p50_ms'],
+                      stats['p99_ms'], stats['peak_rss_mb'],
+                      stats['errors']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = find_regressions(
+                results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
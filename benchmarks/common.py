@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import resource
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Helpers shared by the benchmark scripts. Nothing in here imports the
+application: the environment has to be configured with
+setup_environment() before app, auth or models are imported.
+'''
+
+BENCH_AUDIENCE = 'bench'
+BENCH_DOMAIN = 'bench.local'
+BENCH_KID = 'bench-key'
+
+ALL_PERMISSIONS = [
+    'get:movies', 'get:actors', 'post:movies', 'post:actors',
+    'patch:movies', 'delete:movies', 'patch:actors', 'delete:actors',
+    'get:stats', 'get:internal', 'export:movies', 'export:actors']
+
+
+'''
+setup_environment(database_url, workdir)
+    points the application at the database and at a local JWKS file
+    holding a freshly generated RSA key, so no Auth0 tenant is needed
+    returns a function signing bearer tokens with that key
+'''
+
+
+def setup_environment(database_url, workdir):
+    from Crypto.PublicKey import RSA
+    from jose import jwt, jwk
+
+    key = RSA.generate(2048)
+    private_key = key.export_key().decode()
+    public_jwk = jwk.construct(
+        key.publickey().export_key().decode(), 'RS256').to_dict()
+    public_jwk.update({'kid': BENCH_KID, 'use': 'sig'})
+    jwks_path = os.path.join(workdir, 'jwks.json')
+    with open(jwks_path, 'w') as jwks_file:
+        json.dump({'keys': [public_jwk]}, jwks_file)
+
+    os.environ.update({
+        'DATABASE_URL': database_url,
+        'AUTH0_DOMAIN': BENCH_DOMAIN,
+        'API_AUDIENCE': BENCH_AUDIENCE,
+        'ALGORITHMS': 'RS256',
+        'JWKS_FILE': jwks_path
+    })
+
+    def sign_token(permissions=ALL_PERMISSIONS, subject='bench', ttl=3600):
+        claims = {
+            'iss': 'https://%s/' % BENCH_DOMAIN,
+            'aud': BENCH_AUDIENCE,
+            'sub': subject,
+            'exp': int(time.time()) + ttl,
+            'permissions': permissions
+        }
+        return jwt.encode(
+            claims, private_key, algorithm='RS256',
+            headers={'kid': BENCH_KID})
+
+    return sign_token
+
+
+'''
+seed_catalog(rows)
+    recreates the tables and fills them with rows generated movies and
+    actors, inserted with executemany batches
+'''
+
+GENRES = ('comedy', 'drama', 'action', 'horror', 'romance', 'documentary')
+GENDERS = ('female', 'male', 'non-binary')
+
+
+def seed_catalog(rows, batch_size=10000):
+    from models import db, Movie, Actor
+
+    db.drop_all()
+    db.create_all()
+    for start in range(0, rows, batch_size):
+        stop = min(start + batch_size, rows)
+        db.session.execute(Movie.__table__.insert(), [
+            {'name': 'movie %d' % i, 'genre': GENRES[i % len(GENRES)]}
+            for i in range(start, stop)])
+        db.session.execute(Actor.__table__.insert(), [
+            {'name': 'actor %d' % i,
+             'experience_level': str(i % 10),
+             'gender': GENDERS[i % len(GENDERS)],
+             'age': 18 + i % 60}
+            for i in range(start, stop)])
+        db.session.commit()
+
+
+'''
+current_rss()
+    returns the resident set size of this process in bytes
+'''
+
+
+def current_rss():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is the peak (kilobytes on Linux), the best we can do
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RSSSampler:
+    """Samples the process RSS in the background and keeps the peak"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+
+'''
+percentile(values, fraction)
+    nearest-rank percentile of an already sorted list
+'''
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    rank = int(round(fraction * len(values)))
+    return values[min(len(values) - 1, max(0, rank - 1))]
+
+
+'''
+run_load(send, requests, concurrency)
+    calls send(i) for i in range(requests) from concurrency threads and
+    returns throughput, latency percentiles, error count and peak RSS
+    send must return the HTTP status code of the response
+'''
+
+
+def run_load(send, requests, concurrency):
+    latencies = []
+    errors = []
+
+    def timed_send(i):
+        start = time.perf_counter()
+        status = send(i)
+        latencies.append(time.perf_counter() - start)
+        if status >= 400:
+            errors.append(status)
+
+    with RSSSampler() as sampler:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed_send, range(requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': len(errors),
+        'throughput': requests / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_rss_mb': sampler.peak / (1024 * 1024)
+    }
+
+
+'''
+find_regressions(results, baseline, tolerance)
+    compares two result files and lists every endpoint whose throughput
+    dropped or p99 latency grew by more than tolerance (a fraction)
+'''
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for size, endpoints in results['results'].items():
+        for name, current in endpoints.items():
+            previous = baseline.get('results', {}).get(size, {}).get(name)
+            if previous is None:
+                continue
+            if current['throughput'] < previous['throughput'] * (
+                    1 - tolerance):
+                regressions.append('%s %s: throughput %.1f < %.1f req/s' % (
+                    size, name, current['throughput'],
+                    previous['throughput']))
+            if current['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+                regressions.append('%s %s: p99 %.2f > %.2f ms' % (
+                    size, name, current['p99_ms'], previous['p99_ms']))
+    return regressions
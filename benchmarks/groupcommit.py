@@ -0,0 +1,97 @@
+"""Compare per-row commits with group commits of single row inserts.
+
+Inserts movies with Movie.insert() from concurrent threads, as the
+threads of a worker do under POST /movies, once committing every row on
+its own and once per group commit window. Reports the throughput, the
+p50/p99 latency of an insert and the number of commits.
+
+    python -m benchmarks.groupcommit --windows 1,2,5 --concurrency 16
+    python -m benchmarks.groupcommit --database postgresql://... --windows 2
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+
+from benchmarks.common import setup_environment, run_load
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--database', help='database URL (default: a temporary SQLite file)')
+    parser.add_argument('--windows', default='1,2,5',
+                        help='comma separated group commit windows (ms)')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='rows inserted in each mode')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--output', help='file the JSON results are saved to')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='cinema-bench-')
+    database = args.database or 'sqlite:///%s' % os.path.join(
+        workdir, 'bench.db')
+    setup_environment(database, workdir)
+
+    # the application reads its configuration at import time
+    from sqlalchemy import event
+    from app import app
+    from models import db, Movie, group_committer
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        engine = db.engine
+    commits = []
+    event.listen(engine, 'commit', lambda connection: commits.append(1))
+
+    def insert(i):
+        with app.app_context():
+            try:
+                Movie(name='movie %d' % i, genre='drama').insert()
+            except Exception as e:
+                print(e)
+                return 500
+        return 200
+
+    modes = [('per-row', None)] + [
+        ('group %sms' % window, float(window))
+        for window in args.windows.split(',')]
+    results = {
+        'meta': {
+            'database': database.split(':')[0],
+            'concurrency': args.concurrency,
+            'max_batch': args.max_batch,
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'results': {}
+    }
+    for name, window in modes:
+        group_committer.enabled = window is not None
+        group_committer.window = window or 0
+        group_committer.max_batch = args.max_batch
+        del commits[:]
+        stats = results['results'][name] = run_load(
+            insert, args.requests, args.concurrency)
+        stats['commits'] = len(commits)
+        print('%-12s %8.1f rows/s  p50 %7.2f ms  p99 %7.2f ms  '
+              'commits %6d  errors %d' % (
+                  name, stats['throughput'], stats['p50_ms'],
+                  stats['p99_ms'], stats['commits'], stats['errors']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
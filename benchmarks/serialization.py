@@ -0,0 +1,121 @@
+"""Microbenchmark of the JSON encoding of movie and actor lists.
+
+Builds generated rows in memory (no database), turns them into response
+dicts with the precompiled row serializers and encodes the lists with
+every available encoder, printing the encode throughput in rows/s and
+MB/s.
+
+    python -m benchmarks.serialization --sizes 10000,1000000
+    python -m benchmarks.serialization --output serialization.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+
+from benchmarks.common import GENRES, GENDERS
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', default='10000,1000000',
+        help='comma separated list sizes, e.g. 10000,1000000')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each encoder, the best one is kept')
+    parser.add_argument('--output', help='file the JSON results are saved to')
+    return parser.parse_args(argv)
+
+
+'''
+generate_rows(model, rows)
+    returns rows tuples in the order of the model's FIELDS, like the ones
+    select_fields() fetches
+'''
+
+
+def generate_rows(model, rows):
+    if model.__tablename__ == 'movies':
+        return [(i, 'movie %d' % i, GENRES[i % len(GENRES)])
+                for i in range(rows)]
+    return [(i, 'actor %d' % i, str(i % 10), GENDERS[i % len(GENDERS)],
+             18 + i % 60) for i in range(rows)]
+
+
+'''
+best_time(function, repeat)
+    calls function repeat times, returns its last result and the shortest
+    duration in seconds
+'''
+
+
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # the models only need a database URL to be imported
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    from models import Movie, Actor
+    from serialization import ENCODERS, row_serializer
+
+    encoders = {'json': ENCODERS['json'],
+                'json (sorted keys)': lambda value: ENCODERS['json'](
+                    value, sort_keys=True)}
+    if 'orjson' in ENCODERS:
+        encoders['orjson'] = ENCODERS['orjson']
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'repeat': args.repeat,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'results': {}
+    }
+    for rows in [int(size) for size in args.sizes.split(',')]:
+        sizes = results['results'][str(rows)] = {}
+        for model in (Movie, Actor):
+            name = model.__tablename__
+            serialize = row_serializer(model.FIELDS)
+            data = generate_rows(model, rows)
+            items, elapsed = best_time(
+                lambda: [serialize(row) for row in data], args.repeat)
+            cases = sizes[name] = {
+                'build': {'seconds': elapsed,
+                          'rows_per_s': rows / elapsed if elapsed else 0.0}}
+            print('%8d %-7s %-20s %12.0f rows/s' % (
+                rows, name, 'build dicts', cases['build']['rows_per_s']))
+
+            document = {'success': True, name: items}
+            for encoder, dumps in encoders.items():
+                body, elapsed = best_time(
+                    lambda: dumps(document), args.repeat)
+                cases[encoder] = {
+                    'seconds': elapsed,
+                    'bytes': len(body),
+                    'rows_per_s': rows / elapsed if elapsed else 0.0,
+                    'mb_per_s': len(body) / elapsed / (1024 * 1024)
+                    if elapsed else 0.0
+                }
+                print('%8d %-7s %-20s %12.0f rows/s %9.1f MB/s' % (
+                    rows, name, encoder, cases[encoder]['rows_per_s'],
+                    cases[encoder]['mb_per_s']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""Compare the gunicorn worker modes of gunicorn.conf.py over HTTP.
+
+Starts gunicorn once per mode (sync, gthread, gevent when it is installed)
+against the same generated catalog, waits for the workers to be ready and
+drives GET /movies and POST /movies over real sockets. Reports the time
+to the first response, the throughput, p50/p99 latency and the memory of
+the master and its workers (PSS, so the pages shared copy-on-write by
+the preloaded app are only counted once).
+
+    python -m benchmarks.server --modes sync,gthread,gevent --workers 4
+    python -m benchmarks.server --database postgresql://... --rows 100000
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import importlib.util
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from benchmarks.common import setup_environment, seed_catalog, run_load
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--database', help='database URL (default: a temporary SQLite file)')
+    parser.add_argument('--modes', default='sync,gthread,gevent',
+                        help='comma separated worker classes')
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='movies and actors in the catalog')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads of the gthread workers')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests sent to each endpoint')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--preload', default='true', choices=('true', 'false'))
+    parser.add_argument('--output', help='file the JSON results are saved to')
+    return parser.parse_args(argv)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+'''
+send(url, headers, body)
+    sends one request and returns its status code, 599 when the server
+    could not be reached
+'''
+
+
+def send(url, headers, body=None):
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode('utf-8')
+        headers = dict(headers, **{'Content-Type': 'application/json'})
+    try:
+        with urlopen(Request(url, data=data, headers=headers),
+                     timeout=30) as response:
+            response.read()
+            return response.status
+    except HTTPError as e:
+        return e.code
+    except (URLError, OSError):
+        return 599
+
+
+'''
+process_memory(pid)
+    returns the PSS of a process and of its children in bytes (the RSS
+    where /proc/<pid>/smaps_rollup is not available)
+'''
+
+
+def process_memory(pid):
+    total = 0
+    pids = [pid]
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as children:
+            pids += [int(child) for child in children.read().split()]
+    except OSError:
+        return 0
+    for process in pids:
+        for path, field in (('/proc/%d/smaps_rollup' % process, 'Pss:'),
+                            ('/proc/%d/status' % process, 'VmRSS:')):
+            try:
+                with open(path) as status:
+                    for line in status:
+                        if line.startswith(field):
+                            total += int(line.split()[1]) * 1024
+                            break
+                break
+            except OSError:
+                continue
+    return total
+
+
+'''
+run_mode(mode, args, headers)
+    starts gunicorn with a worker mode, loads it and stops it
+'''
+
+
+def run_mode(mode, args, headers):
+    port = free_port()
+    base_url = 'http://127.0.0.1:%d' % port
+    env = dict(os.environ,
+               WEB_WORKER_CLASS=mode,
+               WEB_CONCURRENCY=str(args.workers),
+               WEB_THREADS=str(args.threads),
+               WEB_PRELOAD=args.preload)
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', '127.0.0.1:%d' % port,
+         'app:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        while send(base_url + '/', headers) != 200:
+            if server.poll() is not None or \
+                    time.perf_counter() - start > 60:
+                raise RuntimeError('gunicorn %s did not start' % mode)
+            time.sleep(0.05)
+        results = {'ready_s': time.perf_counter() - start}
+        results['GET /movies'] = run_load(
+            lambda i: send(base_url + '/movies?limit=100', headers),
+            args.requests, args.concurrency)
+        results['POST /movies'] = run_load(
+            lambda i: send(base_url + '/movies', headers,
+                           {'name': 'bench %s %d' % (mode, i),
+                            'genre': 'drama'}),
+            args.requests, args.concurrency)
+        results['memory_mb'] = process_memory(server.pid) / (1024 * 1024)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='cinema-bench-')
+    database = args.database or 'sqlite:///%s' % os.path.join(
+        workdir, 'bench.db')
+    sign_token = setup_environment(database, workdir)
+    headers = {'Authorization': 'Bearer ' + sign_token()}
+
+    # the application reads its configuration at import time
+    from app import app
+
+    with app.app_context():
+        seed_catalog(args.rows)
+
+    results = {
+        'meta': {
+            'database': database.split(':')[0],
+            'rows': args.rows,
+            'workers': args.workers,
+            'threads': args.threads,
+            'concurrency': args.concurrency,
+            'preload': args.preload,
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'results': {}
+    }
+    for mode in args.modes.split(','):
+        if mode == 'gevent' and importlib.util.find_spec('gevent') is None:
+            print('%-8s skipped, gevent is not installed' % mode)
+            continue
+        stats = results['results'][mode] = run_mode(mode, args, headers)
+        print('%-8s ready in %.2f s, %.1f MB' % (
+            mode, stats['ready_s'], stats['memory_mb']))
+        for name in ('GET /movies', 'POST /movies'):
+            print('%-8s %-14s %8.1f req/s  p50 %7.2f ms  p99 %7.2f ms  '
+                  'errors %d' % (
+                      mode, name, stats[name]['throughput'],
+                      stats[name]['p50_ms'], stats[name]['p99_ms'],
+                      stats[name]['errors']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import json
+from flask import abort
+
+from filtering import get_filters
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson')
+# most ids a batch update or delete may list
+MAX_BATCH_IDS = 10000
+
+'''
+read_bulk_rows(request)
+    returns the rows of a bulk request body, either a JSON array or
+    newline delimited JSON (one object per line)
+    lines that are not valid JSON are kept as None so they can be
+    reported per row, aborts with 400 when the body is not a list
+'''
+
+
+def read_bulk_rows(request):
+    if request.mimetype in NDJSON_MIMETYPES:
+        rows = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                rows.append(None)
+    else:
+        rows = request.get_json(silent=True)
+
+    if not isinstance(rows, list) or len(rows) == 0:
+        abort(400)
+    return rows
+
+
+'''
+validate_rows(model, rows)
+    applies the checks of the single create endpoints to every row:
+    a row must be an object and name is required; every value must be
+    of its column's type, numbers may also be sent as strings (like the
+    age of the async POST /actors)
+    returns the column values of the valid rows with their index in the
+    request, and the per row error report
+'''
+
+
+def column_value(model, column, value):
+    # the value in the column's type, None when it cannot be converted
+    python_type = model.__table__.c[column].type.python_type
+    if isinstance(value, python_type) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        try:
+            return python_type(value)
+        except ValueError:
+            return None
+    return None
+
+
+def validate_rows(model, rows):
+    columns = [field for field in model.FIELDS if field != 'id']
+    valid = []
+    errors = []
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            errors.append({'index': index, 'message': 'invalid row'})
+            continue
+        if row.get('name') is None:
+            errors.append({'index': index, 'message': 'name is required'})
+            continue
+        values = {}
+        for column in columns:
+            value = row.get(column)
+            if value is not None:
+                value = column_value(model, column, value)
+                if value is None:
+                    errors.append(
+                        {'index': index, 'message': 'invalid %s' % column})
+                    break
+            values[column] = value
+        else:
+            valid.append((index, values))
+    return valid, errors
+
+
+'''
+read_batch_criteria(body, model)
+    returns the WHERE criteria of a batch update or delete body:
+    "ids", a list of ids, and/or "filter", an object of the list filter
+    parameters of the model (e.g. {"genre": "comedy"})
+    aborts with 400 when neither is given or a value is invalid, so a
+    batch never targets the whole table by mistake
+'''
+
+
+def read_batch_criteria(body, model):
+    if not isinstance(body, dict):
+        abort(400)
+    criteria = []
+
+    ids = body.get('ids')
+    if ids is not None:
+        if not isinstance(ids, list) or not ids or \
+                len(ids) > MAX_BATCH_IDS or \
+                any(type(id) is not int for id in ids):
+            abort(400)
+        criteria.append(model.__table__.c.id.in_(ids))
+
+    filters = body.get('filter')
+    if filters is not None:
+        if not isinstance(filters, dict) or not filters or \
+                any(name not in model.FILTERS for name in filters):
+            abort(400)
+        # the filters take the same strings as the query parameters
+        criteria += get_filters(
+            {name: str(value) for name, value in filters.items()}, model)
+
+    if not criteria:
+        abort(400)
+    return criteria
+
+
+'''
+read_values(body, model)
+    returns the column values to write from an object, any of the
+    model's FIELDS but the id, aborts with 400 when it is not an object
+'''
+
+
+def read_values(body, model):
+    if not isinstance(body, dict):
+        abort(400)
+    return {column: body[column]
+            for column in model.FIELDS if column != 'id' and column in body}
@@ -0,0 +1,214 @@
+import os
+from datetime import datetime, timedelta
+from flask import abort
+from sqlalchemy import DDL, and_, event, or_, select
+
+from models import db, Movie, Actor, Tombstone
+from pagination import (
+    encode_cursor,
+    decode_cursor,
+    get_fields,
+    get_limit,
+    select_fields
+)
+from serialization import row_serializer
+
+'''
+The delta sync of the collections. Database triggers stamp created_at and
+updated_at on every insert and update of movies and actors and write a
+tombstone for every deleted row, whichever code path issues the write,
+like the catalog statistics triggers (see stats.py). GET /<collection>/
+changes?since=<token> reads the rows and tombstones after the token with
+a range scan of the (updated_at, id) index and of the tombstones index,
+so a client that is up to date costs two empty index lookups.
+'''
+
+# seconds back from the database clock that the token of the last page
+# stops at: a write stamped earlier may still be uncommitted (or not yet
+# replayed by a replica), so the changes newer than that are sent again
+# on the next call instead of being skipped; keep it above the longest
+# write transaction plus REPLICA_MAX_LAG
+CHANGES_SAFETY_WINDOW = float(os.environ.get('CHANGES_SAFETY_WINDOW', 10))
+
+# the current UTC time in the format of the DateTime columns (SQLite
+# stores them as text, compared as strings: microseconds are zero padded)
+NOW_SQL = {
+    'postgresql': "timezone('utc', statement_timestamp())",
+    'sqlite': "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+}
+
+# the kind of an entry of the changes, tombstones sort first at the same
+# time so a row deleted and created again is reported alive
+DELETED, CHANGED = 0, 1
+
+'''
+changes_ddl(table)
+    the statements creating the triggers of a table
+    Postgres sets the timestamps in a row level BEFORE trigger and writes
+    the tombstones of a DELETE with one statement over its transition
+    table; SQLite only has AFTER triggers, which update the new row
+'''
+
+
+def changes_ddl(table):
+    values = {'table': table}
+    postgresql = [
+        "CREATE OR REPLACE FUNCTION {table}_touch() RETURNS trigger "
+        "LANGUAGE plpgsql AS $$ BEGIN "
+        "NEW.updated_at := {now}; "
+        "IF TG_OP = 'INSERT' THEN NEW.created_at := NEW.updated_at; "
+        "ELSE NEW.created_at := OLD.created_at; END IF; "
+        "RETURN NEW; END $$",
+        "CREATE TRIGGER {table}_changes_touch "
+        "BEFORE INSERT OR UPDATE ON {table} "
+        "FOR EACH ROW EXECUTE PROCEDURE {table}_touch()",
+        "CREATE OR REPLACE FUNCTION {table}_tombstone() RETURNS trigger "
+        "LANGUAGE plpgsql AS $$ BEGIN "
+        "INSERT INTO tombstones (collection, id, deleted_at) "
+        "SELECT '{table}', id, {now} FROM old_rows "
+        "ON CONFLICT (collection, id) "
+        "DO UPDATE SET deleted_at = excluded.deleted_at; "
+        "RETURN NULL; END $$",
+        "CREATE TRIGGER {table}_changes_delete AFTER DELETE ON {table} "
+        "REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT "
+        "EXECUTE PROCEDURE {table}_tombstone()"
+    ]
+    # the update made by the insert trigger leaves updated_at changed, so
+    # it does not fire the update trigger
+    sqlite = [
+        "CREATE TRIGGER IF NOT EXISTS {table}_changes_insert "
+        "AFTER INSERT ON {table} BEGIN "
+        "UPDATE {table} SET created_at = {now}, updated_at = {now} "
+        "WHERE id = new.id; END",
+        "CREATE TRIGGER IF NOT EXISTS {table}_changes_update "
+        "AFTER UPDATE ON {table} "
+        "WHEN new.updated_at IS old.updated_at BEGIN "
+        "UPDATE {table} SET updated_at = {now} WHERE id = new.id; END",
+        "CREATE TRIGGER IF NOT EXISTS {table}_changes_delete "
+        "AFTER DELETE ON {table} BEGIN "
+        "INSERT INTO tombstones (collection, id, deleted_at) "
+        "VALUES ('{table}', old.id, {now}) "
+        "ON CONFLICT (collection, id) "
+        "DO UPDATE SET deleted_at = excluded.deleted_at; END"
+    ]
+    return {
+        'postgresql': [statement.format(now=NOW_SQL['postgresql'], **values)
+                       for statement in postgresql],
+        'sqlite': [statement.format(now=NOW_SQL['sqlite'], **values)
+                   for statement in sqlite]
+    }
+
+
+# create the triggers along with the tables on create_all (% is the
+# substitution character of DDL)
+for _model in (Movie, Actor):
+    for _dialect, _statements in changes_ddl(_model.__tablename__).items():
+        for _statement in _statements:
+            event.listen(_model.__table__, 'after_create', DDL(
+                _statement.replace('%', '%%')).execute_if(dialect=_dialect))
+
+
+'''
+encode_token(key) / decode_token(token)
+    converts the (time, kind, id) key of the last reported change to an
+    opaque, url safe token and back
+'''
+
+
+def encode_token(key):
+    changed_at, kind, id = key
+    return encode_cursor([changed_at.isoformat(), kind, id])
+
+
+def decode_token(token):
+    changed_at, kind, id = decode_cursor(token)
+    if kind not in (DELETED, CHANGED) or not isinstance(id, int):
+        raise ValueError('invalid token')
+    return datetime.fromisoformat(changed_at), kind, id
+
+
+'''
+get_changes_args(args, model)
+    reads and validates the since, limit and fields query parameters,
+    aborts with 400 on invalid values
+'''
+
+
+def get_changes_args(args, model):
+    since = args.get('since')
+    if since is not None:
+        try:
+            since = decode_token(since)
+        except Exception:
+            abort(400)
+    return since, get_limit(args), get_fields(args, model)
+
+
+def _after(changed_at, id, kind, key):
+    # entries of this kind ordered after key
+    since, since_kind, since_id = key
+    if kind > since_kind:
+        return changed_at >= since
+    if kind < since_kind:
+        return changed_at > since
+    return or_(changed_at > since, and_(changed_at == since, id > since_id))
+
+
+'''
+get_changes(model, fields, limit, since)
+    returns the rows of the model changed after the since key (every row
+    without it) and the ids deleted after it, up to limit changes oldest
+    first, the token of the next call and whether more changes are
+    waiting; an id is reported once, alive when it was created again
+    no token passes the changes of the last CHANGES_SAFETY_WINDOW seconds:
+    the pages only follow each other through older changes, the recent
+    ones fill the rest of the last page and are sent again next time
+    (clients upsert the rows and drop the deleted ids, so that is harmless)
+'''
+
+
+def get_changes(model, fields, limit, since=None, window=None):
+    if window is None:
+        window = CHANGES_SAFETY_WINDOW
+    table = model.__table__
+    tombstones = Tombstone.__table__
+
+    now = db.session.execute(select(db.literal_column(
+        NOW_SQL[db.engine.dialect.name], db.DateTime))).scalar()
+    horizon = (now - timedelta(seconds=window), DELETED, 0)
+
+    rows = select_fields(model, fields, ('updated_at', 'id')) \
+        .order_by(table.c.updated_at, table.c.id).limit(limit + 1)
+    deleted = select(tombstones.c.deleted_at, tombstones.c.id) \
+        .where(tombstones.c.collection == table.name) \
+        .order_by(tombstones.c.deleted_at, tombstones.c.id) \
+        .limit(limit + 1)
+    if since is not None:
+        rows = rows.where(
+            _after(table.c.updated_at, table.c.id, CHANGED, since))
+        deleted = deleted.where(
+            _after(tombstones.c.deleted_at, tombstones.c.id, DELETED, since))
+
+    entries = [((row.updated_at, CHANGED, row.id), row)
+               for row in db.session.execute(rows)]
+    entries += [((row.deleted_at, DELETED, row.id), None)
+                for row in db.session.execute(deleted)]
+    entries.sort(key=lambda entry: entry[0])
+
+    # the token only moves through the changes older than the horizon, a
+    # write stamped before it but committed later is still ahead of it
+    settled = [entry for entry in entries if entry[0] < horizon]
+    more = len(settled) > limit
+    if more:
+        entries = settled[:limit]
+        last = entries[-1][0]
+    else:
+        entries = entries[:limit]
+        last = horizon if since is None else max(since, horizon)
+
+    serialize = row_serializer(tuple(fields))
+    changed = [serialize(row) for key, row in entries if row is not None]
+    alive = set(key[2] for key, row in entries if row is not None)
+    deleted = [key[2] for key, row in entries
+               if row is None and key[2] not in alive]
+    return changed, deleted, encode_token(last), more
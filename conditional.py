@@ -0,0 +1,31 @@
+from flask import Response
+
+from models import get_version
+
+'''
+collection_etag(name, *related)
+    returns the strong ETag of a collection, derived from its version
+    counter with a single primary key lookup, and from the counters of
+    the related collections embedded in the response
+'''
+
+
+def collection_etag(name, *related):
+    return '.'.join(
+        '%s-%d' % (collection, get_version(collection))
+        for collection in (name,) + related)
+
+
+'''
+not_modified(request, etag)
+    returns an empty 304 response when the request's If-None-Match
+    matches the etag, None otherwise
+'''
+
+
+def not_modified(request, etag):
+    if not request.if_none_match.contains(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,180 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+'''
+Connection pool settings, read from the environment
+'''
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get(
+    'DB_POOL_PRE_PING', 'true').lower() == 'true'
+# per connection Postgres timeouts in milliseconds, 0 disables them
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+DB_LOCK_TIMEOUT = int(os.environ.get('DB_LOCK_TIMEOUT', 0))
+
+# upper bounds (seconds) of the checkout wait time histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class PoolStats:
+    """Checkout wait time histogram and timeout counter of a worker's pool"""
+
+    def __init__(self, buckets=WAIT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.wait_sum = 0.0
+        self.checkouts = 0
+        self.timeouts = 0
+
+    def observe_wait(self, seconds):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, seconds)] += 1
+            self.wait_sum += seconds
+            self.checkouts += 1
+
+    def observe_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def histogram(self):
+        buckets = [str(bucket) for bucket in self.buckets] + ['+Inf']
+        return dict(zip(buckets, self.counts))
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long each checkout waits for a connection"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            pool_stats.observe_timeout()
+            raise
+        pool_stats.observe_wait(time.perf_counter() - start)
+        return connection
+
+
+'''
+engine_options(database_path)
+    returns the SQLALCHEMY_ENGINE_OPTIONS for the database, SQLite keeps
+    the pool SQLAlchemy picks for it
+'''
+
+
+def engine_options(database_path):
+    if database_path.startswith('sqlite'):
+        return {}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+    if database_path.startswith('postgresql'):
+        settings = []
+        if DB_STATEMENT_TIMEOUT:
+            settings.append('-c statement_timeout=%d' % DB_STATEMENT_TIMEOUT)
+        if DB_LOCK_TIMEOUT:
+            settings.append('-c lock_timeout=%d' % DB_LOCK_TIMEOUT)
+        if settings:
+            options['connect_args'] = {'options': ' '.join(settings)}
+    return options
+
+
+'''
+async_engine_options(database_path)
+    the same settings for the asyncio engine of the ASGI app, whose pool
+    has to stay the asyncio-aware one SQLAlchemy picks
+'''
+
+
+def async_engine_options(database_path):
+    if database_path.startswith('sqlite'):
+        return {}
+
+    options = {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+    if database_path.startswith('postgresql'):
+        settings = {}
+        if DB_STATEMENT_TIMEOUT:
+            settings['statement_timeout'] = str(DB_STATEMENT_TIMEOUT)
+        if DB_LOCK_TIMEOUT:
+            settings['lock_timeout'] = str(DB_LOCK_TIMEOUT)
+        if settings:
+            options['connect_args'] = {'server_settings': settings}
+    return options
+
+
+'''
+get_pool_status(engine)
+    returns the current state of the engine's pool along with the
+    checkout wait time histogram of this worker
+'''
+
+
+def get_pool_status(engine):
+    pool = engine.pool
+    status = {
+        'pid': os.getpid(),
+        'pool': pool.__class__.__name__,
+        'checkouts': pool_stats.checkouts,
+        'timeouts': pool_stats.timeouts,
+        'wait_seconds_sum': pool_stats.wait_sum,
+        'wait_seconds_histogram': pool_stats.histogram()
+    }
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'timeout': pool.timeout()
+        })
+    return status
+
+
+'''
+prime_pool(engine, size)
+    opens size connections of the engine's pool (all of its pool_size by
+    default) and checks them back in, so they are ready for the first
+    requests; these checkouts are left out of the wait time histogram
+'''
+
+
+def prime_pool(engine, size=None):
+    pool = engine.pool
+    if size is None:
+        size = pool.size() if isinstance(pool, QueuePool) else 1
+    connections = []
+    try:
+        for _ in range(size):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+    pool_stats.reset()
+    return len(connections)
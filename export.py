@@ -0,0 +1,109 @@
+import io
+import csv
+import zlib
+from flask import Response, abort, stream_with_context
+
+from models import db
+from pagination import get_fields, list_statement
+from filtering import get_filters
+from serialization import dumps, row_serializer
+from streaming import STREAM_BATCH_SIZE
+
+# format -> mimetype of the exports
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson'
+}
+DEFAULT_EXPORT_FORMAT = 'ndjson'
+# zlib level of the gzip encoded exports, the default speed / size balance
+EXPORT_GZIP_LEVEL = 6
+
+'''
+get_export_args(args, model)
+    reads the format, fields and filter query parameters of an export,
+    aborts with 400 on invalid values
+'''
+
+
+def get_export_args(args, model):
+    export_format = args.get('format', DEFAULT_EXPORT_FORMAT)
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    return export_format, get_fields(args, model), get_filters(args, model)
+
+
+'''
+csv_lines(fields, rows) / ndjson_lines(fields, rows)
+    encode one batch of rows, CSV without the header line
+'''
+
+
+def csv_lines(fields, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def ndjson_lines(fields, rows):
+    serialize = row_serializer(tuple(fields))
+    return b''.join(dumps(serialize(row)) + b'\n' for row in rows)
+
+
+'''
+gzip_chunks(chunks, level)
+    gzip encodes a stream of chunks as they come, the compressor only
+    keeps its window in memory
+'''
+
+
+def gzip_chunks(chunks, level=EXPORT_GZIP_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+'''
+export_collection(name, model, args, accept_gzip, batch_size)
+    streams every row of the model matching the filters as CSV (with a
+    header line) or NDJSON, in id order, fetched from a server side
+    cursor batch_size rows at a time and encoded batch by batch, so the
+    worker memory stays bounded whatever the size of the table; gzip
+    encoded when the client accepts it
+    an empty export is an empty body (the header line for CSV), not 404
+'''
+
+
+def export_collection(name, model, args, accept_gzip=False,
+                      batch_size=STREAM_BATCH_SIZE):
+    export_format, fields, filters = get_export_args(args, model)
+    # select exactly the exported columns, in their order
+    statement = list_statement(model, fields, filters) \
+        .with_only_columns(*[model.__table__.c[field] for field in fields])
+    encode = csv_lines if export_format == 'csv' else ndjson_lines
+
+    def generate():
+        result = db.session.execute(
+            statement.execution_options(stream_results=True))
+        try:
+            if export_format == 'csv':
+                yield csv_lines(fields, [fields])
+            for rows in result.partitions(batch_size):
+                yield encode(fields, rows)
+        finally:
+            result.close()
+
+    chunks = generate()
+    headers = {
+        'Content-Disposition': 'attachment; filename="%s.%s"' % (
+            name, export_format),
+        'Vary': 'Accept-Encoding'
+    }
+    if accept_gzip:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(
+        stream_with_context(chunks), headers=headers,
+        content_type=EXPORT_FORMATS[export_format])
@@ -0,0 +1,52 @@
+import operator
+from flask import abort
+
+'''
+get_filters(args, model)
+    turns the filter query parameters declared in the model's FILTERS
+    (parameter -> (column, comparison)) into parameterized SQL criteria,
+    converting each value to the column's python type
+    aborts with 400 on values of the wrong type
+'''
+
+
+def get_filters(args, model):
+    table = model.__table__
+    criteria = []
+    for parameter, (name, comparison) in model.FILTERS.items():
+        value = args.get(parameter)
+        if value is None:
+            continue
+        column = table.c[name]
+        try:
+            value = column.type.python_type(value)
+        except ValueError:
+            abort(400)
+        criteria.append(getattr(operator, comparison)(column, value))
+    return criteria
+
+
+'''
+get_sort(args, model)
+    reads the sort query parameter, a comma separated list of the
+    model's FIELDS, each prefixed with - for a descending order, e.g.
+    sort=name,-age
+    returns (column, descending) pairs, aborts with 400 on unknown fields
+'''
+
+
+def get_sort(args, model):
+    sort = args.get('sort')
+    if sort is None:
+        return []
+
+    keys = []
+    for key in sort.split(','):
+        key = key.strip()
+        descending = key.startswith('-')
+        name = key[1:] if descending else key
+        if name not in model.FIELDS or \
+                name in [previous for previous, _ in keys]:
+            abort(400)
+        keys.append((name, descending))
+    return keys
@@ -0,0 +1,118 @@
+import os
+import threading
+
+from metrics import registry
+
+'''
+Group commit settings, read from the environment
+With GROUP_COMMIT the single row writes of the models (insert, update,
+delete) issued at the same moment by the threads of a worker share one
+transaction, so they pay for one commit (one WAL flush) together instead
+of one each. A write waits up to GROUP_COMMIT_WINDOW milliseconds for
+others to join its batch: a longer window merges more writes per commit
+(throughput) but delays each of them by up to that long (latency).
+'''
+
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT', 'false').lower() == 'true'
+GROUP_COMMIT_WINDOW = float(os.environ.get('GROUP_COMMIT_WINDOW', 2))
+# a full batch is committed right away, without waiting for the window
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 64))
+
+
+class _Write:
+    def __init__(self, work, collections):
+        self.work = work
+        self.collections = collections
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Batch:
+    def __init__(self):
+        self.writes = []
+        self.full = threading.Event()
+
+
+class GroupCommitter:
+    """Merges the writes submitted concurrently into one transaction.
+
+    The first write of a batch leads it: it waits for the window to end
+    (or the batch to fill up), then runs every write of the batch on one
+    connection, bumps the version of each collection they touched once
+    and commits. The other writers wait for the leader and get their own
+    result or error back. A failing write is taken out of the batch and
+    the others are run again in a new transaction, so it does not fail
+    them; if the commit itself fails every write of the batch fails.
+    """
+
+    def __init__(self, get_engine, bump_version, enabled=GROUP_COMMIT,
+                 window=GROUP_COMMIT_WINDOW,
+                 max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.get_engine = get_engine
+        self.bump_version = bump_version
+        self.enabled = enabled
+        self.window = window
+        self.max_batch = max_batch
+        self._batch = None
+        self._lock = threading.Lock()
+
+    def submit(self, work, collections=()):
+        '''runs work(connection) in the next group commit and returns its
+        result once committed, raises its error if it failed'''
+        write = _Write(work, collections)
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            batch.writes.append(write)
+            if len(batch.writes) >= self.max_batch:
+                self._batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window / 1000)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            self._commit(batch.writes)
+        else:
+            write.done.wait()
+
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _commit(self, writes):
+        registry.inc('group_commit_batches_total')
+        registry.inc('group_commit_writes_total', len(writes))
+        pending = list(writes)
+        try:
+            while pending:
+                failed = None
+                try:
+                    with self.get_engine().begin() as connection:
+                        for write in pending:
+                            failed = write
+                            write.result = write.work(connection)
+                        failed = None
+                        collections = set()
+                        for write in pending:
+                            collections.update(write.collections)
+                        # in the same order in every batch, so concurrent
+                        # batches do not deadlock on the version rows
+                        for name in sorted(collections):
+                            self.bump_version(name, connection)
+                    break
+                except Exception as e:
+                    if failed is None:
+                        for write in pending:
+                            write.result = None
+                            write.error = e
+                        break
+                    failed.error = e
+                    pending.remove(failed)
+        finally:
+            for write in writes:
+                write.done.set()
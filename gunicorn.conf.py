@@ -0,0 +1,83 @@
+import os
+import multiprocessing
+
+'''
+Gunicorn settings, read from the environment
+gunicorn loads this file from the working directory on its own:
+    gunicorn app:app
+WEB_WORKER_CLASS picks the workers: sync (one request at a time),
+gthread (WEB_THREADS requests at a time) or gevent (WEB_WORKER_CONNECTIONS
+greenlets, needs `pip install gevent psycogreen`)
+'''
+
+WEB_WORKER_CLASS = os.environ.get('WEB_WORKER_CLASS', 'gthread')
+WEB_CONCURRENCY = int(os.environ.get(
+    'WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 32))
+WEB_WORKER_CONNECTIONS = int(os.environ.get('WEB_WORKER_CONNECTIONS', 1000))
+WEB_TIMEOUT = int(os.environ.get('WEB_TIMEOUT', 30))
+WEB_PRELOAD = os.environ.get('WEB_PRELOAD', 'true').lower() == 'true'
+
+if WEB_WORKER_CLASS == 'gevent':
+    # before the app is preloaded, so its locks and sockets are cooperative
+    from gevent import monkey
+    monkey.patch_all()
+
+worker_class = WEB_WORKER_CLASS
+workers = WEB_CONCURRENCY
+if WEB_WORKER_CLASS == 'gthread':
+    threads = WEB_THREADS
+elif WEB_WORKER_CLASS == 'gevent':
+    worker_connections = WEB_WORKER_CONNECTIONS
+timeout = WEB_TIMEOUT
+# import the app once in the master, the workers share its memory pages
+# copy-on-write instead of importing it again each
+preload_app = WEB_PRELOAD
+
+'''
+post_fork(server, worker)
+    runs in every new worker: drops the database pool copied from the
+    master so no connection socket is ever shared between processes
+    (importing the app opens none, the master never touches the database)
+'''
+
+
+def post_fork(server, worker):
+    from models import db
+    from replicas import replica_set
+
+    db.engine.dispose()
+    replica_set.dispose()
+    if WEB_WORKER_CLASS == 'gevent':
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            server.log.warning('psycogreen is missing, psycopg2 will block')
+        else:
+            patch_psycopg()
+
+
+'''
+post_worker_init(worker)
+    runs in every worker before it accepts requests: opens the connections
+    of the pool and fetches the JWKS, so the first requests do not pay
+    for them; a failure is logged and left to the first requests
+'''
+
+
+def post_worker_init(worker):
+    from models import db
+    from dbpool import prime_pool
+    from replicas import replica_set
+    from auth import jwks_store
+
+    try:
+        prime_pool(db.engine)
+        for replica in replica_set.replicas:
+            prime_pool(replica.engine)
+    except Exception as e:
+        worker.log.warning('could not prime the database pool: %s', e)
+    try:
+        jwks_store.refresh()
+    except Exception as e:
+        worker.log.warning('could not fetch the JWKS: %s', e)
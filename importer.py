@@ -0,0 +1,184 @@
+import io
+import os
+import csv
+import gzip
+import json
+import time
+from itertools import islice
+
+from models import db, bump_version, ImportCheckpoint
+
+# rows validated, inserted and committed together
+IMPORT_BATCH_SIZE = 10000
+
+'''
+read_records(path)
+    yields the records of a CSV (with a header line) or NDJSON file one
+    at a time, gunzipping files ending in .gz on the fly
+    NDJSON lines that are not valid JSON are yielded as None so they are
+    rejected like any invalid row
+'''
+
+
+def read_records(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    extension = os.path.splitext(name)[1]
+    if extension not in ('.csv', '.ndjson', '.jsonl'):
+        raise ValueError('unknown file type: %s, expected .csv or .ndjson'
+                         % path)
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as source:
+        if extension == '.csv':
+            yield from csv.DictReader(source)
+            return
+        for line in source:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+'''
+validate_record(model, record)
+    applies the checks of the create endpoints to a record and converts
+    its values to the types of the model's columns (CSV values are all
+    strings, empty ones are NULL)
+    returns the column values and None, or None and the error message
+'''
+
+
+def validate_record(model, record):
+    if not isinstance(record, dict):
+        return None, 'invalid row'
+    values = {}
+    for field in model.FIELDS:
+        value = record.get(field)
+        if value == '':
+            value = None
+        if value is not None:
+            if isinstance(value, bool) or \
+                    not isinstance(value, (str, int, float)):
+                return None, 'invalid %s' % field
+            python_type = model.__table__.c[field].type.python_type
+            try:
+                value = python_type(value)
+            except ValueError:
+                return None, 'invalid %s' % field
+        values[field] = value
+    if values['name'] is None:
+        return None, 'name is required'
+    if values['id'] is None:
+        del values['id']
+    return values, None
+
+
+'''
+insert_rows(model, rows)
+    inserts validated rows in the current transaction: COPY FROM STDIN on
+    Postgres, an executemany INSERT elsewhere
+    rows with and without an id are inserted separately, and on Postgres
+    the id sequence is moved past the ids given in between
+'''
+
+
+def insert_rows(model, rows):
+    table = model.__table__
+    postgresql = db.engine.dialect.name == 'postgresql'
+    with_ids = [row for row in rows if 'id' in row]
+    without_ids = [row for row in rows if 'id' not in row]
+    for group in (with_ids, without_ids):
+        if not group:
+            continue
+        columns = [field for field in model.FIELDS if field in group[0]]
+        if postgresql:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in group:
+                writer.writerow([row[column] for column in columns])
+            buffer.seek(0)
+            cursor = db.session.connection().connection.cursor()
+            cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+                table.name, ', '.join(columns)), buffer)
+        else:
+            db.session.execute(table.insert(), group)
+        # before the rows without an id take their ids from the sequence
+        if group is with_ids and postgresql:
+            db.session.execute(db.text(
+                "SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                "(SELECT max(id) FROM {table}))".format(table=table.name)))
+
+
+'''
+import_file(model, path, batch_size, restart, report)
+    imports the records of a file into the model's table, batch_size rows
+    per transaction; every batch also moves the file's ImportCheckpoint,
+    so after a failure running it again resumes after the last committed
+    batch without duplicating rows (restart=True starts over instead)
+    rejected records are reported with their position in the file and
+    skipped; report(message) receives the progress after every batch
+    returns the number of imported and rejected records
+'''
+
+
+def import_file(model, path, batch_size=IMPORT_BATCH_SIZE, restart=False,
+                report=print):
+    table = model.__table__.name
+    source = '%s:%s' % (table, os.path.abspath(path))
+    size = os.path.getsize(path)
+
+    checkpoint = db.session.get(ImportCheckpoint, source)
+    if checkpoint is not None and restart:
+        db.session.delete(checkpoint)
+        db.session.commit()
+        checkpoint = None
+    if checkpoint is None:
+        checkpoint = ImportCheckpoint(
+            source=source, size=size, position=0, imported=0, rejected=0,
+            done=False)
+        db.session.add(checkpoint)
+    elif checkpoint.size != size:
+        raise ValueError('%s changed since its import started, run it '
+                         'again with --restart' % path)
+    elif checkpoint.done:
+        report('%s: %s already imported' % (table, path))
+        return checkpoint.imported, checkpoint.rejected
+    elif checkpoint.position:
+        report('%s: resuming after record %d' % (table, checkpoint.position))
+
+    records = islice(read_records(path), checkpoint.position, None)
+    start = time.perf_counter()
+    imported = 0
+    try:
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            rows = []
+            for offset, record in enumerate(batch):
+                values, error = validate_record(model, record)
+                if error is None:
+                    rows.append(values)
+                else:
+                    checkpoint.rejected += 1
+                    report('%s: rejected record %d: %s' % (
+                        table, checkpoint.position + offset + 1, error))
+            if rows:
+                insert_rows(model, rows)
+                bump_version(table)
+            checkpoint.position += len(batch)
+            checkpoint.imported += len(rows)
+            db.session.commit()
+
+            imported += len(rows)
+            elapsed = time.perf_counter() - start
+            report('%s: %d records imported, %d rejected, %.0f rows/s' % (
+                table, checkpoint.imported, checkpoint.rejected,
+                imported / elapsed if elapsed else 0))
+        checkpoint.done = True
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return checkpoint.imported, checkpoint.rejected
@@ -0,0 +1,66 @@
+from collections import defaultdict
+from flask import abort
+from sqlalchemy import select
+
+from models import db
+from serialization import row_serializer
+
+'''
+get_include(args, model)
+    reads the include query parameter, a comma separated list of the
+    model's INCLUDES, aborts with 400 on unknown relationships
+'''
+
+
+def get_include(args, model):
+    include = args.get('include')
+    if include is None:
+        return []
+
+    names = [name.strip() for name in include.split(',') if name.strip()]
+    if not names or any(name not in model.INCLUDES for name in names):
+        abort(400)
+    return list(dict.fromkeys(names))
+
+
+'''
+related_statement(model, name, ids)
+    selects the rows related to the parents ids through the many to many
+    relationship name, each with the id of its parent, in one query
+    (what selectin loading does for the ORM)
+'''
+
+
+def related_statement(model, name, ids):
+    relationship = model.__mapper__.relationships[name]
+    target = relationship.mapper.class_.__table__
+    parent_key = relationship.synchronize_pairs[0][1]
+    target_id, target_key = relationship.secondary_synchronize_pairs[0]
+    columns = [target.c[field]
+               for field in relationship.mapper.class_.FIELDS]
+    return select(parent_key, *columns) \
+        .join_from(relationship.secondary, target, target_id == target_key) \
+        .where(parent_key.in_(ids)) \
+        .order_by(parent_key, target.c.id)
+
+
+'''
+load_included(model, include, items, ids)
+    embeds the related rows of every included relationship in the items,
+    ids being the ids of the items in the same order
+    issues one query per relationship whatever the number of items
+'''
+
+
+def load_included(model, include, items, ids):
+    for name in include:
+        related = defaultdict(list)
+        if ids:
+            serialize = row_serializer(model.__mapper__.relationships[name]
+                                       .mapper.class_.FIELDS)
+            for row in db.session.execute(
+                    related_statement(model, name, ids)):
+                related[row[0]].append(serialize(row[1:]))
+        for item, parent_id in zip(items, ids):
+            item[name] = related[parent_id]
+    return items
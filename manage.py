@@ -1,7 +1,9 @@
-from flask_script import Manager
+from flask_script import Command, Manager, Option
 from flask_migrate import Migrate, MigrateCommand
 from app import app
-from models import db
+from models import db, Movie, Actor
+from stats import rebuild_stats as rebuild_catalog_stats
+from importer import IMPORT_BATCH_SIZE, import_file
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -9,5 +11,41 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def create_db():
+    """Creates the database tables which do not exist yet"""
+    db.create_all()
+
+
+@manager.command
+def rebuild_stats():
+    """Recomputes the catalog statistics served by GET /stats"""
+    rebuild_catalog_stats()
+
+
+class ImportCatalog(Command):
+    """Imports movies and actors from CSV or NDJSON files (.gz too),
+    resuming an interrupted import of the same file where it stopped"""
+
+    option_list = (
+        Option('--movies', dest='movies', help='file of movies'),
+        Option('--actors', dest='actors', help='file of actors'),
+        Option('--batch-size', dest='batch_size', type=int,
+               default=IMPORT_BATCH_SIZE, help='rows per transaction'),
+        Option('--restart', dest='restart', action='store_true',
+               default=False,
+               help='import the files from the start again')
+    )
+
+    def run(self, movies, actors, batch_size, restart):
+        for model, path in ((Movie, movies), (Actor, actors)):
+            if path:
+                import_file(model, path, batch_size, restart)
+
+
+# `import` is a keyword, the command cannot be a decorated function
+manager.add_command('import', ImportCatalog())
+
+
 if __name__ == '__main__':
     manager.run()
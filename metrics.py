@@ -0,0 +1,319 @@
+import os
+import copy
+import json
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# directory shared by the gunicorn workers to aggregate their metrics,
+# without it /metrics only reports the worker serving the scrape
+METRICS_DIR = os.environ.get('METRICS_DIR')
+# minimum seconds between two writes of a worker's metrics file
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+
+# upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# request phases reported in Server-Timing, in this order
+PHASES = ('auth', 'jwt', 'db', 'serialize')
+
+
+class MetricsRegistry:
+    """Per worker request latency histograms, query counts and counters"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.routes = {}
+        self.counters = {}
+        self.last_flush = 0
+        self._lock = threading.Lock()
+
+    def observe_request(self, method, route, status, seconds, timings,
+                        queries):
+        key = '%s %s' % (method, route)
+        with self._lock:
+            entry = self.routes.get(key)
+            if entry is None:
+                entry = self.routes[key] = {
+                    'method': method,
+                    'route': route,
+                    'count': 0,
+                    'sum': 0.0,
+                    'buckets': [0] * (len(self.buckets) + 1),
+                    'queries': 0,
+                    'phases': dict.fromkeys(PHASES, 0.0),
+                    'statuses': {}
+                }
+            entry['count'] += 1
+            entry['sum'] += seconds
+            entry['buckets'][bisect_left(self.buckets, seconds)] += 1
+            entry['queries'] += queries
+            for phase, duration in timings.items():
+                entry['phases'][phase] = (
+                    entry['phases'].get(phase, 0.0) + duration)
+            status = str(status)
+            entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+
+    def inc(self, name, value=1, **labels):
+        key = json.dumps([name, sorted(labels.items())])
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return copy.deepcopy({
+                'buckets': list(self.buckets),
+                'routes': self.routes,
+                'counters': self.counters
+            })
+
+    def flush(self, force=False):
+        if not METRICS_DIR:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_flush < METRICS_FLUSH_INTERVAL:
+            return
+        self.last_flush = now
+        path = os.path.join(METRICS_DIR, '%d.json' % os.getpid())
+        with open(path + '.tmp', 'w') as metrics_file:
+            json.dump(self.snapshot(), metrics_file)
+        # atomic, so a scrape never reads half a file
+        os.replace(path + '.tmp', path)
+
+    def collect(self):
+        '''returns the snapshots of every worker merged together'''
+        if not METRICS_DIR:
+            return self.snapshot()
+        self.flush(force=True)
+        snapshots = []
+        for name in os.listdir(METRICS_DIR):
+            if name.endswith('.json'):
+                with open(os.path.join(METRICS_DIR, name)) as metrics_file:
+                    snapshots.append(json.load(metrics_file))
+        return merge_snapshots(snapshots)
+
+
+registry = MetricsRegistry()
+
+
+'''
+merge_snapshots(snapshots)
+    sums the metrics of several workers
+'''
+
+
+def merge_snapshots(snapshots):
+    merged = {'buckets': list(LATENCY_BUCKETS), 'routes': {}, 'counters': {}}
+    for snapshot in snapshots:
+        for key, entry in snapshot['routes'].items():
+            total = merged['routes'].get(key)
+            if total is None:
+                merged['routes'][key] = copy.deepcopy(entry)
+                continue
+            for field in ('count', 'sum', 'queries'):
+                total[field] += entry[field]
+            total['buckets'] = [
+                a + b for a, b in zip(total['buckets'], entry['buckets'])]
+            for phase, duration in entry['phases'].items():
+                total['phases'][phase] = (
+                    total['phases'].get(phase, 0) + duration)
+            for status, count in entry['statuses'].items():
+                total['statuses'][status] = (
+                    total['statuses'].get(status, 0) + count)
+        for key, value in snapshot['counters'].items():
+            merged['counters'][key] = merged['counters'].get(key, 0) + value
+    return merged
+
+
+'''
+render_prometheus(snapshot)
+    formats a snapshot in the Prometheus text exposition format
+'''
+
+
+def _labels(**labels):
+    return ','.join(
+        '%s="%s"' % (name, str(value).replace('"', '\\"'))
+        for name, value in labels.items())
+
+
+def render_prometheus(snapshot):
+    routes = sorted(snapshot['routes'].values(),
+                    key=lambda entry: (entry['route'], entry['method']))
+    lines = [
+        '# HELP http_request_duration_seconds Request latency per route.',
+        '# TYPE http_request_duration_seconds histogram'
+    ]
+    for entry in routes:
+        labels = _labels(method=entry['method'], route=entry['route'])
+        cumulative = 0
+        bounds = [str(bound) for bound in snapshot['buckets']] + ['+Inf']
+        for bound, count in zip(bounds, entry['buckets']):
+            cumulative += count
+            lines.append(
+                'http_request_duration_seconds_bucket{%s,le="%s"} %d'
+                % (labels, bound, cumulative))
+        lines.append('http_request_duration_seconds_sum{%s} %f'
+                     % (labels, entry['sum']))
+        lines.append('http_request_duration_seconds_count{%s} %d'
+                     % (labels, entry['count']))
+
+    lines += [
+        '# HELP http_requests_total Requests per route and status.',
+        '# TYPE http_requests_total counter'
+    ]
+    for entry in routes:
+        for status, count in sorted(entry['statuses'].items()):
+            lines.append('http_requests_total{%s} %d' % (_labels(
+                method=entry['method'], route=entry['route'],
+                status=status), count))
+
+    lines += [
+        '# HELP http_request_phase_seconds_total Time spent per phase.',
+        '# TYPE http_request_phase_seconds_total counter'
+    ]
+    for entry in routes:
+        for phase, duration in sorted(entry['phases'].items()):
+            lines.append(
+                'http_request_phase_seconds_total{%s} %f' % (_labels(
+                    method=entry['method'], route=entry['route'],
+                    phase=phase), duration))
+
+    lines += [
+        '# HELP db_queries_total Database queries per route.',
+        '# TYPE db_queries_total counter'
+    ]
+    for entry in routes:
+        lines.append('db_queries_total{%s} %d' % (_labels(
+            method=entry['method'], route=entry['route']), entry['queries']))
+
+    typed = set()
+    for key, value in sorted(snapshot['counters'].items()):
+        name, labels = json.loads(key)
+        if name not in typed:
+            lines.append('# TYPE %s counter' % name)
+            typed.add(name)
+        lines.append('%s{%s} %s' % (name, _labels(**dict(labels)), value))
+    return '\n'.join(lines) + '\n'
+
+
+'''
+record_timing(phase, seconds)
+    adds the duration of a phase to the current request's timings,
+    does nothing outside of a request
+'''
+
+
+def record_timing(phase, seconds):
+    if has_request_context() and 'timings' in g:
+        g.timings[phase] = g.timings.get(phase, 0.0) + seconds
+
+
+class timed:
+    """Context manager recording the duration of its block as a phase"""
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        record_timing(self.phase, time.perf_counter() - self.start)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    seconds = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context() and 'timings' in g:
+        g.query_count += 1
+        record_timing('db', seconds)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_start'):
+        connection.info['query_start'].pop()
+
+
+'''
+init_metrics(app)
+    times every request of the app, adds the Server-Timing header and
+    feeds the per route aggregates exposed by /metrics
+'''
+
+
+def init_metrics(app):
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.timings = {}
+        g.query_count = 0
+
+    @app.after_request
+    def record_request(response):
+        if 'request_start' not in g:
+            return response
+        total = time.perf_counter() - g.request_start
+        server_timing = ['%s;dur=%.2f' % (phase, g.timings[phase] * 1000)
+                         for phase in PHASES if phase in g.timings]
+        server_timing.append('total;dur=%.2f' % (total * 1000))
+        response.headers['Server-Timing'] = ', '.join(server_timing)
+
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        registry.observe_request(
+            request.method, route, response.status_code, total, g.timings,
+            g.query_count)
+        registry.flush()
+        return response
+
+
+'''
+observed_async(route)
+    the init_metrics of an async handler of asgi.py, reported under the
+    route of the Flask app serving the same requests: times it, adds the
+    Server-Timing header (the total only, the phases are recorded in
+    flask.g) and feeds the per route aggregates
+    a request the handler hands over to the Flask app (it returns the
+    WSGI app instead of a response) is recorded by the Flask app
+'''
+
+
+def observed_async(route):
+    def decorator(f):
+        @wraps(f)
+        async def wrapper(request, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                response = await f(request, *args, **kwargs)
+            except Exception as e:
+                status = getattr(e, 'status_code', None) or \
+                    getattr(e, 'code', None) or 500
+                registry.observe_request(
+                    request.method, route, status,
+                    time.perf_counter() - start, {}, 0)
+                registry.flush()
+                raise
+            if not hasattr(response, 'status_code'):
+                return response
+            total = time.perf_counter() - start
+            response.headers['Server-Timing'] = 'total;dur=%.2f' % (
+                total * 1000)
+            registry.observe_request(
+                request.method, route, response.status_code, total, {}, 0)
+            registry.flush()
+            return response
+
+        return wrapper
+    return decorator
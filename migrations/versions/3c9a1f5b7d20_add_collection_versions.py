@@ -0,0 +1,32 @@
+"""Add collection versions.
+
+Revision ID: 3c9a1f5b7d20
+Revises: 217e3f474901
+Create Date: 2026-10-18 09:12:41.205318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9a1f5b7d20'
+down_revision = '217e3f474901'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    collection_versions = op.create_table('collection_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(collection_versions, [
+        {'name': 'movies', 'version': 0},
+        {'name': 'actors', 'version': 0}
+    ])
+
+
+def downgrade():
+    op.drop_table('collection_versions')
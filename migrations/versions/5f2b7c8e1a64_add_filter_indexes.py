@@ -0,0 +1,34 @@
+"""Add list filter and sort indexes.
+
+Revision ID: 5f2b7c8e1a64
+Revises: 8d41e6b2c9f3
+Create Date: 2026-10-18 12:26:53.870142
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5f2b7c8e1a64'
+down_revision = '8d41e6b2c9f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_movies_genre_id', 'movies', ['genre', 'id'])
+    op.create_index('ix_movies_name_id', 'movies', ['name', 'id'])
+    op.create_index('ix_actors_gender_age', 'actors', ['gender', 'age'])
+    op.create_index('ix_actors_experience_level_id', 'actors',
+                    ['experience_level', 'id'])
+    op.create_index('ix_actors_age_id', 'actors', ['age', 'id'])
+    op.create_index('ix_actors_name_id', 'actors', ['name', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_actors_name_id', table_name='actors')
+    op.drop_index('ix_actors_age_id', table_name='actors')
+    op.drop_index('ix_actors_experience_level_id', table_name='actors')
+    op.drop_index('ix_actors_gender_age', table_name='actors')
+    op.drop_index('ix_movies_name_id', table_name='movies')
+    op.drop_index('ix_movies_genre_id', table_name='movies')
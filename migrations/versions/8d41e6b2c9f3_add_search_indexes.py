@@ -0,0 +1,69 @@
+"""Add full text search indexes.
+
+Revision ID: 8d41e6b2c9f3
+Revises: 3c9a1f5b7d20
+Create Date: 2026-10-18 11:03:27.514209
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8d41e6b2c9f3'
+down_revision = '3c9a1f5b7d20'
+branch_labels = None
+depends_on = None
+
+SEARCHABLE = {
+    'movies': ('name', 'genre'),
+    'actors': ('name',)
+}
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table, columns in SEARCHABLE.items():
+        if dialect == 'postgresql':
+            document = " || ' ' || ".join(
+                "coalesce(%s, '')" % column for column in columns)
+            op.execute(
+                "CREATE INDEX ix_%s_search ON %s "
+                "USING gin (to_tsvector('simple', %s))"
+                % (table, table, document))
+        elif dialect == 'sqlite':
+            names = ', '.join(columns)
+            new = ', '.join('new.%s' % column for column in columns)
+            old = ', '.join('old.%s' % column for column in columns)
+            fts_delete = (
+                "INSERT INTO %s_fts(%s_fts, rowid, %s) "
+                "VALUES ('delete', old.id, %s);" % (table, table, names, old))
+            fts_insert = (
+                "INSERT INTO %s_fts(rowid, %s) VALUES (new.id, %s);"
+                % (table, names, new))
+            op.execute(
+                "CREATE VIRTUAL TABLE %s_fts USING fts5("
+                "%s, content='%s', content_rowid='id')"
+                % (table, names, table))
+            op.execute(
+                "CREATE TRIGGER %s_fts_insert AFTER INSERT ON %s "
+                "BEGIN %s END" % (table, table, fts_insert))
+            op.execute(
+                "CREATE TRIGGER %s_fts_delete AFTER DELETE ON %s "
+                "BEGIN %s END" % (table, table, fts_delete))
+            op.execute(
+                "CREATE TRIGGER %s_fts_update AFTER UPDATE ON %s "
+                "BEGIN %s %s END" % (table, table, fts_delete, fts_insert))
+            op.execute(
+                "INSERT INTO %s_fts(%s_fts) VALUES ('rebuild')"
+                % (table, table))
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table in SEARCHABLE:
+        if dialect == 'postgresql':
+            op.execute('DROP INDEX ix_%s_search' % table)
+        elif dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute('DROP TRIGGER %s_fts_%s' % (table, trigger))
+            op.execute('DROP TABLE %s_fts' % table)
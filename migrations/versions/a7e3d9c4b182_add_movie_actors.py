@@ -0,0 +1,32 @@
+"""Add the movie_actors casting table.
+
+Revision ID: a7e3d9c4b182
+Revises: 5f2b7c8e1a64
+Create Date: 2026-10-18 13:48:05.291766
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7e3d9c4b182'
+down_revision = '5f2b7c8e1a64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('movie_actors',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index('ix_movie_actors_actor_id', 'movie_actors', ['actor_id'])
+
+
+def downgrade():
+    op.drop_index('ix_movie_actors_actor_id', table_name='movie_actors')
+    op.drop_table('movie_actors')
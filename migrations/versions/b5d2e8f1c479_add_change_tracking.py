@@ -0,0 +1,115 @@
+"""Add the change timestamps, the tombstones and their triggers.
+
+Revision ID: b5d2e8f1c479
+Revises: e4b7c1d9a356
+Create Date: 2026-10-18 17:40:12.664081
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5d2e8f1c479'
+down_revision = 'e4b7c1d9a356'
+branch_labels = None
+depends_on = None
+
+TABLES = ('movies', 'actors')
+
+# the triggers as of this revision, see changes.py
+NOW_SQL = {
+    'postgresql': "timezone('utc', statement_timestamp())",
+    'sqlite': "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+}
+
+
+def postgresql_triggers(table):
+    now = NOW_SQL['postgresql']
+    op.execute(
+        "CREATE OR REPLACE FUNCTION {table}_touch() RETURNS trigger "
+        "LANGUAGE plpgsql AS $$ BEGIN "
+        "NEW.updated_at := {now}; "
+        "IF TG_OP = 'INSERT' THEN NEW.created_at := NEW.updated_at; "
+        "ELSE NEW.created_at := OLD.created_at; END IF; "
+        "RETURN NEW; END $$".format(table=table, now=now))
+    op.execute(
+        "CREATE TRIGGER {table}_changes_touch "
+        "BEFORE INSERT OR UPDATE ON {table} "
+        "FOR EACH ROW EXECUTE PROCEDURE {table}_touch()".format(table=table))
+    op.execute(
+        "CREATE OR REPLACE FUNCTION {table}_tombstone() RETURNS trigger "
+        "LANGUAGE plpgsql AS $$ BEGIN "
+        "INSERT INTO tombstones (collection, id, deleted_at) "
+        "SELECT '{table}', id, {now} FROM old_rows "
+        "ON CONFLICT (collection, id) "
+        "DO UPDATE SET deleted_at = excluded.deleted_at; "
+        "RETURN NULL; END $$".format(table=table, now=now))
+    op.execute(
+        "CREATE TRIGGER {table}_changes_delete AFTER DELETE ON {table} "
+        "REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT "
+        "EXECUTE PROCEDURE {table}_tombstone()".format(table=table))
+
+
+def sqlite_triggers(table):
+    now = NOW_SQL['sqlite']
+    op.execute(
+        "CREATE TRIGGER {table}_changes_insert AFTER INSERT ON {table} "
+        "BEGIN UPDATE {table} SET created_at = {now}, updated_at = {now} "
+        "WHERE id = new.id; END".format(table=table, now=now))
+    op.execute(
+        "CREATE TRIGGER {table}_changes_update AFTER UPDATE ON {table} "
+        "WHEN new.updated_at IS old.updated_at BEGIN "
+        "UPDATE {table} SET updated_at = {now} WHERE id = new.id; "
+        "END".format(table=table, now=now))
+    op.execute(
+        "CREATE TRIGGER {table}_changes_delete AFTER DELETE ON {table} "
+        "BEGIN INSERT INTO tombstones (collection, id, deleted_at) "
+        "VALUES ('{table}', old.id, {now}) "
+        "ON CONFLICT (collection, id) "
+        "DO UPDATE SET deleted_at = excluded.deleted_at; "
+        "END".format(table=table, now=now))
+
+
+def upgrade():
+    op.create_table('tombstones',
+    sa.Column('collection', sa.String(), nullable=False),
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('collection', 'id')
+    )
+    op.create_index('ix_tombstones_collection_deleted_at_id', 'tombstones',
+                    ['collection', 'deleted_at', 'id'])
+    dialect = op.get_bind().dialect.name
+    for table in TABLES:
+        op.add_column(table, sa.Column('created_at', sa.DateTime()))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime()))
+        # the existing rows count as changed now, in the triggers' format
+        if dialect in NOW_SQL:
+            op.execute("UPDATE {table} SET created_at = {now}, "
+                       "updated_at = {now}".format(
+                           table=table, now=NOW_SQL[dialect]))
+        op.create_index('ix_%s_updated_at_id' % table, table,
+                        ['updated_at', 'id'])
+        if dialect == 'postgresql':
+            postgresql_triggers(table)
+        elif dialect == 'sqlite':
+            sqlite_triggers(table)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table in TABLES:
+        if dialect == 'postgresql':
+            op.execute('DROP TRIGGER %s_changes_touch ON %s' % (table, table))
+            op.execute('DROP TRIGGER %s_changes_delete ON %s'
+                       % (table, table))
+            op.execute('DROP FUNCTION %s_touch()' % table)
+            op.execute('DROP FUNCTION %s_tombstone()' % table)
+        elif dialect == 'sqlite':
+            for event in ('insert', 'update', 'delete'):
+                op.execute('DROP TRIGGER %s_changes_%s' % (table, event))
+        op.drop_index('ix_%s_updated_at_id' % table, table_name=table)
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'created_at')
+    op.drop_table('tombstones')
@@ -0,0 +1,135 @@
+"""Add the catalog statistics table and its triggers.
+
+Revision ID: c2f8a1e5d703
+Revises: a7e3d9c4b182
+Create Date: 2026-10-18 15:02:44.108357
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2f8a1e5d703'
+down_revision = 'a7e3d9c4b182'
+branch_labels = None
+depends_on = None
+
+# the statistics as of this revision, see stats.py
+STATS_DIMENSIONS = {
+    'movies': {
+        'genre': ('genre', "coalesce({row}.genre, '')")
+    },
+    'actors': {
+        'gender': ('gender', "coalesce({row}.gender, '')"),
+        'age': ('age', "coalesce(CAST({row}.age / 10 * 10 AS TEXT) || '-' || "
+                       "CAST({row}.age / 10 * 10 + 9 AS TEXT), '')")
+    }
+}
+
+UPSERT = (
+    "INSERT INTO catalog_stats (dimension, value, count) {values} "
+    "ON CONFLICT (dimension, value) "
+    "DO UPDATE SET count = catalog_stats.count + excluded.count")
+
+
+def stats_rows(table, row, source, delta):
+    selects = ["SELECT '%s' AS dimension, '' AS value, %s AS delta "
+               "FROM %s %s" % (table, delta, source, row)]
+    for dimension, (_, value) in STATS_DIMENSIONS[table].items():
+        selects.append("SELECT '%s.%s', %s, %s FROM %s %s" % (
+            table, dimension, value.format(row=row), delta, source, row))
+    return ' UNION ALL '.join(selects)
+
+
+def postgresql_triggers(table):
+    def changes(*sources):
+        return UPSERT.format(values=(
+            "SELECT dimension, value, sum(delta) FROM (%s) AS changes "
+            "GROUP BY dimension, value HAVING sum(delta) <> 0" % (
+                ' UNION ALL '.join(
+                    stats_rows(table, 'r', source, delta)
+                    for source, delta in sources))))
+
+    op.execute(
+        "CREATE OR REPLACE FUNCTION {table}_stats() RETURNS trigger "
+        "LANGUAGE plpgsql AS $$ BEGIN "
+        "IF TG_OP = 'INSERT' THEN {insert}; "
+        "ELSIF TG_OP = 'DELETE' THEN {delete}; "
+        "ELSE {update}; END IF; "
+        "RETURN NULL; END $$".format(
+            table=table,
+            insert=changes(('new_rows', 1)),
+            delete=changes(('old_rows', -1)),
+            update=changes(('new_rows', 1), ('old_rows', -1))))
+    for event, transitions in (
+            ('insert', 'NEW TABLE AS new_rows'),
+            ('update', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+            ('delete', 'OLD TABLE AS old_rows')):
+        op.execute(
+            "CREATE TRIGGER {table}_stats_{event} AFTER {event} ON {table} "
+            "REFERENCING {transitions} FOR EACH STATEMENT "
+            "EXECUTE PROCEDURE {table}_stats()".format(
+                table=table, event=event, transitions=transitions))
+
+
+def sqlite_triggers(table):
+    def upserts(row, delta, total=True):
+        statements = []
+        if total:
+            statements.append(UPSERT.format(
+                values="VALUES ('%s', '', %d)" % (table, delta)))
+        for dimension, (_, value) in STATS_DIMENSIONS[table].items():
+            statements.append(UPSERT.format(values="VALUES ('%s.%s', %s, %d)"
+                              % (table, dimension, value.format(row=row),
+                                 delta)))
+        return '; '.join(statements) + ';'
+
+    changed = ' OR '.join(
+        'old.{column} IS NOT new.{column}'.format(column=column)
+        for column, _ in STATS_DIMENSIONS[table].values())
+    op.execute(
+        "CREATE TRIGGER %s_stats_insert AFTER INSERT ON %s BEGIN %s END"
+        % (table, table, upserts('new', 1)))
+    op.execute(
+        "CREATE TRIGGER %s_stats_delete AFTER DELETE ON %s BEGIN %s END"
+        % (table, table, upserts('old', -1)))
+    op.execute(
+        "CREATE TRIGGER %s_stats_update AFTER UPDATE ON %s WHEN %s "
+        "BEGIN %s %s END" % (
+            table, table, changed, upserts('old', -1, total=False),
+            upserts('new', 1, total=False)))
+
+
+def upgrade():
+    op.create_table('catalog_stats',
+    sa.Column('dimension', sa.String(), nullable=False),
+    sa.Column('value', sa.String(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('dimension', 'value')
+    )
+    dialect = op.get_bind().dialect.name
+    for table in STATS_DIMENSIONS:
+        if dialect == 'postgresql':
+            postgresql_triggers(table)
+        elif dialect == 'sqlite':
+            sqlite_triggers(table)
+        # count the existing rows
+        op.execute(
+            "INSERT INTO catalog_stats (dimension, value, count) "
+            "SELECT dimension, value, sum(delta) FROM (%s) AS changes "
+            "GROUP BY dimension, value" % stats_rows(table, table, table, 1))
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table in STATS_DIMENSIONS:
+        for event in ('insert', 'update', 'delete'):
+            if dialect == 'postgresql':
+                op.execute('DROP TRIGGER %s_stats_%s ON %s'
+                           % (table, event, table))
+            elif dialect == 'sqlite':
+                op.execute('DROP TRIGGER %s_stats_%s' % (table, event))
+        if dialect == 'postgresql':
+            op.execute('DROP FUNCTION %s_stats()' % table)
+    op.drop_table('catalog_stats')
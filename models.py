@@ -1,27 +1,34 @@
 import os
 from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
 import json
 
+from dbpool import engine_options
+from replicas import RoutingSQLAlchemy
+from groupcommit import GroupCommitter
+from serialization import serializer
+
 
 database_path = os.environ['DATABASE_URL']
 if database_path.startswith("postgres://"):
     database_path = database_path.replace("postgres://", "postgresql://", 1)
 
-db = SQLAlchemy()
+# GET requests may read from a replica (see replicas.init_replicas)
+db = RoutingSQLAlchemy()
 
 """
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the engine is created on first use and the schema is left untouched,
+    run `python manage.py create_db` to create missing tables
 """
 
 
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
 
 
 '''
@@ -49,6 +56,361 @@ def db_drop_and_create_all():
     actor.insert()
 
 
+'''
+bulk_insert(model, rows)
+    inserts a list of column dicts in a single transaction and returns
+    the new ids in the same order
+    on databases supporting RETURNING the rows are sent as multi-row
+    INSERT ... VALUES ... RETURNING id statements of BULK_INSERT_BATCH_SIZE
+    rows, elsewhere one INSERT per row is issued before the single commit
+'''
+
+BULK_INSERT_BATCH_SIZE = 1000
+
+
+def bulk_insert(model, rows, batch_size=BULK_INSERT_BATCH_SIZE):
+    table = model.__table__
+    ids = []
+    try:
+        if db.engine.dialect.full_returning:
+            for start in range(0, len(rows), batch_size):
+                statement = table.insert().values(
+                    rows[start:start + batch_size]).returning(table.c.id)
+                ids.extend(db.session.execute(statement).scalars())
+        else:
+            for row in rows:
+                result = db.session.execute(table.insert().values(**row))
+                ids.append(result.inserted_primary_key[0])
+        bump_version(table.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+'''
+update_rows(model, criteria, values, columns)
+    runs UPDATE ... SET values WHERE criteria in a single transaction and
+    returns the requested columns of the updated rows (their id by
+    default), with RETURNING where the database supports it
+    elsewhere the matching ids are selected first and updated by primary
+    key in statements of BULK_INSERT_BATCH_SIZE ids
+'''
+
+
+def update_rows(model, criteria, values, columns=('id',),
+                batch_size=BULK_INSERT_BATCH_SIZE):
+    table = model.__table__
+    returning = [table.c[column] for column in columns]
+    try:
+        if db.engine.dialect.full_returning:
+            rows = db.session.execute(
+                table.update().where(*criteria).values(**values)
+                .returning(*returning)).all()
+        else:
+            ids = _matching_ids(table, criteria)
+            for start in range(0, len(ids), batch_size):
+                db.session.execute(
+                    table.update()
+                    .where(table.c.id.in_(ids[start:start + batch_size]))
+                    .values(**values))
+            rows = _select_by_ids(table, ids, returning, batch_size)
+        if rows:
+            bump_version(table.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return rows
+
+
+'''
+delete_rows(model, criteria)
+    runs DELETE ... WHERE criteria RETURNING id in a single transaction,
+    removing the rows from the casting table as well, and returns the
+    deleted ids
+    without RETURNING the matching ids are selected first and deleted by
+    primary key in statements of BULK_INSERT_BATCH_SIZE ids
+'''
+
+
+def delete_rows(model, criteria, batch_size=BULK_INSERT_BATCH_SIZE):
+    table = model.__table__
+    try:
+        # the casting rows go first, with a single set based statement,
+        # whether or not the database enforces the foreign keys
+        for relationship in model.__mapper__.relationships:
+            key = relationship.synchronize_pairs[0][1]
+            result = db.session.execute(
+                relationship.secondary.delete().where(key.in_(
+                    db.select(table.c.id).where(*criteria)
+                    .scalar_subquery())))
+            if result.rowcount:
+                bump_version(relationship.mapper.class_.__tablename__)
+
+        if db.engine.dialect.full_returning:
+            ids = db.session.execute(
+                table.delete().where(*criteria).returning(table.c.id)
+            ).scalars().all()
+        else:
+            ids = _matching_ids(table, criteria)
+            for start in range(0, len(ids), batch_size):
+                db.session.execute(table.delete().where(
+                    table.c.id.in_(ids[start:start + batch_size])))
+        if ids:
+            bump_version(table.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+def _matching_ids(table, criteria):
+    return db.session.execute(
+        db.select(table.c.id).where(*criteria).order_by(table.c.id)
+    ).scalars().all()
+
+
+def _select_by_ids(table, ids, columns, batch_size):
+    rows = []
+    for start in range(0, len(ids), batch_size):
+        rows.extend(db.session.execute(
+            db.select(*columns)
+            .where(table.c.id.in_(ids[start:start + batch_size]))
+            .order_by(table.c.id)))
+    return rows
+
+
+"""
+CollectionVersion
+    a counter per collection (table name) bumped in the same transaction
+    as every write, used to build the ETag of the collection GETs
+    it lives in the database so every worker sees the same version
+"""
+
+
+class CollectionVersion(db.Model):
+    __tablename__ = 'collection_versions'
+
+    name = db.Column(String, primary_key=True)
+    version = db.Column(Integer, nullable=False, default=0)
+
+
+"""
+ImportCheckpoint
+    how far the import of a file has gone (see importer.py), updated in
+    the transaction of every imported batch so an interrupted import
+    resumes right after the last committed row
+"""
+
+
+class ImportCheckpoint(db.Model):
+    __tablename__ = 'import_checkpoints'
+
+    # "<table>:<absolute path of the file>"
+    source = db.Column(String, primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    position = db.Column(Integer, nullable=False, default=0)
+    imported = db.Column(Integer, nullable=False, default=0)
+    rejected = db.Column(Integer, nullable=False, default=0)
+    done = db.Column(db.Boolean, nullable=False, default=False)
+
+
+"""
+Tombstone
+    the id of a deleted movie or actor and when it was deleted, written
+    by the database triggers of changes.py so the delta sync can report
+    deletions (re-deleting an id moves its deleted_at)
+"""
+
+
+class Tombstone(db.Model):
+    __tablename__ = 'tombstones'
+    # serves the changes since a token with a range scan per collection
+    __table_args__ = (
+        db.Index('ix_tombstones_collection_deleted_at_id',
+                 'collection', 'deleted_at', 'id'),
+    )
+
+    # the table name of the deleted row
+    collection = db.Column(String, primary_key=True)
+    id = db.Column(Integer, primary_key=True, autoincrement=False)
+    deleted_at = db.Column(db.DateTime, nullable=False)
+
+
+"""
+CatalogStat
+    a counter of the catalog statistics, e.g. the number of movies of a
+    genre, maintained by database triggers (see stats.py)
+"""
+
+
+class CatalogStat(db.Model):
+    __tablename__ = 'catalog_stats'
+
+    dimension = db.Column(String, primary_key=True)
+    value = db.Column(String, primary_key=True)
+    count = db.Column(Integer, nullable=False, default=0)
+
+
+'''
+bump_version(name, connection)
+    increments the version of a collection without committing, so the
+    bump is part of the caller's write transaction (of the session, or
+    of connection when given)
+'''
+
+
+def bump_version(name, connection=None):
+    execute = (db.session if connection is None else connection).execute
+    table = CollectionVersion.__table__
+    result = execute(
+        table.update()
+        .where(table.c.name == name)
+        .values(version=table.c.version + 1))
+    if result.rowcount == 0:
+        execute(table.insert().values(name=name, version=1))
+
+
+'''
+get_version(name)
+    returns the current version of a collection (0 before any write)
+'''
+
+
+def get_version(name):
+    table = CollectionVersion.__table__
+    version = db.session.execute(
+        db.select(table.c.version).where(table.c.name == name)).scalar()
+    return version or 0
+
+
+"""
+movie_actors
+    the casting of the actors in the movies (many to many)
+"""
+
+movie_actors = db.Table(
+    'movie_actors',
+    db.Column('movie_id', Integer,
+              db.ForeignKey('movies.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('actor_id', Integer,
+              db.ForeignKey('actors.id', ondelete='CASCADE'),
+              primary_key=True),
+    # the primary key serves the lookups by movie
+    db.Index('ix_movie_actors_actor_id', 'actor_id')
+)
+
+
+# merges the concurrent single row writes of the models when enabled
+group_committer = GroupCommitter(lambda: db.engine, bump_version)
+
+'''
+group_write(instance, work, *collections)
+    runs work(connection) in the next group commit on behalf of instance,
+    bumping the versions of collections, and returns its result
+    the instance leaves the caller's session, whose transaction is ended
+    first so it holds no lock the batch would wait for
+
+_insert_work(instance) / _update_work(instance) / _delete_work(instance)
+    the Core statements of the single row writes of an instance
+'''
+
+
+def group_write(instance, work, *collections):
+    if instance in db.session:
+        db.session.expunge(instance)
+    db.session.commit()
+    return group_committer.submit(work, collections)
+
+
+def _row_values(instance):
+    return {field: getattr(instance, field)
+            for field in instance.FIELDS if field != 'id'}
+
+
+def _insert_work(instance):
+    statement = instance.__table__.insert().values(**_row_values(instance))
+    return lambda connection: \
+        connection.execute(statement).inserted_primary_key[0]
+
+
+def _update_work(instance):
+    table = instance.__table__
+    statement = table.update().where(table.c.id == instance.id) \
+        .values(**_row_values(instance))
+    return lambda connection: connection.execute(statement)
+
+
+def _delete_work(instance):
+    table = instance.__table__
+    statements = []
+    # the casting rows go first, as in delete_rows
+    for relationship in instance.__mapper__.relationships:
+        key = relationship.synchronize_pairs[0][1]
+        statements.append(
+            relationship.secondary.delete().where(key == instance.id))
+    statements.append(table.delete().where(table.c.id == instance.id))
+
+    def work(connection):
+        for statement in statements:
+            connection.execute(statement)
+    return work
+
+
+'''
+update_row(model, id, values, columns) / delete_row(model, id)
+    update_rows and delete_rows of the single row routes (PATCH and
+    DELETE /movies/<id>), run in the next group commit when it is enabled
+    the work records the collections it changed, the committer bumps
+    them once the whole batch ran
+'''
+
+
+def update_row(model, id, values, columns=('id',)):
+    table = model.__table__
+    if not group_committer.enabled:
+        return update_rows(model, [table.c.id == id], values, columns)
+    collections = []
+
+    def work(connection):
+        # a batch run again after a failing write starts over
+        del collections[:]
+        if connection.execute(table.update().where(table.c.id == id)
+                              .values(**values)).rowcount:
+            collections.append(table.name)
+        return connection.execute(
+            db.select(*[table.c[column] for column in columns])
+            .where(table.c.id == id)).all()
+    db.session.commit()
+    return group_committer.submit(work, collections)
+
+
+def delete_row(model, id):
+    table = model.__table__
+    if not group_committer.enabled:
+        return delete_rows(model, [table.c.id == id])
+    collections = []
+
+    def work(connection):
+        del collections[:]
+        for relationship in model.__mapper__.relationships:
+            key = relationship.synchronize_pairs[0][1]
+            if connection.execute(relationship.secondary.delete()
+                                  .where(key == id)).rowcount:
+                collections.append(relationship.mapper.class_.__tablename__)
+        if connection.execute(table.delete().where(table.c.id == id)) \
+                .rowcount:
+            collections.append(table.name)
+            return [id]
+        return []
+    db.session.commit()
+    return group_committer.submit(work, collections)
+
+
 """
 Movie
 """
@@ -56,36 +418,73 @@ Movie
 
 class Movie(db.Model):
     __tablename__ = 'movies'
+    # columns clients may select with ?fields=
+    FIELDS = ('id', 'name', 'genre')
+    # columns matched by /movies/search
+    SEARCHABLE = ('name', 'genre')
+    # list filters: query parameter -> (column, comparison)
+    FILTERS = {
+        'genre': ('genre', 'eq')
+    }
+    # relationships clients may embed with ?include=
+    INCLUDES = ('actors',)
+    # indexes serving the list filters and sorts, keyed on id last so
+    # the keyset pages are read in index order
+    __table_args__ = (
+        db.Index('ix_movies_genre_id', 'genre', 'id'),
+        db.Index('ix_movies_name_id', 'name', 'id'),
+        db.Index('ix_movies_updated_at_id', 'updated_at', 'id')
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(String)
     genre = db.Column(String)
+    # UTC, set by the database triggers of changes.py on every write
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    actors = db.relationship(
+        'Actor', secondary=movie_actors, back_populates='movies',
+        order_by='Actor.id')
 
-    def format(self):
-        return{
-            'id': self.id,
-            'name': self.name,
-            'genre': self.genre
-        }
+    # precompiled {'id': self.id, 'name': self.name, 'genre': self.genre}
+    format = serializer(FIELDS)
 
     '''
     insert()
     '''
     def insert(self):
+        if group_committer.enabled:
+            self.id = group_write(
+                self, _insert_work(self), self.__tablename__)
+            return
         db.session.add(self)
+        bump_version(self.__tablename__)
         db.session.commit()
 
     '''
     update()
     '''
     def update(self):
+        if group_committer.enabled:
+            group_write(self, _update_work(self), self.__tablename__)
+            return
+        bump_version(self.__tablename__)
         db.session.commit()
 
     '''
     delete()
     '''
     def delete(self):
+        collections = [self.__tablename__]
+        # the actors embedding this movie change too
+        if self.actors:
+            collections.append(Actor.__tablename__)
+        if group_committer.enabled:
+            group_write(self, _delete_work(self), *collections)
+            return
         db.session.delete(self)
+        for name in collections:
+            bump_version(name)
         db.session.commit()
 
 
@@ -96,25 +495,52 @@ Actor
 
 class Actor(db.Model):
     __tablename__ = 'actors'
+    # columns clients may select with ?fields=
+    FIELDS = ('id', 'name', 'experience_level', 'gender', 'age')
+    # columns matched by /actors/search
+    SEARCHABLE = ('name',)
+    # relationships clients may embed with ?include=
+    INCLUDES = ('movies',)
+    # list filters: query parameter -> (column, comparison)
+    FILTERS = {
+        'gender': ('gender', 'eq'),
+        'experience_level': ('experience_level', 'eq'),
+        'age_min': ('age', 'ge'),
+        'age_max': ('age', 'le')
+    }
+    # indexes serving the list filters and sorts, keyed on id last so
+    # the keyset pages are read in index order
+    __table_args__ = (
+        db.Index('ix_actors_gender_age', 'gender', 'age'),
+        db.Index('ix_actors_experience_level_id', 'experience_level', 'id'),
+        db.Index('ix_actors_age_id', 'age', 'id'),
+        db.Index('ix_actors_name_id', 'name', 'id'),
+        db.Index('ix_actors_updated_at_id', 'updated_at', 'id')
+    )
 
     id = db.Column(Integer, primary_key=True)
     name = db.Column(String)
     experience_level = db.Column(String)
     gender = db.Column(String)
     age = db.Column(Integer)
+    # UTC, set by the database triggers of changes.py on every write
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    movies = db.relationship(
+        'Movie', secondary=movie_actors, back_populates='actors',
+        order_by='Movie.id')
 
-    def format(self):
-        return{
-            'name': self.name,
-            'id': self.id,
-            'experience_level': self.experience_level,
-            'gender': self.gender,
-            'age': self.age
-        }
+    # precompiled {'id': self.id, 'name': self.name, ...} of the FIELDS
+    format = serializer(FIELDS)
 
     '''
     insert()
     '''
     def insert(self):
+        if group_committer.enabled:
+            self.id = group_write(
+                self, _insert_work(self), self.__tablename__)
+            return
         db.session.add(self)
+        bump_version(self.__tablename__)
         db.session.commit()
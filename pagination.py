@@ -0,0 +1,241 @@
+import json
+import base64
+from flask import abort
+from sqlalchemy import and_, false, or_, select
+
+from models import db
+from includes import load_included
+from serialization import row_serializer
+
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+'''
+encode_cursor(values) / decode_cursor(cursor)
+    converts the keyset values of the last row of a page to an opaque,
+    url safe cursor and back
+'''
+
+
+def encode_cursor(values):
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    padding = '=' * (-len(cursor) % 4)
+    values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    if not isinstance(values, list):
+        raise ValueError('cursor must encode a list')
+    return values
+
+
+'''
+get_limit(args)
+    reads and validates the limit query parameter, capped to
+    MAX_PAGE_LIMIT, aborts with 400 on invalid values
+'''
+
+
+def get_limit(args):
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_LIMIT))
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, MAX_PAGE_LIMIT)
+
+
+'''
+get_page_args(args, model, sort)
+    reads and validates the limit and after query parameters,
+    aborts with 400 on invalid values
+    the cursor holds the value of every sort key (see sort_keys), each
+    of the type of its column or None when the column is nullable
+'''
+
+
+def get_page_args(args, model, sort=()):
+    limit = get_limit(args)
+
+    after = args.get('after')
+    if after is not None:
+        try:
+            after = decode_cursor(after)
+        except Exception:
+            abort(400)
+        names = [name for name, descending in sort_keys(sort)]
+        if len(after) != len(names):
+            abort(400)
+        for name, value in zip(names, after):
+            column = model.__table__.c[name]
+            if value is None:
+                if not column.nullable:
+                    abort(400)
+            # JSON true and false decode to bool, a subclass of int
+            elif isinstance(value, bool) or \
+                    not isinstance(value, column.type.python_type):
+                abort(400)
+    return limit, after
+
+
+'''
+get_fields(args, model)
+    reads the fields query parameter and checks it against the model's
+    FIELDS allow-list, aborts with 400 on unknown fields
+    returns every allowed field when the parameter is missing
+'''
+
+
+def get_fields(args, model):
+    fields = args.get('fields')
+    if fields is None:
+        return list(model.FIELDS)
+
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    if not fields or any(field not in model.FIELDS for field in fields):
+        abort(400)
+    # drop duplicates but keep the requested order
+    return list(dict.fromkeys(fields))
+
+
+'''
+select_fields(model, fields, keys)
+    builds a Core select of only the requested columns (plus the columns
+    of the keyset, the id by default), so no mapped instances are loaded
+'''
+
+
+def select_fields(model, fields, keys=('id',)):
+    table = model.__table__
+    columns = [table.c[field] for field in fields]
+    columns += [table.c[key] for key in keys if key not in fields]
+    return select(*columns)
+
+
+'''
+row_to_dict(fields, row)
+    builds the response dict of a row returned by select_fields
+    loops should get the precompiled row_serializer(fields) once instead
+'''
+
+
+def row_to_dict(fields, row):
+    return row_serializer(tuple(fields))(row)
+
+
+'''
+sort_keys(sort)
+    the keyset of a sort: the requested (column, descending) pairs
+    followed by the id, which makes every key unique
+'''
+
+
+def sort_keys(sort=()):
+    keys = list(sort)
+    if 'id' not in [name for name, descending in keys]:
+        keys.append(('id', False))
+    return keys
+
+
+'''
+nulls_largest(dialect)
+    whether NULLs sort after every value on ascending order, as on
+    Postgres; SQLite and MySQL put them first
+    ORDER BY is left in the native order so the indexes can serve it and
+    the keyset predicate follows that order instead
+'''
+
+
+def nulls_largest(dialect):
+    return dialect.name in ('postgresql', 'oracle')
+
+
+def _after_key(column, value, descending, nulls_are_largest):
+    # rows sorted strictly after value on this key
+    if value is None:
+        if nulls_are_largest != descending:
+            return false()
+        return column.isnot(None)
+    after = column < value if descending else column > value
+    if nulls_are_largest != descending:
+        return or_(after, column.is_(None))
+    return after
+
+
+def _same_key(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+'''
+list_statement(model, fields, filters, sort)
+    selects the model's fields matching every filter criterion, ordered
+    by the keyset of the sort
+
+page_statement(model, fields, limit, after, filters, sort, dialect)
+    selects one page of it, following the rows of the after cursor with a
+    keyset predicate (WHERE id > :cursor ORDER BY id LIMIT n for the
+    default sort) instead of OFFSET
+
+build_page(fields, rows, limit, sort)
+    turns the fetched rows into the page and the cursor of the next page
+    (None on the last page)
+'''
+
+
+def list_statement(model, fields, filters=(), sort=()):
+    table = model.__table__
+    keys = sort_keys(sort)
+    statement = select_fields(model, fields, [name for name, _ in keys])
+    order = [table.c[name].desc() if descending else table.c[name]
+             for name, descending in keys]
+    return statement.where(*filters).order_by(*order)
+
+
+def page_statement(model, fields, limit, after=None, filters=(), sort=(),
+                   dialect=None):
+    table = model.__table__
+    statement = list_statement(model, fields, filters, sort)
+    if after is not None:
+        nulls_are_largest = dialect is not None and nulls_largest(dialect)
+        keys = sort_keys(sort)
+        # (a > x) OR (a = x AND b > y) OR (a = x AND b = y AND id > z)...
+        clauses = []
+        for i, (name, descending) in enumerate(keys):
+            clauses.append(and_(*[
+                _same_key(table.c[previous], value)
+                for (previous, _), value in zip(keys[:i], after)
+            ], _after_key(
+                table.c[name], after[i], descending, nulls_are_largest)))
+        statement = statement.where(or_(*clauses))
+    # fetch one extra row to know whether there is a next page
+    return statement.limit(limit + 1)
+
+
+def build_page(fields, rows, limit, sort=()):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([
+            rows[-1]._mapping[name] for name, _ in sort_keys(sort)])
+    serialize = row_serializer(tuple(fields))
+    return [serialize(row) for row in rows], next_cursor
+
+
+'''
+paginate(model, fields, limit, after, filters, sort, include)
+    returns one page of the model's fields and the cursor of the next page
+    the included relationships are loaded with one query each
+'''
+
+
+def paginate(model, fields, limit, after=None, filters=(), sort=(),
+             include=()):
+    rows = db.session.execute(page_statement(
+        model, fields, limit, after, filters, sort, db.engine.dialect)).all()
+    items, next_cursor = build_page(fields, rows, limit, sort)
+    if include:
+        load_included(
+            model, include, items, [row.id for row in rows[:limit]])
+    return items, next_cursor
@@ -0,0 +1,223 @@
+import os
+import math
+import time
+import random
+import threading
+from flask import g, request, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm, text
+
+from dbpool import engine_options
+from metrics import registry
+
+'''
+Read replica settings, read from the environment
+Without DATABASE_REPLICA_URLS every query goes to DATABASE_URL.
+'''
+
+DATABASE_REPLICA_URLS = [
+    url.strip().replace('postgres://', 'postgresql://', 1)
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url.strip()
+]
+# replicas further behind the primary (seconds) are not read from
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))
+# seconds between two health and lag checks of the replicas
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 5))
+# seconds a client reads from the primary after one of its writes
+READ_YOUR_WRITES_WINDOW = float(
+    os.environ.get('READ_YOUR_WRITES_WINDOW', 10))
+
+# cookie and header holding the end of a client's primary window, the
+# header is for clients which do not keep cookies
+PRIMARY_COOKIE = 'read_primary_until'
+PRIMARY_HEADER = 'X-Read-Primary-Until'
+
+READ_METHODS = ('GET', 'HEAD')
+# the methods which change data and start a client's primary window
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# seconds since the last transaction replayed by a Postgres standby,
+# 0 when it has replayed everything it received or is not a standby
+_POSTGRES_LAG = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE coalesce(extract(epoch FROM now() - "
+    "pg_last_xact_replay_timestamp()), 0) END")
+
+
+class Replica:
+    """A read replica engine with its last known health and lag"""
+
+    def __init__(self, url):
+        self.engine = create_engine(url, **engine_options(url))
+        self.healthy = True
+        self.lag = 0.0
+
+    def check(self):
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name == 'postgresql':
+                    self.lag = float(
+                        connection.execute(text(_POSTGRES_LAG)).scalar())
+                else:
+                    connection.execute(text('SELECT 1'))
+                    self.lag = 0.0
+            self.healthy = True
+        except Exception as e:
+            print(e)
+            self.healthy = False
+
+    def status(self):
+        return {
+            'url': self.engine.url.render_as_string(hide_password=True),
+            'healthy': self.healthy,
+            'lag_seconds': self.lag
+        }
+
+
+class ReplicaSet:
+    """The read replicas of the primary database.
+
+    pick() returns the engine of a healthy replica whose lag is within
+    max_lag, or None when there is none. Health and lag are checked again
+    at most every check_interval seconds, in a background thread started
+    by the request which finds them out of date: a replica which is down
+    never holds a request for a connect timeout, the requests keep using
+    the last known state until the check is done.
+    """
+
+    def __init__(self, urls=DATABASE_REPLICA_URLS, max_lag=REPLICA_MAX_LAG,
+                 check_interval=REPLICA_CHECK_INTERVAL):
+        self.replicas = [Replica(url) for url in urls]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        for replica in self.replicas:
+            replica.check()
+        self.checked_at = time.monotonic()
+
+    def pick(self):
+        if not self.replicas:
+            return None
+        if (self.checked_at is None or time.monotonic() - self.checked_at >=
+                self.check_interval) and self._lock.acquire(blocking=False):
+            self._check_in_background()
+        candidates = [replica for replica in self.replicas
+                      if replica.healthy and replica.lag <= self.max_lag]
+        if not candidates:
+            return None
+        return random.choice(candidates).engine
+
+    def _check_in_background(self):
+        # the caller holds the lock, released once the check is done
+        def run():
+            try:
+                self.check()
+            finally:
+                self._lock.release()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+    def status(self):
+        return [replica.status() for replica in self.replicas]
+
+
+replica_set = ReplicaSet()
+
+
+class RoutingSession(SignallingSession):
+    """Session sending the queries of a request to the replica chosen for
+    it (g.db_replica), everything else to the primary; flushes always go
+    to the primary"""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if has_app_context() and not self._flushing:
+            replica = g.get('db_replica')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """flask_sqlalchemy.SQLAlchemy whose sessions are RoutingSessions"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+'''
+reads_from_primary()
+    whether the client wrote less than READ_YOUR_WRITES_WINDOW seconds
+    ago, according to the cookie or header set on its last write (values
+    further in the future than the window are ignored)
+'''
+
+
+def reads_from_primary():
+    until = request.cookies.get(PRIMARY_COOKIE) or \
+        request.headers.get(PRIMARY_HEADER)
+    if until is None:
+        return False
+    try:
+        until = float(until)
+    except ValueError:
+        return False
+    now = time.time()
+    return now < until <= now + READ_YOUR_WRITES_WINDOW
+
+
+'''
+start_primary_window(response)
+    sets the cookie and header sending the client's reads to the primary
+    for READ_YOUR_WRITES_WINDOW seconds, after a successful write; takes
+    the Flask app's responses and the Starlette ones of asgi.py
+'''
+
+
+def start_primary_window(response):
+    if not replica_set.replicas:
+        return
+    until = '%.3f' % (time.time() + READ_YOUR_WRITES_WINDOW)
+    response.set_cookie(
+        PRIMARY_COOKIE, until, max_age=math.ceil(READ_YOUR_WRITES_WINDOW),
+        httponly=True, samesite='Lax')
+    response.headers[PRIMARY_HEADER] = until
+
+
+'''
+init_replicas(app)
+    routes the reads (GET) of the app to a replica unless the client
+    wrote recently, and starts the primary window of the clients writing
+'''
+
+
+def init_replicas(app):
+    @app.before_request
+    def route_reads():
+        if not replica_set.replicas or request.method not in READ_METHODS:
+            return
+        if reads_from_primary():
+            registry.inc('db_read_routing_total', target='primary',
+                         reason='recent_write')
+            return
+        replica = replica_set.pick()
+        if replica is None:
+            registry.inc('db_read_routing_total', target='primary',
+                         reason='no_replica')
+            return
+        registry.inc('db_read_routing_total', target='replica')
+        g.db_replica = replica
+
+    @app.after_request
+    def stick_to_primary(response):
+        if request.method in WRITE_METHODS and response.status_code < 400:
+            start_primary_window(response)
+        return response
@@ -0,0 +1,194 @@
+from flask import abort
+from sqlalchemy import (
+    DDL,
+    and_,
+    cast,
+    column,
+    event,
+    func,
+    literal_column,
+    or_,
+    table as table_clause
+)
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+
+from models import db, Movie, Actor
+from pagination import (
+    encode_cursor,
+    decode_cursor,
+    get_limit,
+    select_fields
+)
+from serialization import row_serializer
+
+# text search configuration of the Postgres indexes, 'simple' does no
+# stemming which suits titles and names
+SEARCH_CONFIG = 'simple'
+
+'''
+search_document(model)
+    the SQL expression indexed for the model's SEARCHABLE columns on
+    Postgres, the same text has to be used by the index and the queries
+    for the planner to pick the index
+'''
+
+
+def search_document(model):
+    columns = " || ' ' || ".join(
+        "coalesce(%s, '')" % name for name in model.SEARCHABLE)
+    return "to_tsvector('%s', %s)" % (SEARCH_CONFIG, columns)
+
+
+'''
+search_ddl(model)
+    the statements creating the text index of a model's table:
+    a GIN index on search_document() on Postgres, an external content FTS5
+    table kept in sync by triggers on SQLite
+'''
+
+
+def search_ddl(model):
+    table = model.__tablename__
+    columns = ', '.join(model.SEARCHABLE)
+    new_values = ', '.join('new.%s' % name for name in model.SEARCHABLE)
+    old_values = ', '.join('old.%s' % name for name in model.SEARCHABLE)
+    fts_delete = (
+        "INSERT INTO {table}_fts({table}_fts, rowid, {columns}) "
+        "VALUES ('delete', old.id, {old_values});")
+    fts_insert = (
+        "INSERT INTO {table}_fts(rowid, {columns}) "
+        "VALUES (new.id, {new_values});")
+    # only when an indexed column changed: the change tracking triggers
+    # (see changes.py) update the row they just inserted, before it is in
+    # the index, and FTS5 breaks on the delete of a row it does not have
+    changed = ' OR '.join(
+        'old.%s IS NOT new.%s' % (name, name) for name in model.SEARCHABLE)
+    sqlite = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5("
+        "{columns}, content='{table}', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS {table}_fts_insert "
+        "AFTER INSERT ON {table} BEGIN " + fts_insert + " END",
+        "CREATE TRIGGER IF NOT EXISTS {table}_fts_delete "
+        "AFTER DELETE ON {table} BEGIN " + fts_delete + " END",
+        "CREATE TRIGGER IF NOT EXISTS {table}_fts_update "
+        "AFTER UPDATE ON {table} WHEN {changed} BEGIN " + fts_delete +
+        " " + fts_insert + " END",
+        # index the rows inserted before the FTS table existed
+        "INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')"
+    ]
+    postgresql = [
+        "CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} "
+        "USING gin ({document})"
+    ]
+    values = dict(table=table, columns=columns, new_values=new_values,
+                  old_values=old_values, changed=changed,
+                  document=search_document(model))
+    return {
+        'sqlite': [statement.format(**values) for statement in sqlite],
+        'postgresql': [statement.format(**values) for statement in postgresql]
+    }
+
+
+# create the text indexes along with the tables on create_all
+for _model in (Movie, Actor):
+    for _dialect, _statements in search_ddl(_model).items():
+        for _statement in _statements:
+            event.listen(_model.__table__, 'after_create',
+                         DDL(_statement).execute_if(dialect=_dialect))
+    event.listen(
+        _model.__table__, 'before_drop',
+        DDL('DROP TABLE IF EXISTS %s_fts' % _model.__tablename__)
+        .execute_if(dialect='sqlite'))
+
+
+'''
+fts5_query(q)
+    quotes every word of the user input so FTS5 reads it as plain terms
+    (all of them must match) instead of its query syntax
+'''
+
+
+def fts5_query(q):
+    return ' '.join('"%s"' % word.replace('"', '""') for word in q.split())
+
+
+'''
+search_statement(model, fields, q, limit, after, dialect)
+    selects one page of the rows matching q, best match first
+    the score is ts_rank on Postgres and the negated bm25 rank of FTS5
+    on SQLite (higher is better for both); pages are keyset paginated on
+    (score, id) so deep pages cost the same as the first one
+    ts_rank returns a real, it is widened to double precision so the
+    score of the cursor compares equal to the one of its row
+'''
+
+
+def search_statement(model, fields, q, limit, after=None, dialect=None):
+    table = model.__table__
+    statement = select_fields(model, fields)
+    dialect = dialect or db.engine.dialect
+    if dialect.name == 'sqlite':
+        fts = table_clause(
+            '%s_fts' % table.name, column('rowid'), column('rank'))
+        score = (-fts.c.rank).label('score')
+        statement = statement.add_columns(score) \
+            .select_from(table.join(fts, table.c.id == fts.c.rowid)) \
+            .where(literal_column(fts.name).op('MATCH')(fts5_query(q)))
+    else:
+        document = literal_column(search_document(model))
+        query = func.plainto_tsquery(
+            literal_column("'%s'" % SEARCH_CONFIG), q)
+        score = cast(func.ts_rank(document, query),
+                     DOUBLE_PRECISION).label('score')
+        statement = statement.add_columns(score).where(
+            document.op('@@')(query))
+
+    if after is not None:
+        statement = statement.where(or_(
+            score < after[0], and_(score == after[0], table.c.id > after[1])))
+    # fetch one extra row to know whether there is a next page
+    return statement.order_by(score.desc(), table.c.id).limit(limit + 1)
+
+
+'''
+get_search_args(args)
+    reads the q, limit and after query parameters of a search, aborts with
+    400 when q is missing or blank or when a value is invalid
+'''
+
+
+def get_search_args(args):
+    q = args.get('q', '').strip()
+    if not q:
+        abort(400)
+    limit = get_limit(args)
+
+    after = args.get('after')
+    if after is not None:
+        try:
+            after = decode_cursor(after)
+        except Exception:
+            abort(400)
+        if len(after) != 2 or not isinstance(after[0], (int, float)) or \
+                not isinstance(after[1], int) or \
+                any(isinstance(value, bool) for value in after):
+            abort(400)
+    return q, limit, after
+
+
+'''
+search(model, fields, q, limit, after)
+    returns one ranked page of the model's fields matching q and the
+    cursor of the next page (None on the last page)
+'''
+
+
+def search(model, fields, q, limit, after=None):
+    rows = db.session.execute(
+        search_statement(model, fields, q, limit, after)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1].score, rows[-1].id])
+    serialize = row_serializer(tuple(fields))
+    return [serialize(row) for row in rows], next_cursor
@@ -0,0 +1,128 @@
+import os
+import json
+import uuid
+import decimal
+import datetime
+from functools import lru_cache
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used without it
+    orjson = None
+
+# json encoder of the responses: auto (orjson when it is installed),
+# orjson or json (the standard library)
+JSON_ENCODER = os.environ.get('JSON_ENCODER', 'auto')
+
+'''
+default(value)
+    converts the values the encoders do not know natively, the same way
+    for both encoders (orjson already writes dates as ISO 8601)
+'''
+
+
+def default(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    raise TypeError('%r is not JSON serializable' % type(value).__name__)
+
+
+def _stdlib_dumps(value, sort_keys=False, indent=False):
+    if indent:
+        text = json.dumps(value, default=default, sort_keys=sort_keys,
+                          indent=2, separators=(', ', ': '))
+    else:
+        text = json.dumps(value, default=default, sort_keys=sort_keys,
+                          separators=(',', ':'))
+    return text.encode('utf-8')
+
+
+def _orjson_dumps(value, sort_keys=False, indent=False):
+    option = orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(value, default=default, option=option)
+
+
+ENCODERS = {'json': _stdlib_dumps}
+if orjson is not None:
+    ENCODERS['orjson'] = _orjson_dumps
+
+'''
+get_encoder(name)
+    returns the dumps(value, sort_keys, indent) -> bytes function of an
+    encoder, auto picks the fastest one installed
+'''
+
+
+def get_encoder(name=JSON_ENCODER):
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in ENCODERS else 'json'
+    if name not in ENCODERS:
+        raise ValueError('unknown or missing JSON encoder: %s' % name)
+    return ENCODERS[name]
+
+
+dumps = get_encoder()
+
+'''
+jsonify(*args, **kwargs)
+    a drop-in replacement of flask.jsonify encoding with dumps
+    keys are sorted when JSON_SORT_KEYS is set and the output is only
+    indented when JSONIFY_PRETTYPRINT_REGULAR is set or in debug mode
+'''
+
+
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError(
+            'jsonify() behavior undefined when passed both args and kwargs')
+    elif len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+
+    config = current_app.config
+    body = dumps(
+        data, sort_keys=config['JSON_SORT_KEYS'],
+        indent=config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug)
+    return current_app.response_class(
+        body + b'\n', mimetype=config['JSONIFY_MIMETYPE'])
+
+
+def _check_fields(fields):
+    # the names are compiled into code, only accept identifiers
+    if not all(isinstance(field, str) and field.isidentifier()
+               for field in fields):
+        raise ValueError('invalid field names: %r' % (fields,))
+
+
+'''
+serializer(fields) / row_serializer(fields)
+    compile (once per list of fields) a function building the response
+    dict of an object from its attributes, or of a row from its columns
+    in the order of fields, e.g. for ('id', 'name'):
+        lambda obj: {'id': obj.id, 'name': obj.name}
+    a dict display is what a hand-written format() does, and is faster
+    than building the dict from getters or from zip()
+'''
+
+
+@lru_cache(maxsize=None)
+def serializer(fields):
+    _check_fields(fields)
+    items = ', '.join('%r: obj.%s' % (field, field) for field in fields)
+    return eval('lambda obj: {%s}' % items)
+
+
+@lru_cache(maxsize=None)
+def row_serializer(fields):
+    _check_fields(fields)
+    items = ', '.join(
+        '%r: row[%d]' % (field, index) for index, field in enumerate(fields))
+    return eval('lambda row: {%s}' % items)
@@ -0,0 +1,178 @@
+from sqlalchemy import DDL, event
+
+from models import db, Movie, Actor, CatalogStat
+
+'''
+The catalog statistics are counts kept in the catalog_stats table, one
+row per (dimension, value): the number of movies and actors, and their
+split by genre, gender and age decade. Database triggers maintain them in
+the same transaction as every write to movies and actors, whichever code
+path issues it (ORM, set based statements, the async app or a bulk
+load), so reading them costs the same at any catalog size.
+'''
+
+# dimension -> (column, SQL of the counted value of the row alias {row})
+STATS_DIMENSIONS = {
+    'movies': {
+        'genre': ('genre', "coalesce({row}.genre, '')")
+    },
+    'actors': {
+        'gender': ('gender', "coalesce({row}.gender, '')"),
+        'age': ('age', "coalesce(CAST({row}.age / 10 * 10 AS TEXT) || '-' || "
+                       "CAST({row}.age / 10 * 10 + 9 AS TEXT), '')")
+    }
+}
+
+# value reported for rows without one (NULL columns)
+UNKNOWN = 'unknown'
+
+_UPSERT = (
+    "INSERT INTO catalog_stats (dimension, value, count) {values} "
+    "ON CONFLICT (dimension, value) "
+    "DO UPDATE SET count = catalog_stats.count + excluded.count")
+
+'''
+stats_rows(table, row, source, delta)
+    selects (dimension, value, delta) for every counter touched by the
+    rows of source, aliased as row
+'''
+
+
+def stats_rows(table, row, source, delta):
+    selects = ["SELECT '%s' AS dimension, '' AS value, %s AS delta "
+               "FROM %s %s" % (table, delta, source, row)]
+    for dimension, (_, value) in STATS_DIMENSIONS[table].items():
+        selects.append("SELECT '%s.%s', %s, %s FROM %s %s" % (
+            table, dimension, value.format(row=row), delta, source, row))
+    return ' UNION ALL '.join(selects)
+
+
+'''
+stats_ddl(table)
+    the statements creating the triggers of a table
+    Postgres uses statement level triggers over the transition tables, so
+    a set based write updates each counter once; the +1 / -1 of the new
+    and old rows of an UPDATE are summed first and the counters that did
+    not change are not written at all
+    SQLite only has row level triggers, each upserting its counters
+'''
+
+
+def stats_ddl(table):
+    def changes(*sources):
+        return _UPSERT.format(values=(
+            "SELECT dimension, value, sum(delta) FROM (%s) AS changes "
+            "GROUP BY dimension, value HAVING sum(delta) <> 0" % (
+                ' UNION ALL '.join(
+                    stats_rows(table, 'r', source, delta)
+                    for source, delta in sources))))
+
+    function = (
+        "CREATE OR REPLACE FUNCTION {table}_stats() RETURNS trigger "
+        "LANGUAGE plpgsql AS $$ BEGIN "
+        "IF TG_OP = 'INSERT' THEN {insert}; "
+        "ELSIF TG_OP = 'DELETE' THEN {delete}; "
+        "ELSE {update}; END IF; "
+        "RETURN NULL; END $$").format(
+            table=table,
+            insert=changes(('new_rows', 1)),
+            delete=changes(('old_rows', -1)),
+            update=changes(('new_rows', 1), ('old_rows', -1)))
+    postgresql = [function] + [
+        "CREATE TRIGGER {table}_stats_{event} AFTER {event} ON {table} "
+        "REFERENCING {transitions} FOR EACH STATEMENT "
+        "EXECUTE PROCEDURE {table}_stats()".format(
+            table=table, event=event, transitions=transitions)
+        for event, transitions in (
+            ('insert', 'NEW TABLE AS new_rows'),
+            ('update', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+            ('delete', 'OLD TABLE AS old_rows'))
+    ]
+
+    def upserts(row, delta, total=True):
+        statements = []
+        if total:
+            statements.append(_UPSERT.format(
+                values="VALUES ('%s', '', %d)" % (table, delta)))
+        for dimension, (_, value) in STATS_DIMENSIONS[table].items():
+            statements.append(_UPSERT.format(values="VALUES ('%s.%s', %s, %d)"
+                              % (table, dimension, value.format(row=row),
+                                 delta)))
+        return '; '.join(statements) + ';'
+
+    changed = ' OR '.join(
+        'old.{column} IS NOT new.{column}'.format(column=column)
+        for column, _ in STATS_DIMENSIONS[table].values())
+    sqlite = [
+        "CREATE TRIGGER IF NOT EXISTS %s_stats_insert AFTER INSERT ON %s "
+        "BEGIN %s END" % (table, table, upserts('new', 1)),
+        "CREATE TRIGGER IF NOT EXISTS %s_stats_delete AFTER DELETE ON %s "
+        "BEGIN %s END" % (table, table, upserts('old', -1)),
+        "CREATE TRIGGER IF NOT EXISTS %s_stats_update AFTER UPDATE ON %s "
+        "WHEN %s BEGIN %s %s END" % (
+            table, table, changed, upserts('old', -1, total=False),
+            upserts('new', 1, total=False))
+    ]
+    return {'postgresql': postgresql, 'sqlite': sqlite}
+
+
+# create the triggers along with the tables on create_all
+for _model in (Movie, Actor):
+    for _dialect, _statements in stats_ddl(_model.__tablename__).items():
+        for _statement in _statements:
+            event.listen(_model.__table__, 'after_create',
+                         DDL(_statement).execute_if(dialect=_dialect))
+
+
+'''
+rebuild_stats()
+    recomputes every counter from the movies and actors tables in one
+    transaction, writes are blocked meanwhile on Postgres so no change is
+    missed; used to resynchronize the counters (manage.py rebuild_stats)
+'''
+
+
+def rebuild_stats():
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(db.text(
+                'LOCK TABLE movies, actors IN SHARE MODE'))
+        db.session.execute(db.text('DELETE FROM catalog_stats'))
+        for table in STATS_DIMENSIONS:
+            db.session.execute(db.text(
+                "INSERT INTO catalog_stats (dimension, value, count) "
+                "SELECT dimension, value, sum(delta) FROM (%s) AS changes "
+                "GROUP BY dimension, value"
+                % stats_rows(table, table, table, 1)))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+'''
+get_stats()
+    returns the counters as {"movies": {"count": n, "genre": {...}},
+    "actors": {"count": n, "gender": {...}, "age": {...}}}
+'''
+
+
+def get_stats():
+    stats = {}
+    for table, dimensions in STATS_DIMENSIONS.items():
+        stats[table] = {'count': 0}
+        for dimension in dimensions:
+            stats[table][dimension] = {}
+
+    rows = db.session.execute(
+        db.select(CatalogStat.dimension, CatalogStat.value,
+                  CatalogStat.count).where(CatalogStat.count != 0))
+    for dimension, value, count in rows:
+        table, _, name = dimension.partition('.')
+        if table not in stats:
+            continue
+        if not name:
+            stats[table]['count'] = count
+        elif name in stats[table]:
+            stats[table][name][value or UNKNOWN] = count
+    return stats
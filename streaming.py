@@ -0,0 +1,48 @@
+from itertools import chain
+from flask import Response, abort, stream_with_context
+
+from models import db
+from pagination import list_statement
+from serialization import dumps, row_serializer
+
+# number of rows fetched from the server side cursor per round trip
+STREAM_BATCH_SIZE = 1000
+
+'''
+stream_collection(name, model, fields, filters, sort)
+    streams {"success": true, "<name>": [...]} as a JSON array built from
+    a server side cursor, serializing each batch of rows as it arrives so
+    worker memory stays flat whatever the size of the table
+    aborts with 404 when no row matches
+'''
+
+
+def stream_collection(name, model, fields, batch_size=STREAM_BATCH_SIZE,
+                      filters=(), sort=()):
+    statement = list_statement(model, fields, filters, sort)
+    result = db.session.execute(
+        statement.execution_options(stream_results=True))
+    rows = iter(result.yield_per(batch_size))
+    # peek at the first row so an empty collection still answers 404
+    first = next(rows, None)
+    if first is None:
+        result.close()
+        abort(404)
+
+    serialize = row_serializer(tuple(fields))
+
+    def generate():
+        yield b'{"success":true,"%s":[' % name.encode()
+        separator = b''
+        chunk = []
+        for row in chain([first], rows):
+            chunk.append(separator + dumps(serialize(row)))
+            separator = b','
+            if len(chunk) >= batch_size:
+                yield b''.join(chunk)
+                chunk = []
+        chunk.append(b']}')
+        yield b''.join(chunk)
+
+    return Response(
+        stream_with_context(generate()), mimetype='application/json')
@@ -1,10 +1,64 @@
 import os
+import sys
+import time
+import asyncio
+import threading
 import unittest
+import subprocess
+import runpy
+import auth
+import io
+import csv
 import json
+import gzip
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
+import flask_migrate
+from flask import Flask, request
 from flask_sqlalchemy import SQLAlchemy
+from Crypto.PublicKey import RSA
+from jose import jwt, jwk
+from jose.utils import base64url_decode, base64url_encode
 
 from app import create_app
-from models import setup_db, Movie, Actor
+from models import (
+    setup_db,
+    db,
+    Movie,
+    Actor,
+    movie_actors,
+    bulk_insert,
+    update_rows,
+    delete_rows,
+    get_version,
+    group_committer
+)
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects import postgresql
+from auth import (
+    AuthError,
+    JWKSStore,
+    TokenCache,
+    file_jwks_fetcher,
+    requires_auth
+)
+from pagination import encode_cursor, decode_cursor, page_statement
+from filtering import get_filters
+from search import search_statement, fts5_query
+from stats import get_stats, rebuild_stats
+from export import export_collection
+from importer import import_file, insert_rows, read_records
+from changes import encode_token, decode_token, get_changes
+from dbpool import engine_options, PoolStats, prime_pool
+from metrics import MetricsRegistry, merge_snapshots, registry
+from admission import Bulkhead, RateLimiter
+from replicas import ReplicaSet, PRIMARY_COOKIE, PRIMARY_HEADER
+from groupcommit import GroupCommitter
+from serialization import ENCODERS, jsonify, serializer, row_serializer
+from benchmarks.common import find_regressions
 
 
 class CinemaTestCase(unittest.TestCase):
@@ -15,6 +69,7 @@ class CinemaTestCase(unittest.TestCase):
         self.app = create_app()
         self.client = self.app.test_client
         setup_db(self.app)
+        db.create_all()
 
         self.new_movie = {"name": "test_movie", "genre": "fairy tale"}
         self.new_movie_without_name = {"genre": "comedy"}
@@ -197,6 +252,2046 @@ class CinemaTestCase(unittest.TestCase):
         self.assertEqual(data["message"], "Permission not found.")
 
 
+class JWKSStoreTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    def setUp(self):
+        key = RSA.generate(2048)
+        self.private_key = key.export_key().decode()
+        public_jwk = jwk.construct(
+            key.publickey().export_key().decode(), 'RS256').to_dict()
+        public_jwk.update({'kid': 'test-key', 'use': 'sig'})
+        self.jwks = {'keys': [public_jwk]}
+        self.fetches = 0
+
+    def fetcher(self):
+        self.fetches += 1
+        return self.jwks, None
+
+    def test_keys_are_cached_by_kid(self):
+        store = JWKSStore(self.fetcher, ttl=600)
+        key = store.get_key('test-key')
+
+        self.assertIsNotNone(key)
+        self.assertIs(store.get_key('test-key'), key)
+        self.assertEqual(self.fetches, 1)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        store = JWKSStore(self.fetcher, ttl=600, min_refresh_interval=600)
+        store.get_key('test-key')
+
+        self.assertIsNone(store.get_key('unknown-key'))
+        self.assertEqual(self.fetches, 1)
+
+        store.min_refresh_interval = 0
+        self.assertIsNone(store.get_key('unknown-key'))
+        self.assertEqual(self.fetches, 2)
+
+    def test_max_age_overrides_ttl(self):
+        store = JWKSStore(lambda: (self.jwks, 0), ttl=600)
+        store.refresh()
+
+        self.assertLessEqual(store.expires_at, time.monotonic())
+
+    def test_fetch_failure_without_keys(self):
+        def failing_fetcher():
+            raise OSError('unreachable')
+
+        store = JWKSStore(failing_fetcher)
+        with self.assertRaises(AuthError) as context:
+            store.get_key('test-key')
+        self.assertEqual(context.exception.status_code, 503)
+
+    def test_fetch_failure_is_counted(self):
+        def failures():
+            return registry.snapshot()['counters'].get(
+                json.dumps(['jwks_refresh_failures_total', []]), 0)
+
+        store = JWKSStore(self.fetcher)
+        store.refresh()
+        before = failures()
+        store.fetcher = mock.Mock(side_effect=OSError('unreachable'))
+        with mock.patch('builtins.print') as printed:
+            store.refresh()
+
+        # the keys fetched before are kept
+        self.assertIsNotNone(store.get_key('test-key'))
+        self.assertEqual(failures(), before + 1)
+        printed.assert_not_called()
+
+    def sign(self, alg):
+        # a token signed with the RS256 key whatever its header claims
+        def encode(part):
+            return base64url_encode(json.dumps(part).encode())
+        signing_input = b'.'.join([
+            encode({'alg': alg, 'kid': 'test-key', 'typ': 'JWT'}),
+            encode({'sub': 'test', 'aud': 'api', 'exp': time.time() + 60,
+                    'iss': 'https://test.example/'})])
+        key = jwk.construct(self.private_key, 'RS256')
+        return b'.'.join([
+            signing_input, base64url_encode(key.sign(signing_input))]
+        ).decode()
+
+    def test_algorithms_are_matched_exactly(self):
+        store = JWKSStore(self.fetcher)
+        with mock.patch.multiple(
+                'auth', jwks_store=store,
+                ALGORITHMS=auth.parse_algorithms("['RS256']"),
+                AUTH0_DOMAIN='test.example', API_AUDIENCE='api'):
+            self.assertEqual(
+                auth.verify_decode_jwt(self.sign('RS256'))['sub'], 'test')
+            for alg in ('RS2', 'S256', 'none'):
+                with self.assertRaises(AuthError):
+                    auth.verify_decode_jwt(self.sign(alg))
+
+    def test_file_fetcher(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as jwks_file:
+            json.dump(self.jwks, jwks_file)
+            jwks_file.flush()
+            store = JWKSStore(file_jwks_fetcher(jwks_file.name))
+
+            key = store.get_key('test-key')
+            token = jwt.encode(
+                {'sub': 'test'}, self.private_key, algorithm='RS256',
+                headers={'kid': 'test-key'})
+            signing_input, signature = token.encode().rsplit(b'.', 1)
+
+            self.assertTrue(key.verify(
+                signing_input, base64url_decode(signature)))
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        self.payload = {
+            'sub': 'test',
+            'exp': time.time() + 60,
+            'permissions': ['get:movies']}
+
+    def test_hit_and_miss(self):
+        cache = TokenCache(max_size=2)
+        self.assertIsNone(cache.get('token'))
+        cache.set('token', self.payload)
+
+        self.assertEqual(cache.get('token'), self.payload)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_entry_expires_at_exp_claim(self):
+        cache = TokenCache()
+        cache.set('token', dict(self.payload, exp=time.time() - 1))
+
+        self.assertIsNone(cache.get('token'))
+
+    def test_lru_eviction(self):
+        cache = TokenCache(max_size=2)
+        cache.set('a', self.payload)
+        cache.set('b', self.payload)
+        cache.get('a')
+        cache.set('c', self.payload)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_disabled_cache(self):
+        cache = TokenCache(enabled=False)
+        cache.set('token', self.payload)
+
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_counters_are_scraped(self):
+        client = create_app().test_client()
+
+        def scrape():
+            counters = {}
+            for line in client.get('/metrics').data.decode().splitlines():
+                if line.startswith('token_cache_'):
+                    name, value = line.split()
+                    counters[name] = float(value)
+            return counters
+
+        cache = TokenCache(max_size=1)
+        cache.get('a')
+        cache.set('a', self.payload)
+        cache.get('a')
+        cache.set('b', self.payload)
+        before = scrape()
+        cache.get('b')
+        cache.get('a')
+        cache.set('c', self.payload)
+        after = scrape()
+
+        for name in ('hits', 'misses', 'evictions'):
+            self.assertIn('token_cache_%s_total{}' % name, before)
+            self.assertEqual(after['token_cache_%s_total{}' % name] -
+                             before['token_cache_%s_total{}' % name], 1)
+
+    def test_requires_auth_skips_verification_on_hit(self):
+        app = create_app()
+        view = requires_auth('get:movies')(lambda payload: payload['sub'])
+        headers = {'Authorization': 'Bearer cached-token'}
+
+        with mock.patch('auth.token_cache', TokenCache()), \
+                mock.patch('auth.verify_decode_jwt',
+                           return_value=self.payload) as verify:
+            for _ in range(3):
+                with app.test_request_context(headers=headers):
+                    self.assertEqual(view(), 'test')
+            self.assertEqual(verify.call_count, 1)
+
+            with app.test_request_context(headers=headers):
+                with self.assertRaises(AuthError) as context:
+                    requires_auth('post:movies')(lambda payload: None)()
+            self.assertEqual(context.exception.status_code, 403)
+
+
+class MockedAuthTestCase(unittest.TestCase):
+    """Base test case which accepts any bearer token with all permissions"""
+
+    permissions = [
+        'get:movies', 'get:actors', 'post:movies', 'post:actors',
+        'patch:movies', 'delete:movies', 'patch:actors', 'delete:actors',
+        'get:stats', 'get:internal', 'export:movies', 'export:actors']
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        db.create_all()
+        payload = {'sub': 'test', 'permissions': self.permissions}
+        patchers = [
+            mock.patch('auth.token_cache', TokenCache(enabled=False)),
+            mock.patch('auth.verify_decode_jwt', return_value=payload)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.headers = {'Authorization': 'Bearer test-token'}
+
+    def unique_tag(self):
+        # a value of this test only, to tell its rows apart in the
+        # database shared by the tests
+        return '%s-%d' % (self.id().rsplit('.', 1)[-1], time.time_ns())
+
+
+class PaginationTestCase(MockedAuthTestCase):
+    """This class represents the keyset pagination test case"""
+
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            Movie(name='paged_movie%d' % i, genre='drama').insert()
+
+    def test_cursor_round_trip(self):
+        cursor = encode_cursor([42])
+
+        self.assertEqual(decode_cursor(cursor), [42])
+
+    def test_boolean_cursor_is_rejected(self):
+        res = self.client().get(
+            '/movies?after=' + encode_cursor([True]), headers=self.headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_pages_follow_next_cursor(self):
+        ids = []
+        url = '/movies?limit=2'
+        while url:
+            res = self.client().get(url, headers=self.headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertLessEqual(len(data['movies']), 2)
+            ids.extend(movie['id'] for movie in data['movies'])
+            url = data['next'] and '/movies?limit=2&after=' + data['next']
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(ids), Movie.query.count())
+
+    def test_empty_page_after_first_is_not_404(self):
+        last_id = Movie.query.order_by(Movie.id.desc()).first().id
+        res = self.client().get(
+            '/movies?after=' + encode_cursor([last_id]), headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'], [])
+        self.assertIsNone(data['next'])
+
+    def test_invalid_page_arguments(self):
+        for query in ('limit=0', 'limit=abc', 'after=not-a-cursor'):
+            res = self.client().get('/actors?' + query, headers=self.headers)
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_sparse_fieldset(self):
+        Actor(name='paged_actor', age=30).insert()
+        res = self.client().get(
+            '/actors?fields=name,age', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for actor in data['actors']:
+            self.assertEqual(set(actor), {'name', 'age'})
+
+    def test_sparse_fieldset_pages_without_id(self):
+        res = self.client().get(
+            '/movies?fields=name&limit=1', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(list(data['movies'][0]), ['name'])
+        self.assertIsNotNone(data['next'])
+
+    def test_unknown_field(self):
+        res = self.client().get(
+            '/movies?fields=id,password', headers=self.headers)
+
+        self.assertEqual(res.status_code, 400)
+
+
+class FilterSortTestCase(MockedAuthTestCase):
+    """This class represents the list filtering and sorting test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.level = self.unique_tag()
+        for name, gender, age in (('filter_b', 'female', 30),
+                                  ('filter_a', 'female', 25),
+                                  ('filter_c', 'female', None),
+                                  ('filter_d', 'female', 60)):
+            Actor(name=name, gender=gender, age=age,
+                  experience_level=self.level).insert()
+        Movie(name='filtered_movie', genre='filter-noir').insert()
+
+    def get_all(self, url):
+        items = []
+        next_cursor = ''
+        while next_cursor is not None:
+            res = self.client().get(
+                url + (next_cursor and '&after=' + next_cursor),
+                headers=self.headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            items.extend(data['actors'])
+            next_cursor = data['next']
+        return items
+
+    def test_filter_movies_by_genre(self):
+        res = self.client().get(
+            '/movies?genre=filter-noir', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['movies'])
+        for movie in data['movies']:
+            self.assertEqual(movie['genre'], 'filter-noir')
+
+    def test_filter_actors_by_age_range(self):
+        actors = self.get_all(
+            '/actors?experience_level=%s&gender=female'
+            '&age_min=25&age_max=35&limit=1' % self.level)
+
+        self.assertEqual(
+            sorted(actor['name'] for actor in actors),
+            ['filter_a', 'filter_b'])
+
+    def test_sort_pages_with_nulls(self):
+        for sort in ('age', '-age', 'name,-age', '-name'):
+            actors = self.get_all(
+                '/actors?experience_level=%s&limit=1&sort=%s'
+                % (self.level, sort))
+            names = [actor['name'] for actor in actors]
+
+            self.assertEqual(len(names), 4)
+            self.assertEqual(len(set(names)), 4)
+        self.assertEqual(names, ['filter_d', 'filter_c', 'filter_b',
+                                 'filter_a'])
+
+    def test_sort_by_age(self):
+        actors = self.get_all(
+            '/actors?experience_level=%s&sort=-age&age_min=0' % self.level)
+
+        self.assertEqual(
+            [actor['age'] for actor in actors], [60, 30, 25])
+
+    def test_invalid_filters_and_sorts(self):
+        for query in ('age_min=abc', 'sort=password', 'sort=age,-age',
+                      'sort=age&after=' + encode_cursor([1])):
+            res = self.client().get('/actors?' + query, headers=self.headers)
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_cursor_values_match_their_columns(self):
+        for cursor in ([{'age': 1}, 1], [[1], 1], ['old', 1], [1, None]):
+            res = self.client().get(
+                '/actors?sort=age&after=' + encode_cursor(cursor),
+                headers=self.headers)
+
+            self.assertEqual(res.status_code, 400)
+
+        # age is nullable, the cursor of a row without one is valid
+        res = self.client().get(
+            '/actors?sort=age&after=' + encode_cursor([None, 1]),
+            headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_common_filters_use_indexes(self):
+        cases = (
+            (Movie, {'genre': 'drama'}, 'ix_movies_genre_id'),
+            (Actor, {'age_min': '25', 'age_max': '35'}, 'ix_actors_age_id'),
+            (Actor, {'gender': 'female', 'age_min': '25'},
+             'ix_actors_gender_age'),
+            (Actor, {'experience_level': '3'},
+             'ix_actors_experience_level_id')
+        )
+        for model, args, index in cases:
+            statement = page_statement(
+                model, ['id', 'name'], 10, filters=get_filters(args, model))
+            compiled = statement.compile(db.engine)
+            params = tuple(
+                compiled.params[name] for name in compiled.positiontup)
+            plan = ' '.join(str(row) for row in db.session.connection()
+                            .exec_driver_sql(
+                                'EXPLAIN QUERY PLAN ' + str(compiled),
+                                params))
+
+            self.assertIn('USING INDEX ' + index, plan)
+
+
+class CastingTestCase(MockedAuthTestCase):
+    """This class represents the movie / actor casting test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.genre = self.unique_tag()
+        self.movies = []
+        for i in range(6):
+            movie = Movie(name='cast_movie%d' % i, genre=self.genre)
+            movie.insert()
+            self.movies.append(movie.id)
+        self.actors = []
+        for i in range(3):
+            actor = Actor(name='cast_actor%d' % i, age=30)
+            actor.insert()
+            self.actors.append(actor.id)
+        for movie_id in self.movies:
+            for actor_id in self.actors[:2]:
+                self.client().put(
+                    '/movies/%d/actors/%d' % (movie_id, actor_id),
+                    headers=self.headers)
+
+    def count_queries(self, url):
+        queries = []
+
+        def count(*args):
+            queries.append(args[2])
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            res = self.client().get(url, headers=self.headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data), len(queries)
+
+    def test_get_movie_with_cast(self):
+        data, queries = self.count_queries(
+            '/movies/%d?include=actors' % self.movies[0])
+        movie = data['movie'][0]
+
+        self.assertEqual(
+            [actor['id'] for actor in movie['actors']], self.actors[:2])
+        self.assertEqual(queries, 2)
+
+    def test_get_actor_with_movies(self):
+        res = self.client().get(
+            '/actors/%d?include=movies' % self.actors[0],
+            headers=self.headers)
+        actor = json.loads(res.data)['actor'][0]
+
+        self.assertEqual(
+            [movie['id'] for movie in actor['movies']], self.movies)
+
+    def test_include_uses_fixed_number_of_queries(self):
+        url = '/movies?genre=%s&include=actors&limit=' % self.genre
+        data, one_movie = self.count_queries(url + '1')
+        data, all_movies = self.count_queries(url + '6')
+
+        self.assertEqual(len(data['movies']), 6)
+        self.assertEqual(one_movie, all_movies)
+        for movie in data['movies']:
+            self.assertEqual(len(movie['actors']), 2)
+
+    def test_include_without_id_field(self):
+        data, _ = self.count_queries(
+            '/movies?genre=%s&include=actors&fields=name' % self.genre)
+
+        self.assertEqual(set(data['movies'][0]), {'name', 'actors'})
+
+    def test_cast_changes_etags(self):
+        res = self.client().get(
+            '/actors?include=movies', headers=self.headers)
+        headers = dict(self.headers, **{'If-None-Match': res.headers['ETag']})
+        res = self.client().get('/actors?include=movies', headers=headers)
+
+        self.assertEqual(res.status_code, 304)
+        self.client().delete(
+            '/movies/%d/actors/%d' % (self.movies[0], self.actors[0]),
+            headers=self.headers)
+        res = self.client().get('/actors?include=movies', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+
+    def test_delete_movie_removes_cast(self):
+        self.client().delete(
+            '/movies/%d' % self.movies[0], headers=self.headers)
+        res = self.client().get(
+            '/actors/%d?include=movies' % self.actors[0],
+            headers=self.headers)
+        actor = json.loads(res.data)['actor'][0]
+
+        self.assertNotIn(
+            self.movies[0], [movie['id'] for movie in actor['movies']])
+
+    def test_invalid_include(self):
+        for url in ('/movies?include=directors',
+                    '/movies?include=actors&stream=true',
+                    '/actors/%d?include=actors' % self.actors[0]):
+            res = self.client().get(url, headers=self.headers)
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_cast_unknown_actor(self):
+        res = self.client().put(
+            '/movies/%d/actors/0' % self.movies[0], headers=self.headers)
+
+        self.assertEqual(res.status_code, 404)
+
+
+class BatchWriteTestCase(MockedAuthTestCase):
+    """This class represents the batch update and delete test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.genre = self.unique_tag()
+        self.ids = bulk_insert(Movie, [
+            {'name': 'batch_movie%d' % i, 'genre': self.genre}
+            for i in range(4)])
+
+    def count_statements(self, method, url, body):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement.split()[0].upper())
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            res = self.client().open(
+                url, method=method, json=body, headers=self.headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        return res, statements
+
+    def test_batch_update_by_ids(self):
+        res = self.client().patch('/movies', json={
+            'ids': self.ids[:2], 'values': {'genre': self.genre + '-new'}},
+            headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(data['updated']), self.ids[:2])
+        self.assertEqual(
+            Movie.query.filter(Movie.genre == self.genre + '-new').count(), 2)
+
+    def test_batch_delete_by_filter(self):
+        actor_id = bulk_insert(Actor, [{'name': 'batch_actor'}])[0]
+        self.client().put('/movies/%d/actors/%d' % (self.ids[0], actor_id),
+                          headers=self.headers)
+        res = self.client().delete(
+            '/movies', json={'filter': {'genre': self.genre}},
+            headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(data['deleted']), self.ids)
+        self.assertEqual(
+            Movie.query.filter(Movie.genre == self.genre).count(), 0)
+        self.assertEqual(db.session.execute(
+            movie_actors.select().where(
+                movie_actors.c.actor_id == actor_id)).all(), [])
+
+    def test_batch_actors(self):
+        ids = bulk_insert(Actor, [
+            {'name': 'batch_actor', 'experience_level': self.genre,
+             'age': age} for age in (20, 40)])
+        res = self.client().patch('/actors', json={
+            'filter': {'experience_level': self.genre, 'age_min': 30},
+            'values': {'gender': 'female'}}, headers=self.headers)
+
+        self.assertEqual(json.loads(res.data)['updated'], ids[1:])
+        res = self.client().delete(
+            '/actors', json={'ids': ids}, headers=self.headers)
+
+        self.assertEqual(sorted(json.loads(res.data)['deleted']), ids)
+
+    def test_batch_requires_target(self):
+        for method, body in (
+                ('DELETE', {}),
+                ('DELETE', {'ids': []}),
+                ('DELETE', {'ids': ['1']}),
+                ('DELETE', {'filter': {'name': 'x'}}),
+                ('PATCH', {'ids': self.ids}),
+                ('PATCH', {'ids': self.ids, 'values': {'id': 1}})):
+            res = self.client().open(
+                '/movies', method=method, json=body, headers=self.headers)
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_single_row_routes_use_pk_statements(self):
+        res, statements = self.count_statements(
+            'PATCH', '/movies/%d' % self.ids[0], {'genre': 'noir'})
+
+        self.assertEqual(json.loads(res.data)['movie'][0]['genre'], 'noir')
+        self.assertIn('UPDATE', statements)
+        res, statements = self.count_statements(
+            'DELETE', '/movies/%d' % self.ids[0], None)
+
+        self.assertEqual(json.loads(res.data)['deleted'], self.ids[0])
+        self.assertIn('DELETE', statements)
+        res, statements = self.count_statements(
+            'DELETE', '/movies/%d' % self.ids[0], None)
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_set_based_statement_count(self):
+        _, few = self.count_statements(
+            'DELETE', '/movies', {'ids': self.ids[:1]})
+        _, many = self.count_statements(
+            'DELETE', '/movies', {'ids': self.ids[1:]})
+
+        self.assertEqual(len(few), len(many))
+
+
+class StatsTestCase(MockedAuthTestCase):
+    """This class represents the catalog statistics test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.genre = self.unique_tag()
+
+    def get_stats(self):
+        res = self.client().get('/stats', headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)['stats']
+
+    def test_counters_follow_every_write_path(self):
+        before = self.get_stats()
+        movie = Movie(name='stats_movie', genre=self.genre)
+        movie.insert()
+        movie_id = movie.id
+        bulk_insert(Movie, [{'name': 'stats_bulk', 'genre': self.genre}])
+        self.client().post('/actors', json={
+            'name': 'stats_actor', 'gender': self.genre, 'age': 42},
+            headers=self.headers)
+        after = self.get_stats()
+
+        self.assertEqual(
+            after['movies']['count'], before['movies']['count'] + 2)
+        self.assertEqual(after['movies']['genre'][self.genre], 2)
+        self.assertEqual(after['actors']['gender'][self.genre], 1)
+        self.assertEqual(
+            after['actors']['age'].get('40-49', 0),
+            before['actors']['age'].get('40-49', 0) + 1)
+
+        self.client().patch('/movies/%d' % movie_id, json={'genre': 'x'},
+                            headers=self.headers)
+        self.client().delete('/movies', json={'filter': {
+            'genre': self.genre}}, headers=self.headers)
+        after = self.get_stats()
+
+        self.assertNotIn(self.genre, after['movies']['genre'])
+        self.assertEqual(
+            after['movies']['count'], before['movies']['count'] + 1)
+
+    def test_rebuild_matches_counters(self):
+        Movie(name='stats_movie', genre=self.genre).insert()
+        counters = get_stats()
+        db.session.execute(db.text(
+            "UPDATE catalog_stats SET count = count + 5 "
+            "WHERE dimension = 'movies'"))
+        db.session.commit()
+
+        self.assertNotEqual(get_stats(), counters)
+        rebuild_stats()
+        self.assertEqual(get_stats(), counters)
+
+    def test_stats_etag(self):
+        res = self.client().get('/stats', headers=self.headers)
+        headers = dict(self.headers, **{'If-None-Match': res.headers['ETag']})
+
+        self.assertEqual(
+            self.client().get('/stats', headers=headers).status_code, 304)
+        Movie(name='stats_movie', genre=self.genre).insert()
+        self.assertEqual(
+            self.client().get('/stats', headers=headers).status_code, 200)
+
+
+class SearchTestCase(MockedAuthTestCase):
+    """This class represents the full text search test case"""
+
+    def setUp(self):
+        super().setUp()
+        Movie(name='zebra crossing', genre='drama').insert()
+        Movie(name='zebra zebra', genre='comedy').insert()
+        Movie(name='unrelated', genre='zebra').insert()
+        Actor(name='Zora Quill', age=40).insert()
+
+    def test_search_ranks_matches(self):
+        res = self.client().get(
+            '/movies/search?q=zebra', headers=self.headers)
+        data = json.loads(res.data)
+        names = [movie['name'] for movie in data['movies']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('unrelated', names)
+        self.assertEqual(names[0], 'zebra zebra')
+
+    def test_search_pages_follow_next_cursor(self):
+        movies = []
+        url = '/movies/search?q=zebra&limit=1'
+        while url:
+            res = self.client().get(url, headers=self.headers)
+            data = json.loads(res.data)
+            movies.extend(data['movies'])
+            url = data['next'] and \
+                '/movies/search?q=zebra&limit=1&after=' + data['next']
+        ids = [movie['id'] for movie in movies]
+
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(
+            {movie['name'] for movie in movies},
+            {'zebra crossing', 'zebra zebra', 'unrelated'})
+
+    def test_search_follows_writes(self):
+        movie = Movie(name='quagga', genre='drama')
+        movie.insert()
+        movie.name = 'okapi'
+        movie.update()
+        res = self.client().get(
+            '/movies/search?q=quagga', headers=self.headers)
+
+        self.assertEqual(res.status_code, 404)
+        res = self.client().get(
+            '/movies/search?q=okapi', headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+
+    def test_search_actors_with_query_syntax(self):
+        res = self.client().get(
+            '/actors/search?q=quill%20"zora&fields=name',
+            headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn({'name': 'Zora Quill'}, data['actors'])
+
+    def test_search_requires_query(self):
+        for query in ('', 'q=%20', 'q=zebra&after=abc', 'q=zebra&limit=0'):
+            res = self.client().get(
+                '/movies/search?' + query, headers=self.headers)
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_fts5_query_quotes_terms(self):
+        self.assertEqual(fts5_query('a "b OR c'), '"a" """b" "OR" "c"')
+
+    def test_uses_text_index(self):
+        statement = search_statement(Movie, ['id'], 'zebra', 10)
+        compiled = statement.compile(db.engine)
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+        plan = ' '.join(str(row) for row in db.session.connection()
+                        .exec_driver_sql(
+                            'EXPLAIN QUERY PLAN ' + str(compiled), params))
+
+        self.assertIn('movies_fts VIRTUAL TABLE INDEX', plan)
+        self.assertIn('SEARCH movies USING INTEGER PRIMARY KEY', plan)
+
+    def test_postgres_score_is_double_precision(self):
+        statement = search_statement(
+            Movie, ['id'], 'zebra', 10, [0.1, 5], postgresql.dialect())
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+
+        # the cursor holds a double, a real score would never equal it
+        self.assertIn('CAST(ts_rank(', sql)
+        self.assertIn('AS DOUBLE PRECISION) < %(', sql)
+        self.assertIn('AS DOUBLE PRECISION) = %(', sql)
+
+    def test_search_rejects_boolean_cursor(self):
+        res = self.client().get(
+            '/movies/search?q=zebra&after=%s' % encode_cursor([True, 1]),
+            headers=self.headers)
+
+        self.assertEqual(res.status_code, 400)
+
+
+class StreamingTestCase(MockedAuthTestCase):
+    """This class represents the streaming collection test case"""
+
+    def test_stream_all_movies(self):
+        Movie(name='streamed_movie', genre='drama').insert()
+        res = self.client().get('/movies?stream=true', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['movies']), Movie.query.count())
+        self.assertIn('streamed_movie', [m['name'] for m in data['movies']])
+
+    def test_stream_all_actors(self):
+        Actor(name='streamed_actor', gender='male', age=40).insert()
+        res = self.client().get('/actors?stream=true', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), Actor.query.count())
+
+    def test_stream_sparse_fieldset(self):
+        Movie(name='streamed_movie', genre='drama').insert()
+        res = self.client().get(
+            '/movies?stream=true&fields=name', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(list(data['movies'][0]), ['name'])
+
+
+class BulkCreateTestCase(MockedAuthTestCase):
+    """This class represents the bulk create test case"""
+
+    def test_bulk_create_movies(self):
+        movies = [{'name': 'bulk_movie%d' % i, 'genre': 'action'}
+                  for i in range(3)]
+        res = self.client().post(
+            '/movies/bulk', json=movies, headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['ids']), 3)
+        self.assertEqual(
+            Movie.query.get(data['ids'][2]).name, 'bulk_movie2')
+
+    def test_bulk_create_actors_from_ndjson(self):
+        body = '\n'.join(json.dumps({'name': 'bulk_actor%d' % i, 'age': 30})
+                         for i in range(2))
+        res = self.client().post(
+            '/actors/bulk', data=body, headers=self.headers,
+            content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['ids']), 2)
+
+    def test_422_bulk_create_without_name(self):
+        movie_count_before = Movie.query.count()
+        res = self.client().post(
+            '/movies/bulk', json=[{'name': 'ok'}, {'genre': 'comedy'}],
+            headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'][0]['index'], 1)
+        self.assertEqual(Movie.query.count(), movie_count_before)
+
+    def test_bulk_create_partial_failure(self):
+        res = self.client().post(
+            '/movies/bulk?partial=true',
+            json=[{'name': 'ok'}, {'genre': 'comedy'}, 'bad'],
+            headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['ids']), 1)
+        self.assertEqual([e['index'] for e in data['errors']], [1, 2])
+
+    def test_bulk_create_checks_column_types(self):
+        res = self.client().post(
+            '/actors/bulk?partial=true',
+            json=[{'name': 'typed_actor', 'age': '41'},
+                  {'name': 'bad_age', 'age': 'abc'},
+                  {'name': 'bool_age', 'age': True},
+                  {'name': ['list'], 'age': 30}],
+            headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(db.session.get(Actor, data['ids'][0]).age, 41)
+        self.assertEqual(data['errors'], [
+            {'index': 1, 'message': 'invalid age'},
+            {'index': 2, 'message': 'invalid age'},
+            {'index': 3, 'message': 'invalid name'}])
+
+    def test_400_bulk_create_without_rows(self):
+        res = self.client().post(
+            '/actors/bulk', json={'name': 'x'}, headers=self.headers)
+
+        self.assertEqual(res.status_code, 400)
+
+
+class ConditionalGetTestCase(MockedAuthTestCase):
+    """This class represents the ETag / conditional GET test case"""
+
+    def test_304_when_collection_unchanged(self):
+        Movie(name='etag_movie', genre='drama').insert()
+        res = self.client().get('/movies', headers=self.headers)
+        etag = res.headers['ETag']
+
+        headers = dict(self.headers, **{'If-None-Match': etag})
+        res = self.client().get('/movies', headers=headers)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_write_changes_etag(self):
+        Actor(name='etag_actor', age=20).insert()
+        etag = self.client().get('/actors', headers=self.headers).headers[
+            'ETag']
+
+        self.client().post(
+            '/actors', json={'name': 'new_actor'}, headers=self.headers)
+        headers = dict(self.headers, **{'If-None-Match': etag})
+        res = self.client().get('/actors', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+
+class PoolTestCase(MockedAuthTestCase):
+    """This class represents the connection pool configuration test case"""
+
+    def test_postgres_engine_options(self):
+        with mock.patch('dbpool.DB_STATEMENT_TIMEOUT', 5000), \
+                mock.patch('dbpool.DB_LOCK_TIMEOUT', 1000):
+            options = engine_options('postgresql://localhost/cinemadb')
+
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(
+            options['connect_args']['options'],
+            '-c statement_timeout=5000 -c lock_timeout=1000')
+
+    def test_sqlite_keeps_default_pool(self):
+        self.assertEqual(engine_options('sqlite:///cinema.db'), {})
+
+    def test_wait_histogram(self):
+        stats = PoolStats(buckets=(0.01, 0.1))
+        for seconds in (0.001, 0.05, 2):
+            stats.observe_wait(seconds)
+
+        self.assertEqual(
+            stats.histogram(), {'0.01': 1, '0.1': 1, '+Inf': 1})
+        self.assertEqual(stats.checkouts, 3)
+
+    def test_pool_status_endpoint(self):
+        res = self.client().get('/internal/pool', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['pool']['pid'], os.getpid())
+
+    def test_prime_pool_opens_the_pool_size(self):
+        engine = sqlalchemy.create_engine(
+            'sqlite://', poolclass=QueuePool, pool_size=3)
+        connects = []
+        event.listen(engine, 'connect', lambda *args: connects.append(1))
+
+        self.assertEqual(prime_pool(engine), 3)
+        self.assertEqual(len(connects), 3)
+        self.assertEqual(engine.pool.checkedin(), 3)
+
+
+class StartupTestCase(unittest.TestCase):
+    """This class represents the application startup test case"""
+
+    # seconds allowed for importing app.py, which creates the app
+    import_budget = float(os.environ.get('STARTUP_BUDGET', 2.0))
+
+    def test_import_does_no_db_io_and_fits_budget(self):
+        # any connection to this database would fail
+        env = dict(
+            os.environ,
+            DATABASE_URL='sqlite:////nonexistent-directory/cinema.db')
+        code = (
+            'import time; start = time.perf_counter(); import app; '
+            'print(time.perf_counter() - start)')
+        result = subprocess.run(
+            [sys.executable, '-c', code], env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertLess(float(result.stdout), self.import_budget)
+
+    def test_gunicorn_config_from_environment(self):
+        path = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+        with mock.patch.dict(os.environ, {
+                'WEB_WORKER_CLASS': 'gthread', 'WEB_CONCURRENCY': '3',
+                'WEB_THREADS': '4'}):
+            config = runpy.run_path(path)
+
+        self.assertEqual(config['worker_class'], 'gthread')
+        self.assertEqual(config['workers'], 3)
+        self.assertEqual(config['threads'], 4)
+        self.assertTrue(config['preload_app'])
+
+        server = mock.Mock()
+        with mock.patch.object(db.engine, 'dispose') as dispose:
+            config['post_fork'](server, mock.Mock())
+        dispose.assert_called_once_with()
+
+
+class MetricsTestCase(MockedAuthTestCase):
+    """This class represents the request timing and metrics test case"""
+
+    def test_server_timing_header(self):
+        Movie(name='timed_movie', genre='drama').insert()
+        res = self.client().get('/movies', headers=self.headers)
+        phases = [part.split(';')[0]
+                  for part in res.headers['Server-Timing'].split(', ')]
+
+        self.assertEqual(res.status_code, 200)
+        for phase in ('auth', 'db', 'serialize', 'total'):
+            self.assertIn(phase, phases)
+
+    def test_metrics_endpoint(self):
+        self.client().get('/movies', headers=self.headers)
+        res = self.client().get('/metrics')
+        text = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(
+            'http_request_duration_seconds_count{method="GET",'
+            'route="/movies"}', text)
+        self.assertIn('db_queries_total{method="GET",route="/movies"}', text)
+
+    def test_worker_snapshots_are_merged(self):
+        registry = MetricsRegistry()
+        registry.observe_request('GET', '/actors', 200, 0.02, {'db': 0.01}, 2)
+        registry.inc('requests_shed_total', kind='read')
+        snapshot = registry.snapshot()
+
+        merged = merge_snapshots([snapshot, snapshot])
+        entry = merged['routes']['GET /actors']
+
+        self.assertEqual(entry['count'], 2)
+        self.assertEqual(entry['queries'], 4)
+        self.assertEqual(sum(entry['buckets']), 2)
+        self.assertEqual(list(merged['counters'].values()), [2])
+
+    def test_metrics_files_are_shared(self):
+        with tempfile.TemporaryDirectory() as metrics_dir, \
+                mock.patch('metrics.METRICS_DIR', metrics_dir):
+            registry = MetricsRegistry()
+            registry.observe_request('GET', '/movies', 200, 0.1, {}, 1)
+            registry.flush(force=True)
+
+            self.assertEqual(
+                os.listdir(metrics_dir), ['%d.json' % os.getpid()])
+            self.assertEqual(
+                registry.collect()['routes']['GET /movies']['count'], 1)
+
+
+class AdmissionTestCase(MockedAuthTestCase):
+    """This class represents the admission control test case"""
+
+    def test_bulkhead_queues_then_sheds(self):
+        bulkhead = Bulkhead('read', limit=1, queue_size=1, timeout=5)
+        self.assertIsNone(bulkhead.acquire())
+
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(bulkhead.acquire()))
+        waiter.start()
+        while bulkhead.queued == 0:
+            time.sleep(0.001)
+        # the only slot is taken and the queue is full
+        self.assertEqual(bulkhead.acquire(), 'queue_full')
+
+        bulkhead.release()
+        waiter.join()
+        self.assertEqual(results, [None])
+        self.assertEqual(bulkhead.stats()['in_flight'], 1)
+
+    def test_bulkhead_queue_timeout(self):
+        bulkhead = Bulkhead('write', limit=1, queue_size=1, timeout=0.01)
+        bulkhead.acquire()
+
+        self.assertEqual(bulkhead.acquire(), 'timeout')
+        self.assertEqual(bulkhead.stats()['queued'], 0)
+
+    def test_token_bucket_per_subject(self):
+        limiter = RateLimiter(rate=1, burst=2)
+
+        self.assertEqual(limiter.consume('a'), 0)
+        self.assertEqual(limiter.consume('a'), 0)
+        self.assertGreater(limiter.consume('a'), 0)
+        self.assertEqual(limiter.consume('b'), 0)
+
+    def test_full_budget_is_shed_with_retry_after(self):
+        full = Bulkhead('read', limit=0, queue_size=0)
+        with mock.patch.dict('admission.bulkheads', {'read': full}):
+            res = self.client().get('/movies', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertIn('Retry-After', res.headers)
+        metrics = self.client().get('/metrics').data.decode()
+        self.assertIn(
+            'requests_shed_total{kind="read",reason="queue_full"}', metrics)
+
+    def test_writes_have_their_own_budget(self):
+        full = Bulkhead('write', limit=0, queue_size=0)
+        Movie(name='admitted_movie', genre='drama').insert()
+        with mock.patch.dict('admission.bulkheads', {'write': full}):
+            read = self.client().get('/movies', headers=self.headers)
+            write = self.client().post(
+                '/movies', json={'name': 'shed_movie'}, headers=self.headers)
+
+        self.assertEqual(read.status_code, 200)
+        self.assertEqual(write.status_code, 503)
+
+    def test_rate_limited_subject(self):
+        with mock.patch('admission.rate_limiter',
+                        RateLimiter(rate=0.5, burst=1)):
+            first = self.client().get('/movies', headers=self.headers)
+            second = self.client().get('/movies', headers=self.headers)
+
+        self.assertNotEqual(first.status_code, 429)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(second.headers['Retry-After'], '2')
+
+
+class ReplicaTestCase(MockedAuthTestCase):
+    """This class represents the read replica routing test case"""
+
+    def setUp(self):
+        super().setUp()
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        # a second database standing in for a replica of the primary
+        self.replicas = ReplicaSet(
+            ['sqlite:///%s' % os.path.join(workdir.name, 'replica.db')])
+        self.addCleanup(self.replicas.dispose)
+        replica = self.replicas.replicas[0].engine
+        db.Model.metadata.create_all(replica)
+        with replica.begin() as connection:
+            connection.execute(Movie.__table__.insert().values(
+                id=1, name='replica_movie', genre='drama'))
+        patcher = mock.patch('replicas.replica_set', self.replicas)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_movie_name(self, client, headers=None):
+        res = client.get('/movies/1', headers=dict(self.headers, **(
+            headers or {})))
+        if res.status_code != 200:
+            return None
+        return json.loads(res.data)['movie'][0]['name']
+
+    def test_reads_go_to_a_replica(self):
+        self.assertEqual(
+            self.get_movie_name(self.client()), 'replica_movie')
+
+    def test_writes_go_to_the_primary_then_reads_stick_to_it(self):
+        client = self.client()
+        res = client.post('/movies', json={'name': 'primary_movie'},
+                          headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(PRIMARY_HEADER, res.headers)
+        with self.app.app_context():
+            self.assertEqual(
+                Movie.query.filter_by(name='replica_movie').count(), 0)
+        # the cookie set by the write
+        self.assertNotEqual(self.get_movie_name(client), 'replica_movie')
+        # or the header, for clients without cookies
+        self.assertNotEqual(self.get_movie_name(self.client(), {
+            PRIMARY_HEADER: res.headers[PRIMARY_HEADER]}), 'replica_movie')
+        # a window longer than allowed is ignored
+        self.assertEqual(self.get_movie_name(self.client(), {
+            PRIMARY_HEADER: str(time.time() + 3600)}), 'replica_movie')
+
+    def test_only_writes_start_the_primary_window(self):
+        client = self.client()
+        res = client.options('/movies', headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn(PRIMARY_HEADER, res.headers)
+        self.assertNotIn(PRIMARY_COOKIE, res.headers.get('Set-Cookie', ''))
+        self.assertEqual(self.get_movie_name(client), 'replica_movie')
+
+    def test_lagging_or_unhealthy_replicas_are_skipped(self):
+        self.replicas.check()
+        self.replicas.check_interval = 3600
+        self.replicas.replicas[0].lag = self.replicas.max_lag + 1
+        self.assertNotEqual(
+            self.get_movie_name(self.client()), 'replica_movie')
+
+        unreachable = ReplicaSet(
+            ['sqlite:////nonexistent-directory/replica.db'])
+        unreachable.check()
+        self.assertFalse(unreachable.replicas[0].healthy)
+        self.assertIsNone(unreachable.pick())
+
+    def test_checks_do_not_hold_the_requests(self):
+        replica = self.replicas.replicas[0]
+        stalled, checked = threading.Event(), threading.Event()
+
+        def stalled_check():
+            # a replica which is down, until the connect timeout
+            stalled.wait(5)
+            replica.healthy = False
+            checked.set()
+
+        with mock.patch.object(replica, 'check', stalled_check):
+            start = time.monotonic()
+            # the last known state is used while the check runs
+            self.assertIs(self.replicas.pick(), replica.engine)
+            self.assertIs(self.replicas.pick(), replica.engine)
+            self.assertLess(time.monotonic() - start, 1)
+            stalled.set()
+            self.assertTrue(checked.wait(5))
+        for _ in range(100):
+            if self.replicas.checked_at is not None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(self.replicas.pick())
+
+
+class GroupCommitTestCase(MockedAuthTestCase):
+    """This class represents the group commit test case"""
+
+    def setUp(self):
+        super().setUp()
+        for name, value in (('enabled', True), ('window', 50)):
+            patcher = mock.patch.object(group_committer, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.tag = self.unique_tag()
+
+    def run_concurrently(self, functions):
+        results = [None] * len(functions)
+
+        def run(i):
+            with self.app.app_context():
+                try:
+                    results[i] = functions[i]()
+                except Exception as e:
+                    results[i] = e
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(len(functions))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_inserts_share_commits(self):
+        with self.app.app_context():
+            version = get_version('movies')
+        commits = []
+        with self.app.app_context():
+            engine = db.engine
+
+        def count_commit(connection):
+            commits.append(1)
+        event.listen(engine, 'commit', count_commit)
+        self.addCleanup(event.remove, engine, 'commit', count_commit)
+
+        def insert(i):
+            movie = Movie(name='%s-%d' % (self.tag, i), genre='drama')
+            movie.insert()
+            return movie.id, movie.format()['name']
+
+        results = self.run_concurrently(
+            [lambda i=i: insert(i) for i in range(8)])
+
+        ids = [movie_id for movie_id, name in results]
+        self.assertEqual(len(set(ids)), 8)
+        self.assertLess(len(commits), 8)
+        with self.app.app_context():
+            self.assertEqual(
+                Movie.query.filter(Movie.name.startswith(self.tag)).count(),
+                8)
+            self.assertGreater(get_version('movies'), version)
+        for movie_id, name in results:
+            with self.app.app_context():
+                self.assertEqual(db.session.get(Movie, movie_id).name, name)
+
+    def test_failing_write_only_fails_its_caller(self):
+        table = Movie.__table__
+
+        def work(name):
+            return lambda connection: connection.execute(
+                table.insert().values(name=name)).inserted_primary_key[0]
+
+        def failing(connection):
+            raise ValueError('bad row')
+
+        committer = GroupCommitter(
+            lambda: db.engine, lambda name, connection: None,
+            enabled=True, window=50)
+        results = self.run_concurrently([
+            lambda: committer.submit(work(self.tag + '-a'), ('movies',)),
+            lambda: committer.submit(failing, ('movies',)),
+            lambda: committer.submit(work(self.tag + '-b'), ('movies',))])
+
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIsInstance(results[0], int)
+        self.assertIsInstance(results[2], int)
+        with self.app.app_context():
+            self.assertEqual(
+                Movie.query.filter(Movie.name.startswith(self.tag)).count(),
+                2)
+
+    def test_failing_commit_fails_every_write(self):
+        def bump_version(name, connection):
+            raise RuntimeError('commit failed')
+
+        committer = GroupCommitter(
+            lambda: db.engine, bump_version, enabled=True, window=50)
+        results = self.run_concurrently([
+            lambda: committer.submit(lambda connection: 1, ('movies',)),
+            lambda: committer.submit(lambda connection: 2, ('movies',))])
+
+        for result in results:
+            self.assertIsInstance(result, RuntimeError)
+
+    def test_update_and_delete(self):
+        with self.app.app_context():
+            movie = Movie(name=self.tag, genre='drama')
+            movie.insert()
+            movie_id = movie.id
+
+            movie = db.session.get(Movie, movie_id)
+            movie.genre = 'comedy'
+            movie.update()
+            self.assertEqual(db.session.get(Movie, movie_id).genre, 'comedy')
+
+            db.session.get(Movie, movie_id).delete()
+            self.assertIsNone(db.session.get(Movie, movie_id))
+
+    def test_single_row_routes_share_commits(self):
+        ids = bulk_insert(Movie, [
+            {'name': '%s-%d' % (self.tag, i), 'genre': 'drama'}
+            for i in range(8)])
+        commits = []
+        with self.app.app_context():
+            engine = db.engine
+
+        def count_commit(connection):
+            commits.append(1)
+        event.listen(engine, 'commit', count_commit)
+        self.addCleanup(event.remove, engine, 'commit', count_commit)
+
+        def request(method, url, body=None):
+            return getattr(self.client(), method)(
+                url, json=body, headers=self.headers).status_code
+
+        statuses = self.run_concurrently(
+            [lambda: request('post', '/movies', {'name': self.tag})] * 4 +
+            [lambda i=i: request('patch', '/movies/%d' % i,
+                                 {'genre': 'comedy'}) for i in ids[:4]] +
+            [lambda i=i: request('delete', '/movies/%d' % i)
+             for i in ids[4:]])
+
+        self.assertEqual(statuses, [200] * 12)
+        # POST, PATCH and DELETE of one row are all coalesced
+        self.assertLess(len(commits), 12)
+        with self.app.app_context():
+            self.assertEqual(Movie.query.filter(
+                Movie.id.in_(ids), Movie.genre == 'comedy').count(), 4)
+            self.assertEqual(
+                Movie.query.filter(Movie.id.in_(ids)).count(), 4)
+
+    def test_single_row_routes_answer_404_in_a_group(self):
+        res = self.client().patch('/movies/0', json={'genre': 'comedy'},
+                                  headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+        res = self.client().delete('/movies/0', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_post_returns_its_own_id(self):
+        res = self.client().post(
+            '/movies', json={'name': self.tag}, headers=self.headers)
+        movie = json.loads(res.data)['movie'][0]
+
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(
+                db.session.get(Movie, movie['id']).name, self.tag)
+
+
+class ExportTestCase(MockedAuthTestCase):
+    """This class represents the CSV and NDJSON export test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.tag = self.unique_tag()
+        bulk_insert(Movie, [
+            {'name': 'export, "%d"' % i, 'genre': self.tag}
+            for i in range(3)])
+
+    def export(self, query, headers=None):
+        return self.client().get(
+            '/movies/export?genre=%s&%s' % (self.tag, query),
+            headers=dict(self.headers, **(headers or {})))
+
+    def test_ndjson_export(self):
+        res = self.export('format=ndjson&fields=name')
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'name': 'export, "%d"' % i} for i in range(3)])
+
+    def test_csv_export(self):
+        res = self.export('format=csv&fields=genre,name')
+        rows = list(csv.reader(io.StringIO(res.data.decode())))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('movies.csv', res.headers['Content-Disposition'])
+        self.assertEqual(rows[0], ['genre', 'name'])
+        self.assertEqual(rows[1:], [
+            [self.tag, 'export, "%d"' % i] for i in range(3)])
+
+    def test_gzip_export(self):
+        plain = self.export('format=csv')
+        res = self.export('format=csv', {'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+    def test_export_is_streamed_in_batches(self):
+        with self.app.test_request_context(
+                '/movies/export?genre=%s' % self.tag):
+            response = export_collection(
+                'movies', Movie, request.args, batch_size=2)
+            chunks = list(response.response)
+
+        self.assertEqual([chunk.count(b'\n') for chunk in chunks], [2, 1])
+
+    def test_invalid_format(self):
+        self.assertEqual(self.export('format=xml').status_code, 400)
+
+    def test_export_requires_its_permission(self):
+        payload = {'sub': 'test', 'permissions': ['get:movies']}
+        with mock.patch('auth.verify_decode_jwt', return_value=payload):
+            res = self.export('format=csv')
+
+        self.assertEqual(res.status_code, 403)
+
+
+class ImportTestCase(MockedAuthTestCase):
+    """This class represents the bulk import test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.tag = self.unique_tag()
+        self.workdir = tempfile.mkdtemp()
+        self.messages = []
+
+    def write(self, name, records, opener=open):
+        path = os.path.join(self.workdir, name)
+        with opener(path, 'wt', encoding='utf-8', newline='') as output:
+            if name.split('.')[1] == 'csv':
+                writer = csv.DictWriter(output, list(records[0]))
+                writer.writeheader()
+                writer.writerows(records)
+            else:
+                for record in records:
+                    output.write(json.dumps(record) + '\n')
+        return path
+
+    def movies(self, count):
+        return [{'name': 'import %d' % i, 'genre': self.tag}
+                for i in range(count)]
+
+    def imported(self):
+        return [movie.name for movie in Movie.query.filter_by(
+            genre=self.tag).order_by(Movie.id)]
+
+    def run_import(self, path, **kwargs):
+        return import_file(Movie, path, report=self.messages.append,
+                           **kwargs)
+
+    def test_import_csv(self):
+        path = self.write('movies.csv', self.movies(5))
+        version = get_version('movies')
+
+        self.assertEqual(self.run_import(path, batch_size=2), (5, 0))
+        self.assertEqual(self.imported(), [
+            'import %d' % i for i in range(5)])
+        self.assertGreater(get_version('movies'), version)
+        self.assertIn('rows/s', self.messages[-1])
+
+    def test_csv_values_are_converted(self):
+        path = self.write('actors.csv', [
+            {'name': 'aged', 'gender': self.tag, 'age': '42'},
+            {'name': 'unknown age', 'gender': self.tag, 'age': ''}])
+
+        self.assertEqual(import_file(
+            Actor, path, report=self.messages.append), (2, 0))
+        self.assertEqual([(actor.name, actor.age) for actor in Actor.query
+                          .filter_by(gender=self.tag).order_by(Actor.id)],
+                         [('aged', 42), ('unknown age', None)])
+
+    def test_import_gzipped_ndjson(self):
+        path = self.write('movies.ndjson.gz', self.movies(3), gzip.open)
+
+        self.assertEqual(self.run_import(path), (3, 0))
+        self.assertEqual(len(self.imported()), 3)
+
+    def test_batch_mixing_given_and_new_ids(self):
+        top = db.session.query(db.func.max(Movie.id)).scalar() or 0
+        records = self.movies(4)
+        records[0]['id'], records[2]['id'] = top + 1, top + 2
+        path = self.write('movies.ndjson', records)
+
+        # the new ids are taken after the given ones, in the same batch
+        self.assertEqual(self.run_import(path, batch_size=4), (4, 0))
+        self.assertEqual(
+            [(movie.id, movie.name) for movie in Movie.query.filter_by(
+                genre=self.tag).order_by(Movie.id)],
+            [(top + 1, 'import 0'), (top + 2, 'import 2'),
+             (top + 3, 'import 1'), (top + 4, 'import 3')])
+
+    def test_invalid_records_are_rejected(self):
+        path = os.path.join(self.workdir, 'movies.ndjson')
+        with open(path, 'w') as output:
+            output.write('\n'.join([
+                json.dumps({'name': 'valid', 'genre': self.tag}),
+                json.dumps({'genre': self.tag}),
+                json.dumps({'id': 'one', 'name': 'id', 'genre': self.tag}),
+                '{not json',
+                json.dumps({'name': ['list'], 'genre': self.tag})]))
+
+        self.assertEqual(self.run_import(path), (1, 4))
+        self.assertEqual(self.imported(), ['valid'])
+        self.assertIn('movies: rejected record 2: name is required',
+                      self.messages)
+        self.assertIn('movies: rejected record 3: invalid id',
+                      self.messages)
+
+    def test_resume_after_failure(self):
+        path = self.write('movies.csv', self.movies(6))
+        calls = []
+
+        def fail_second_batch(model, rows):
+            calls.append(rows)
+            if len(calls) == 2:
+                raise RuntimeError('connection lost')
+            insert_rows(model, rows)
+
+        with mock.patch('importer.insert_rows', fail_second_batch):
+            with self.assertRaises(RuntimeError):
+                self.run_import(path, batch_size=2)
+        self.assertEqual(len(self.imported()), 2)
+
+        self.assertEqual(self.run_import(path, batch_size=2), (6, 0))
+        self.assertIn('movies: resuming after record 2', self.messages)
+        self.assertEqual(self.imported(), [
+            'import %d' % i for i in range(6)])
+
+    def test_finished_import_is_not_repeated(self):
+        path = self.write('movies.csv', self.movies(2))
+        self.run_import(path)
+
+        self.assertEqual(self.run_import(path), (2, 0))
+        self.assertIn('already imported', self.messages[-1])
+        self.assertEqual(len(self.imported()), 2)
+
+        self.assertEqual(self.run_import(path, restart=True), (2, 0))
+        self.assertEqual(len(self.imported()), 4)
+
+    def test_changed_file_must_be_restarted(self):
+        path = self.write('movies.csv', self.movies(4))
+        with mock.patch('importer.insert_rows', side_effect=[
+                None, RuntimeError('connection lost')]):
+            with self.assertRaises(RuntimeError):
+                self.run_import(path, batch_size=2)
+        self.write('movies.csv', self.movies(5))
+
+        with self.assertRaises(ValueError):
+            self.run_import(path)
+        self.assertEqual(self.run_import(path, restart=True), (5, 0))
+
+    def test_unknown_file_type(self):
+        path = os.path.join(self.workdir, 'movies.xml')
+        open(path, 'w').close()
+
+        with self.assertRaises(ValueError):
+            list(read_records(path))
+
+
+class ChangesTestCase(MockedAuthTestCase):
+    """This class represents the delta sync test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.tag = self.unique_tag()
+        # the database clock has millisecond resolution
+        self.since = encode_token(
+            (datetime.utcnow() - timedelta(seconds=1), 0, 0))
+
+    def sync(self, since, **params):
+        params = dict(params, since=since, limit=params.get('limit', 1000))
+        res = self.client().get(
+            '/movies/changes?' + '&'.join(
+                '%s=%s' % item for item in params.items()),
+            headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def changed(self, data):
+        return [movie for movie in data['movies']
+                if movie['genre'] == self.tag]
+
+    def test_changes_since_token(self):
+        ids = bulk_insert(Movie, [
+            {'name': 'kept', 'genre': self.tag},
+            {'name': 'deleted', 'genre': self.tag}])
+        self.client().patch('/movies/%d' % ids[0], json={'name': 'renamed'},
+                            headers=self.headers)
+        self.client().delete('/movies/%d' % ids[1], headers=self.headers)
+
+        data = self.sync(self.since)
+
+        self.assertEqual(self.changed(data), [
+            {'id': ids[0], 'name': 'renamed', 'genre': self.tag}])
+        self.assertIn(ids[1], data['deleted'])
+        self.assertFalse(data['more'])
+
+    def test_schema_built_by_the_migrations(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % (
+            os.path.join(workdir.name, 'migrated.db'))
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(app)
+        flask_migrate.Migrate(app, db, directory=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'migrations'))
+
+        # the tables of the initial revision, then every migration (the
+        # logging setup of env.py would silence the loggers of the tests)
+        with app.app_context(), mock.patch('logging.config.fileConfig'):
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql(
+                    'CREATE TABLE movies (id INTEGER PRIMARY KEY, '
+                    'name VARCHAR, genre VARCHAR)')
+                connection.exec_driver_sql(
+                    'CREATE TABLE actors (id INTEGER PRIMARY KEY, '
+                    'name VARCHAR, experience_level VARCHAR, '
+                    'gender VARCHAR, age INTEGER)')
+            flask_migrate.stamp(revision='217e3f474901')
+            flask_migrate.upgrade()
+
+            with db.engine.begin() as connection:
+                connection.execute(Movie.__table__.insert().values(
+                    name='migrated', genre=self.tag))
+                connection.execute(Actor.__table__.insert().values(
+                    name='migrated actor'))
+                connection.execute(Movie.__table__.update().values(
+                    name='renamed'))
+            with db.engine.connect() as connection:
+                movie = connection.execute(Movie.__table__.select()).one()
+                found = connection.exec_driver_sql(
+                    "SELECT rowid FROM movies_fts "
+                    "WHERE movies_fts MATCH 'renamed'").scalars().all()
+        self.assertIsNotNone(movie.created_at)
+        self.assertGreaterEqual(movie.updated_at, movie.created_at)
+        self.assertEqual(found, [movie.id])
+
+    def test_timestamps(self):
+        movie_id = bulk_insert(Movie, [{'name': 'a', 'genre': self.tag}])[0]
+        created = db.session.get(Movie, movie_id)
+        created_at, updated_at = created.created_at, created.updated_at
+        db.session.expire_all()
+        time.sleep(0.01)
+        update_rows(Movie, [Movie.id == movie_id], {'name': 'b'})
+        movie = db.session.get(Movie, movie_id)
+
+        self.assertEqual(created_at, updated_at)
+        self.assertEqual(movie.created_at, created_at)
+        self.assertGreater(movie.updated_at, updated_at)
+
+    def test_pages_follow_each_other(self):
+        ids = bulk_insert(Movie, [
+            {'name': 'movie %d' % i, 'genre': self.tag} for i in range(3)])
+        delete_rows(Movie, [Movie.id == ids[0]])
+
+        changed, deleted, since, more = [], [], self.since, True
+        # the pages only follow each other through settled changes
+        with mock.patch('changes.CHANGES_SAFETY_WINDOW', 0):
+            while more:
+                data = self.sync(since, limit=1)
+                changed += self.changed(data)
+                deleted += data['deleted']
+                since, more = data['since'], data['more']
+
+        self.assertEqual([movie['id'] for movie in changed], ids[1:])
+        self.assertIn(ids[0], deleted)
+
+    def test_pages_stop_at_the_safety_window(self):
+        bulk_insert(Movie, [
+            {'name': 'movie %d' % i, 'genre': self.tag} for i in range(3)])
+        first = self.sync(self.since, limit=1)
+        again = self.sync(first['since'], limit=1)
+
+        # a write stamped before the last page may still be uncommitted
+        self.assertFalse(first['more'])
+        self.assertEqual(self.changed(again), self.changed(first))
+        self.assertEqual(first['since'], self.since)
+
+    def test_up_to_date_client_gets_nothing(self):
+        bulk_insert(Movie, [{'name': 'a', 'genre': self.tag}])
+        fields = ['id', 'name', 'genre']
+        with self.app.app_context():
+            # without the safety window the token passes the new row
+            changed, _, token, _ = get_changes(
+                Movie, fields, 1000, decode_token(self.since), window=0)
+            again = get_changes(
+                Movie, fields, 1000, decode_token(token), window=0)
+
+        self.assertEqual(len(self.changed({'movies': changed})), 1)
+        self.assertEqual((again[0], again[1], again[3]), ([], [], False))
+
+    def test_recent_changes_are_sent_again(self):
+        bulk_insert(Movie, [{'name': 'a', 'genre': self.tag}])
+        data = self.sync(self.since)
+
+        self.assertEqual(len(self.changed(data)), 1)
+        self.assertEqual(len(self.changed(self.sync(data['since']))), 1)
+
+    def test_recreated_row_is_reported_alive(self):
+        movie_id = bulk_insert(Movie, [{'name': 'a', 'genre': self.tag}])[0]
+        delete_rows(Movie, [Movie.id == movie_id])
+        bulk_insert(Movie, [{'id': movie_id, 'name': 'b', 'genre': self.tag}])
+
+        data = self.sync(self.since)
+
+        self.assertEqual(self.changed(data), [
+            {'id': movie_id, 'name': 'b', 'genre': self.tag}])
+        self.assertNotIn(movie_id, data['deleted'])
+
+    def test_invalid_token(self):
+        res = self.client().get('/movies/changes?since=garbage',
+                                headers=self.headers)
+
+        self.assertEqual(res.status_code, 400)
+
+
+class SerializationTestCase(unittest.TestCase):
+    """This class represents the JSON serialization test case"""
+
+    def test_serializers_match_the_fields(self):
+        actor = Actor(id=1, name='a', experience_level='3', gender='f',
+                      age=30)
+        expected = {'id': 1, 'name': 'a', 'experience_level': '3',
+                    'gender': 'f', 'age': 30}
+
+        self.assertEqual(actor.format(), expected)
+        self.assertEqual(list(actor.format()), list(Actor.FIELDS))
+        self.assertEqual(
+            row_serializer(Actor.FIELDS)((1, 'a', '3', 'f', 30)), expected)
+        self.assertIs(serializer(('id',)), serializer(('id',)))
+
+    def test_invalid_field_names_are_rejected(self):
+        with self.assertRaises(ValueError):
+            serializer(('id', 'name); import os; ('))
+
+    def test_encoders_agree(self):
+        value = {'success': True, 'movies': [
+            {'id': 1, 'name': 'caf\u00e9 "x"', 'genre': None}]}
+
+        for name, dumps in ENCODERS.items():
+            self.assertEqual(json.loads(dumps(value)), value, name)
+
+    def test_jsonify_follows_the_config(self):
+        app = create_app()
+        app.config['JSON_SORT_KEYS'] = True
+        with app.app_context():
+            body = jsonify(b=1, a=[1]).get_data()
+            self.assertEqual(body, b'{"a":[1],"b":1}\n')
+
+            app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+            self.assertIn(b'\n  "a"', jsonify(b=1, a=[1]).get_data())
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """This class represents the benchmark suite smoke test case"""
+
+    def test_benchmark_runs_offline(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            output = os.path.join(workdir, 'bench.json')
+            result = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.api', '--sizes', '20',
+                 '--requests', '4', '--concurrency', '2',
+                 '--output', output],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, result.stderr)
+            with open(output) as results_file:
+                endpoints = json.load(results_file)['results']['20']
+        self.assertEqual(endpoints['GET /movies']['errors'], 0)
+        self.assertIn('p99_ms', endpoints['POST /movies'])
+
+    def test_serialization_benchmark_runs(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            output = os.path.join(workdir, 'serialization.json')
+            result = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.serialization',
+                 '--sizes', '50', '--repeat', '1', '--output', output],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, result.stderr)
+            with open(output) as results_file:
+                movies = json.load(results_file)['results']['50']['movies']
+        self.assertGreater(movies['json']['bytes'], 0)
+
+    def test_server_benchmark_runs(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            output = os.path.join(workdir, 'server.json')
+            result = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.server', '--modes',
+                 'sync,gthread', '--rows', '20', '--workers', '1',
+                 '--requests', '4', '--concurrency', '2',
+                 '--output', output],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, text=True, timeout=120)
+
+            self.assertEqual(result.returncode, 0, result.stderr)
+            with open(output) as results_file:
+                modes = json.load(results_file)['results']
+        self.assertEqual(modes['gthread']['GET /movies']['errors'], 0)
+        self.assertEqual(modes['sync']['POST /movies']['errors'], 0)
+
+    def test_group_commit_benchmark_runs(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            output = os.path.join(workdir, 'groupcommit.json')
+            result = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.groupcommit',
+                 '--windows', '2', '--requests', '20', '--concurrency', '4',
+                 '--output', output],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, result.stderr)
+            with open(output) as results_file:
+                modes = json.load(results_file)['results']
+        self.assertEqual(modes['per-row']['commits'], 20)
+        self.assertEqual(modes['group 2ms']['errors'], 0)
+
+    def test_find_regressions(self):
+        baseline = {'results': {'1000': {'GET /movies': {
+            'throughput': 100.0, 'p99_ms': 10.0}}}}
+        current = {'results': {'1000': {'GET /movies': {
+            'throughput': 70.0, 'p99_ms': 11.0}}}}
+
+        regressions = find_regressions(current, baseline, 0.2)
+
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('throughput', regressions[0])
+
+
+'''
+call_asgi(app, method, url, headers, json_body)
+    sends one request to an ASGI app and returns the status, the headers
+    and the body of its response
+'''
+
+
+def call_asgi(app, method, url, headers=None, json_body=None):
+    path, _, query = url.partition('?')
+    headers = dict(headers or {})
+    body = b''
+    if json_body is not None:
+        body = json.dumps(json_body).encode()
+        headers['Content-Type'] = 'application/json'
+    scope = {
+        'type': 'http', 'http_version': '1.1', 'method': method,
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'root_path': '', 'query_string': query.encode(),
+        'headers': [(name.lower().encode(), value.encode())
+                    for name, value in headers.items()],
+        'client': ('testclient', 50000), 'server': ('testserver', 80)}
+    response = {'headers': {}, 'body': b''}
+
+    async def run():
+        done = asyncio.Event()
+        request_sent = False
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {'type': 'http.request', 'body': body}
+            await done.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['headers'] = {
+                    name.decode().lower(): value.decode()
+                    for name, value in message['headers']}
+            elif message['type'] == 'http.response.body':
+                response['body'] += message.get('body', b'')
+                if not message.get('more_body'):
+                    done.set()
+
+        await app(scope, receive, send)
+
+    asyncio.run(run())
+    return response['status'], response['headers'], response['body']
+
+
+class AsgiTestCase(MockedAuthTestCase):
+    """This class represents the async (ASGI) serving mode test case"""
+
+    def setUp(self):
+        super().setUp()
+        from asgi import app
+        self.asgi_app = app
+
+    def request(self, method, url, json_body=None, headers=None):
+        return call_asgi(
+            self.asgi_app, method, url, dict(self.headers, **(headers or {})),
+            json_body)
+
+    def test_async_movie_lifecycle(self):
+        status, _, body = self.request(
+            'POST', '/movies', {'name': 'async_movie', 'genre': 'drama'})
+        movie = json.loads(body)['movie'][0]
+        self.assertEqual(status, 200)
+
+        status, _, body = self.request(
+            'PATCH', '/movies/%d' % movie['id'], {'genre': 'comedy'})
+        self.assertEqual(json.loads(body)['movie'][0]['genre'], 'comedy')
+
+        status, _, body = self.request('DELETE', '/movies/%d' % movie['id'])
+        self.assertEqual(json.loads(body)['deleted'], movie['id'])
+
+        status, _, body = self.request('DELETE', '/movies/%d' % movie['id'])
+        self.assertEqual(status, 404)
+        self.assertEqual(json.loads(body)['message'], 'resource not found')
+
+    def test_handed_over_request_is_authenticated_once(self):
+        bulk_insert(Movie, [{'name': 'handed_over', 'genre': 'drama'}])
+        with mock.patch('auth.check_rate_limit') as check_rate_limit:
+            status, _, _ = self.request('GET', '/movies?include=actors')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(auth.verify_decode_jwt.call_count, 1)
+        self.assertEqual(check_rate_limit.call_count, 1)
+
+    def test_async_handlers_are_admitted(self):
+        full = Bulkhead('write', 0, queue_size=0)
+        with mock.patch.dict('admission.bulkheads', {'write': full}):
+            status, headers, _ = self.request('POST', '/movies', {'name': 'x'})
+
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['retry-after'], '1')
+
+    def test_async_requests_are_timed(self):
+        bulk_insert(Actor, [{'name': 'timed_actor'}])
+        before = registry.snapshot()['routes'].get('GET /actors', {})
+        status, headers, _ = self.request('GET', '/actors?limit=1')
+        entry = registry.snapshot()['routes']['GET /actors']
+
+        self.assertEqual(status, 200)
+        self.assertIn('total;dur=', headers['server-timing'])
+        self.assertEqual(entry['count'], before.get('count', 0) + 1)
+
+    def test_async_writes_start_the_primary_window(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        replicas = ReplicaSet(
+            ['sqlite:///%s' % os.path.join(workdir.name, 'replica.db')])
+        self.addCleanup(replicas.dispose)
+        with mock.patch('replicas.replica_set', replicas):
+            status, headers, body = self.request(
+                'POST', '/movies', {'name': 'async_write'})
+            movie_id = json.loads(body)['movie'][0]['id']
+            deleted = self.request('DELETE', '/movies/%d' % movie_id)
+            missing = self.request('DELETE', '/movies/%d' % movie_id)
+
+        self.assertEqual(status, 200)
+        self.assertIn(PRIMARY_COOKIE + '=', headers['set-cookie'])
+        self.assertEqual(
+            headers[PRIMARY_HEADER.lower()],
+            headers['set-cookie'].split(';')[0].split('=')[1])
+        self.assertIn(PRIMARY_HEADER.lower(), deleted[1])
+        self.assertEqual(missing[0], 404)
+        self.assertNotIn(PRIMARY_HEADER.lower(), missing[1])
+
+    def test_async_list_pages_and_etag(self):
+        self.request('POST', '/actors', {'name': 'async_actor', 'age': '30'})
+        status, headers, body = self.request('GET', '/actors?fields=name')
+        data = json.loads(body)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(list(data['actors'][0]), ['name'])
+
+        status, _, body = self.request(
+            'GET', '/actors', headers={'If-None-Match': headers['etag']})
+        self.assertEqual(status, 304)
+
+    def test_async_filter_and_sort(self):
+        self.request('POST', '/actors', {'name': 'async_old', 'age': 99})
+        status, _, body = self.request('GET', '/actors?age_min=99&sort=-age')
+        actors = json.loads(body)['actors']
+
+        self.assertEqual(status, 200)
+        self.assertTrue(all(actor['age'] >= 99 for actor in actors))
+
+    def test_async_stream(self):
+        self.request('POST', '/movies', {'name': 'async_streamed'})
+        status, _, body = self.request('GET', '/movies?stream=true')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            len(json.loads(body)['movies']), Movie.query.count())
+
+    def test_async_permissions_and_validation(self):
+        status, _, body = self.request('POST', '/movies', {'genre': 'x'})
+        self.assertEqual(status, 422)
+
+        status, _, body = call_asgi(self.asgi_app, 'GET', '/movies')
+        self.assertEqual(status, 401)
+        self.assertEqual(
+            json.loads(body)['message'], 'Authorization header is expected.')
+
+    def test_other_routes_are_served_by_flask(self):
+        status, _, body = self.request('GET', '/')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            json.loads(body)['message'], 'Applicaion is up and running')
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()